@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+
+import pandas as pd
+import time
+
+from worldbankApi import fetch_series, get_regionnames
+from tools import read_water_data, get_oecd_iso3_code_mapping, merge_wbseries_with_oecd_data
+
+
+def merge_wbseries_with_oecd_data_rowwise(ioecddf, iwbdf, codemapping, cachedir="data/cache", mergedonor=True,
+                                          mergerecipient=True):
+    """
+    the former implementation of merge_wbseries_with_oecd_data, the merge-keys are created row by row as
+    concatenated strings. it is only kept as baseline for the benchmark, see there for the parameters
+    """
+    oecddf = ioecddf.copy()
+    if mergedonor:
+        oecddf = ioecddf[ioecddf['DonorCode'].isin(list(codemapping))]
+    if mergerecipient:
+        oecddf = oecddf[oecddf['RecipientCode'].isin(list(codemapping))]
+    wbdf = iwbdf[iwbdf['Country'].isin(list(codemapping))].reset_index()
+
+    cdf = get_regionnames(cachedir=cachedir)
+    wbdf = wbdf.merge(cdf, right_on="id", how="left", left_on="Country")
+
+    wbdf['mergefield'] = wbdf['Year'].apply(lambda x: str(x))
+    wbdf['mergefield'] = wbdf['mergefield'] + wbdf['id']
+
+    odf = oecddf.copy()
+
+    if mergedonor:
+        odf['donormerge'] = odf['CommitmentDate'].apply(lambda x: str(x.year))
+        odf['donormerge'] = odf['donormerge'] + odf['DonorCode'].apply(lambda x: str(codemapping[x]))
+        odf = odf.merge(wbdf.add_prefix("Donorstat "),
+                        right_on='Donorstat mergefield',
+                        how="left",left_on='donormerge')
+        odf.drop(columns=['Donorstat mergefield','donormerge','Donorstat index','Donorstat Year','Donorstat name','Donorstat Country'],inplace=True)
+        odf.rename(columns={'Donorstat id': 'Donorstat iso3Code'},inplace=True)
+
+    if mergerecipient:
+        odf['recipientmerge'] = odf['CommitmentDate'].apply(lambda x: str(x.year))
+        odf['recipientmerge'] = odf['recipientmerge'] + odf['RecipientCode'].apply(lambda x: str(codemapping[x]))
+        odf = odf.merge(wbdf.add_prefix("Recipientstat "),
+                        right_on='Recipientstat mergefield',
+                        how="left",left_on="recipientmerge")
+        odf.drop(columns=['Recipientstat mergefield','recipientmerge','Recipientstat index','Recipientstat Year','Recipientstat Country'],inplace=True)
+        odf.rename(columns={'Recipientstat id': 'Recipientstat iso3Code'},inplace=True)
+
+    return odf
+
+def run_benchmark(setname="fullset", datadir="data/", cachedir="data/cache", repeat=1, backend=None):
+    """
+    times merge_wbseries_with_oecd_data against the former row by row implementation on the same data
+    and checks both return the same DataFrame
+
+    @param setname: the set of zip-files to read, see tools.datasets
+    @param datadir: where to find the zip-files
+    @param cachedir: where to store/find cached data
+    @param repeat: the rows of the set are repeated this often to benchmark larger frames
+    @param backend: where to fetch the worldbank data, see worldbankApi.fetch_series
+
+    @return: a tupel (seconds of the baseline, seconds of merge_wbseries_with_oecd_data)
+    """
+    wbdf = fetch_series(cachedir=cachedir,backend=backend)
+    codemapping = get_oecd_iso3_code_mapping(cachedir=cachedir,datadir=datadir,setname=setname)
+    df = read_water_data(setname,datadir=datadir,cachedir=cachedir).reset_index()
+    if repeat > 1:
+        df = pd.concat([df]*repeat,ignore_index=True)
+    # the baseline expects plain values instead of categoricals
+    odf = df.astype(dict([(i, object) for i in df.columns if df[i].dtype.name == 'category']))
+
+    start = time.perf_counter()
+    baseline = merge_wbseries_with_oecd_data_rowwise(odf,wbdf,codemapping,cachedir=cachedir)
+    baseline_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    result = merge_wbseries_with_oecd_data(df,wbdf,codemapping,cachedir=cachedir)
+    seconds = time.perf_counter() - start
+
+    result = result.astype(dict([(i, object) for i in result.columns if result[i].dtype.name == 'category']))
+    print("Rows: %d, row by row: %.2fs, vectorized: %.2fs, speedup: %.1fx, same result: %s"
+          %(len(df), baseline_seconds, seconds, baseline_seconds / seconds, baseline.equals(result)))
+    return (baseline_seconds, seconds)
+
+if __name__ == "__main__":
+    run_benchmark()
@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+
+from concurrent.futures import ProcessPoolExecutor
+
+
+def init_worker():
+    """
+    prepares a worker process for rendering. matplotlib has to use a non-interactive backend, plotly
+    keeps its kaleido process alive for the lifetime of the worker, so it is started once per worker.
+    """
+    import matplotlib
+    matplotlib.use("Agg")
+
+
+class ChartRenderer:
+    """
+    renders the images (png) of the generate_*-functions. the data and layout of every chart are queued
+    and rendered inline, deferred or by a pool of worker processes. the json-files are always written
+    by the generate_*-functions themselves.
+
+    usage:
+        with ChartRenderer(workers=4) as renderer:
+            generate_reports(df,renderer=renderer)
+    """
+
+    def __init__(self, workers=0, images=True, defer=False):
+        """
+        @param workers: how many processes render the charts. 0 renders in the calling process, None uses one process per cpu
+        @param images: False skips the images, only the json-files are created
+        @param defer: render queued charts only when wait() is called
+        """
+        self.workers = workers
+        self.images = images
+        self.defer = defer
+        self.executor = None
+        self.queue = []
+        self.futures = []
+        self.callbacks = []
+
+    def render(self, function, *args):
+        """
+        queues a chart. function is called with args and has to be defined on module level, so it can be
+        used by the worker processes
+
+        @param function: the render_*-function creating the image
+        @param args: the arguments (data, layout and filename) of the chart
+        """
+        if not self.images:
+            return
+
+        if self.defer:
+            self.queue.append((function, args))
+        elif self.workers == 0:
+            function(*args)
+        else:
+            self.submit(function, args)
+
+    def finish(self, function, *args):
+        """
+        calls function in this process once all charts queued so far are rendered, for example to write
+        the manifest of a result
+
+        @param function: the function to call
+        @param args: the arguments of the function
+        """
+        if not self.images or (self.workers == 0 and not self.defer):
+            function(*args)
+        else:
+            self.callbacks.append((function, args))
+
+    def submit(self, function, args):
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(max_workers=self.workers, initializer=init_worker)
+        self.futures.append(self.executor.submit(function, *args))
+
+    def wait(self):
+        """
+        renders all deferred charts and waits for the workers, afterwards the callbacks of finish() are called.
+        errors of the workers are raised here.
+        """
+        (queue, self.queue) = (self.queue, [])
+        for (function, args) in queue:
+            if self.workers == 0:
+                function(*args)
+            else:
+                self.submit(function, args)
+
+        # the callbacks are dropped if a chart fails
+        (futures, self.futures) = (self.futures, [])
+        (callbacks, self.callbacks) = (self.callbacks, [])
+        for i in futures:
+            i.result()
+
+        for (function, args) in callbacks:
+            function(*args)
+
+    def close(self):
+        self.wait()
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+# renders everything inline, used by the generate_*-functions if no renderer is given
+inline_renderer = ChartRenderer()
@@ -0,0 +1,319 @@
+#!/usr/bin/env python3
+
+import pandas as pd
+import numpy as np
+import pyarrow as pa
+import copy
+
+from worldbankApi import fetch_series, default_series
+from tools import datasets, read_water_data, merge_wbseries_with_oecd_data, get_oecd_iso3_code_mapping
+from tools import apply_historical_incomegroups_wb, apply_historical_incomegroups_oecd
+from rollupCube import RollupCube, cube_dimensions, cube_valuenames, get_count_name
+
+# the code-filters of where, as parameter and feature
+query_code_filters = [('donorcodes','DonorCode'),('recipientcodes','RecipientCode'),('sectorcodes','SectorCode'),
+                      ('purposecodes','PurposeCode'),('flowcodes','FlowCode'),('incomegroups','IncomegroupName')]
+
+# the features added by the enrichments
+incomegroup_features = {'wb': 'IncomegroupName (WB)', 'oecd': 'IncomegroupName (oecd hist)'}
+
+# the operators of the filters and how pandas evaluates them for features that are not stored in the partitions
+filter_operators = {'==': lambda s, v: s == v,
+                    '!=': lambda s, v: s != v,
+                    '<': lambda s, v: s < v,
+                    '<=': lambda s, v: s <= v,
+                    '>': lambda s, v: s > v,
+                    '>=': lambda s, v: s >= v,
+                    'in': lambda s, v: s.isin(v),
+                    'not in': lambda s, v: ~s.isin(v)}
+
+
+def is_enriched_feature(feature):
+    """
+    @return: True if the feature is added by an enrichment and not read from the partitions
+    """
+    return (feature.startswith("Donorstat ") or feature.startswith("Recipientstat ") or
+            feature in incomegroup_features.values())
+
+def apply_filters(df, filters):
+    """
+    applies filters in the format used by pyarrow to a DataFrame
+
+    @param df: the DataFrame to filter
+    @param filters: a list of tupels (column, operator, value)
+
+    @return: the selected rows of df
+    """
+    mask = np.ones(len(df),dtype=bool)
+    for (column, operator, value) in filters:
+        mask &= filter_operators[operator](df[column],value).fillna(False).to_numpy(dtype=bool)
+    return df if mask.all() else df[mask]
+
+class CrsQuery:
+    """
+    a lazy query over the microdata of the crs. every method returns a new query, nothing is read until
+    collect() is called. the whole chain is planned at once: only the needed features are read, the filters
+    on stored features are applied by the reader, the enrichments only see the remaining rows and sums over
+    the dimensions of the rollup cube are answered from the cube.
+
+    usage:
+        query = (CrsQuery(setname='sane')
+                 .where(donorcodes=['5'],sectorcodes=['140'],years=(2010,None),filterzerocommitment=True)
+                 .enrich(series=['SP.POP.TOTL'])
+                 .aggregate(['Recipientstat iso3Code'],commitment=('USD_Commitment_Defl','sum')))
+        print(query.explain())
+        df = query.collect()
+    """
+
+    def __init__(self, setname="sane", datadir="data/", datasets=datasets, cachedir="data/cache",
+                 workers=1, backend=None):
+        """
+        @param setname: one of 'fullset', 'sane commitment', 'sane disbursement','sane','playset'
+        @param datadir: where to find the zip-files
+        @param datasets: a dict with datasets containing lists of zip-filenames
+        @param cachedir: where to store/find cached data
+        @param workers: how many missing partitions are built in parallel
+        @param backend: where to fetch the worldbank data, see worldbankApi.ApiBackend and worldbankApi.FixtureBackend
+        """
+        self.setname = setname
+        self.datadir = datadir
+        self.datasets = datasets
+        self.cachedir = cachedir
+        self.workers = workers
+        self.backend = backend
+
+        self.columns = None
+        self.codes = {}
+        self.years = (None, None)
+        self.filters = []
+        self.series = None
+        self.mergedonor = False
+        self.mergerecipient = False
+        self.incomegroups = []
+        self.by = None
+        self.aggregations = None
+
+    def derive(self):
+        query = copy.copy(self)
+        query.codes = dict(self.codes)
+        query.filters = list(self.filters)
+        query.incomegroups = list(self.incomegroups)
+        return query
+
+    def select(self, columns):
+        """
+        @param columns: an array of the features of the result, stored or added by an enrichment
+        """
+        query = self.derive()
+        query.columns = list(columns)
+        return query
+
+    def where(self, years=None, donorcodes=None, recipientcodes=None, sectorcodes=None, purposecodes=None,
+              flowcodes=None, incomegroups=None, filterzerocommitment=False, valuename='USD_Commitment_Defl',
+              filters=None):
+        """
+        selects rows, every call adds its filters to the filters of the query
+
+        @param years: a tupel (startyear, stopyear) including both years, one of them may be None
+        @param donorcodes: an array of donor country codes. Use None or array of size 0 to skip this filter
+        @param recipientcodes: an array of recipient codes. Use None or array of size 0 to skip this filter
+        @param sectorcodes: an array of sector codes. Use None or array of size 0 to skip this filter
+        @param purposecodes: an array of purpose codes. Use None or array of size 0 to skip this filter
+        @param flowcodes: an array of flow codes. Use None or array of size 0 to skip this filter
+        @param incomegroups: an array of incomegroup names (IncomegroupName). Use None or array of size 0 to skip this filter
+        @param filterzerocommitment: filter out rows without or with a value of zero for 'valuename'
+        @param valuename: defaults to USD_Commitment_Defl
+        @param filters: additional filters as list of tupels (column, operator, value) as used by pyarrow, the
+                        columns may be added by an enrichment
+        """
+        query = self.derive()
+        parameters = {'donorcodes': donorcodes, 'recipientcodes': recipientcodes, 'sectorcodes': sectorcodes,
+                      'purposecodes': purposecodes, 'flowcodes': flowcodes, 'incomegroups': incomegroups}
+        for (parameter, feature) in query_code_filters:
+            codes = parameters[parameter]
+            if type(codes) == type([]) and len(codes) > 0:
+                if feature in query.codes:
+                    codes = [i for i in query.codes[feature] if i in codes]
+                query.codes[feature] = list(codes)
+
+        if years:
+            (startyear, stopyear) = years
+            if startyear and (query.years[0] is None or startyear > query.years[0]):
+                query.years = (startyear, query.years[1])
+            if stopyear and (query.years[1] is None or stopyear < query.years[1]):
+                query.years = (query.years[0], stopyear)
+
+        # NaN never passes the filter, so this also removes rows without a value
+        if filterzerocommitment:
+            query.filters.append((valuename,'!=',0.0))
+        if filters:
+            query.filters += list(filters)
+        return query
+
+    def enrich(self, series=default_series, donor=True, recipient=True):
+        """
+        adds the series of the worldbank as 'Donorstat <series>' and 'Recipientstat <series>', see
+        tools.merge_wbseries_with_oecd_data. rows of countries without a mapping are removed.
+
+        @param series: the series of the worldbank to add
+        @param donor: add the series of the donors
+        @param recipient: add the series of the recipients
+        """
+        query = self.derive()
+        query.series = list(series)
+        query.mergedonor = donor
+        query.mergerecipient = recipient
+        return query
+
+    def with_incomegroups(self, kinds=['wb','oecd']):
+        """
+        adds the historical incomegroups of the recipients, see tools.apply_historical_incomegroups
+
+        @param kinds: 'wb' adds 'IncomegroupName (WB)', 'oecd' adds 'IncomegroupName (oecd hist)'
+        """
+        query = self.derive()
+        query.incomegroups = [i for i in query.incomegroups if i not in kinds] + list(kinds)
+        return query
+
+    def aggregate(self, by, **aggregations):
+        """
+        groups the selected rows, the result has one row per group
+
+        @param by: an array of features to group by
+        @param aggregations: the aggregates as name=(feature, function) like pandas' named aggregation,
+                             ex.: commitment=('USD_Commitment_Defl','sum')
+        """
+        query = self.derive()
+        query.by = list(by)
+        query.aggregations = dict(aggregations)
+        return query
+
+    def get_filters(self):
+        """
+        @return: all filters of the query as list of tupels (column, operator, value)
+        """
+        # codes that exclude each other leave an empty list, pyarrow needs to know its type
+        result = [(f, 'in', c if len(c) > 0 else pa.array([],type=pa.string())) for (f, c) in self.codes.items()]
+        (startyear, stopyear) = self.years
+        if startyear:
+            result.append(('Year','>=',pd.Timestamp(year=startyear,month=1,day=1)))
+        if stopyear:
+            result.append(('Year','<',pd.Timestamp(year=stopyear+1,month=1,day=1)))
+        return result + self.filters
+
+    def get_output_features(self):
+        if self.aggregations is not None:
+            return self.by + [f for (f, function) in self.aggregations.values()]
+        return self.columns
+
+    def can_use_cube(self):
+        """
+        @return: True if the result is a sum over the dimensions of the rollup cube
+        """
+        if self.aggregations is None or self.series is not None or len(self.incomegroups) > 0:
+            return False
+        if any(i not in cube_dimensions for i in self.by):
+            return False
+        if any(function != 'sum' or f not in cube_valuenames for (f, function) in self.aggregations.values()):
+            return False
+        # removing rows without a value does not change the sums of this value, groups left without such
+        # rows are removed by their count in collect_from_cube
+        sums = set([f for (f, function) in self.aggregations.values()])
+        return all(operator == '!=' and value == 0.0 and sums == set([column])
+                   for (column, operator, value) in self.filters)
+
+    def plan(self):
+        """
+        @return: a dict describing how the query is executed
+        """
+        if self.can_use_cube():
+            return {'source': 'cube', 'by': self.by, 'years': self.years, 'codes': self.codes,
+                    'aggregations': self.aggregations}
+
+        filters = self.get_filters()
+        output = self.get_output_features()
+        columns = None
+        if output is not None:
+            columns = set([i for i in output if not is_enriched_feature(i)])
+            if self.series is not None or len(self.incomegroups) > 0:
+                columns |= set(['CommitmentDate','DonorCode','RecipientCode'])
+            columns = sorted(columns)
+
+        return {'source': 'partitions',
+                'columns': columns,
+                'pushdown': [(c, o, v) for (c, o, v) in filters if not is_enriched_feature(c)],
+                'series': self.series,
+                'mergedonor': self.mergedonor,
+                'mergerecipient': self.mergerecipient,
+                'incomegroups': self.incomegroups,
+                'postfilters': [(c, o, v) for (c, o, v) in filters if is_enriched_feature(c)],
+                'select': self.columns if self.aggregations is None else None,
+                'by': self.by,
+                'aggregations': self.aggregations}
+
+    def explain(self):
+        """
+        @return: the plan as readable text
+        """
+        plan = self.plan()
+        return "\n".join(["%s: %s" %(k, v) for (k, v) in plan.items() if v not in (None, [], {}, False)])
+
+    def collect(self):
+        """
+        executes the query
+
+        @return: a DataFrame with the selected rows and features or the aggregates
+        """
+        plan = self.plan()
+        if plan['source'] == 'cube':
+            return self.collect_from_cube()
+
+        df = read_water_data(self.setname,datadir=self.datadir,datasets=self.datasets,cachedir=self.cachedir,
+                             columns=plan['columns'],filters=plan['pushdown'],workers=self.workers)
+
+        if self.series is not None:
+            wbdf = fetch_series(series=self.series,cachedir=self.cachedir,backend=self.backend)
+            codemapping = get_oecd_iso3_code_mapping(cachedir=self.cachedir,datadir=self.datadir,setname=self.setname,
+                                                     datasets=self.datasets)
+            df = merge_wbseries_with_oecd_data(df.reset_index(),wbdf,codemapping=codemapping,cachedir=self.cachedir,
+                                               mergedonor=self.mergedonor,mergerecipient=self.mergerecipient)
+        if 'wb' in self.incomegroups:
+            df = apply_historical_incomegroups_wb(df,get_oecd_iso3_code_mapping(cachedir=self.cachedir,
+                                                                               datadir=self.datadir,
+                                                                               setname=self.setname,
+                                                                               datasets=self.datasets),
+                                                  datadir=self.datadir,cachedir=self.cachedir)
+        if 'oecd' in self.incomegroups:
+            df = apply_historical_incomegroups_oecd(df,datadir=self.datadir,cachedir=self.cachedir)
+
+        df = apply_filters(df,plan['postfilters'])
+
+        if self.aggregations is not None:
+            df = df.groupby(self.by,observed=True).agg(**self.aggregations).reset_index()
+            return df.sort_values(self.by,kind='mergesort').reset_index(drop=True)
+        if self.columns is not None:
+            return df[[i for i in self.columns if i in df]]
+        return df
+
+    def collect_from_cube(self):
+        cube = RollupCube.load(self.setname,datadir=self.datadir,datasets=self.datasets,cachedir=self.cachedir,
+                               workers=self.workers)
+        codes = dict([(parameter, self.codes.get(feature)) for (parameter, feature) in query_code_filters])
+        # an empty list of codes selects nothing, the cube would skip the filter
+        if any(c is not None and len(c) == 0 for c in codes.values()):
+            cube.cube = cube.cube.iloc[:0]
+        sums = sorted(set([f for (f, function) in self.aggregations.values()]))
+        nonzero = [column for (column, operator, value) in self.filters]
+        df = cube.query(by=self.by,valuenames=sums,counts=len(nonzero) > 0,years=self.years,**codes)
+        # the rows of the removed groups had no value, the sums are 0.0 but the partitions have no such group
+        for i in nonzero:
+            df = df[df[get_count_name(i)] > 0]
+
+        # like pandas groups without missing values in the features of by, 'Year' is a date in the microdata
+        df = df.dropna(subset=self.by).reset_index(drop=True)
+        if 'Year' in self.by:
+            df['Year'] = pd.to_datetime(df['Year'].astype(int).astype(str),format="%Y")
+        result = df[self.by].copy()
+        for (name, (f, function)) in self.aggregations.items():
+            result[name] = df[f]
+        return result.sort_values(self.by,kind='mergesort').reset_index(drop=True)
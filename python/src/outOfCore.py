@@ -0,0 +1,490 @@
+#!/usr/bin/env python3
+
+import pandas as pd
+import numpy as np
+import pyarrow.parquet as pq
+import pickle
+import shutil
+import tempfile
+from datetime import datetime
+
+from worldbankApi import fetch_series, default_series
+from tools import datasets, build_partitions, extract_features, merge_wbseries_with_oecd_data
+from tools import get_oecd_iso3_code_mapping, concat_water_data
+from waterData import default_features, default_valuenames, default_groupings, default_incomegroups
+from waterData import default_focus_groups, default_microdata_selections
+from waterData import generate_histograms_about_projectsize, generate_barchart_for_incomegroup_distribution
+from waterData import generate_sunburst_for_grouping, filter_donor_sector_flow_recipient, select_commitment_years
+from waterData import select_sunburst_data, select_barchart_data, get_grouping_cube, get_histogram_edges
+from waterData import get_histogram_series, save_micro_data
+from chartRenderer import inline_renderer
+
+# how much memory a row of a batch needs while it is enriched and filtered, relative to the row as read.
+# the merges of the enrichment copy the rows and add the series of donor and recipient
+batch_memory_factor = 8
+
+# how many rows are read to estimate the memory of a row
+batch_probe_rows = 1000
+
+
+class ValueStore:
+    """
+    collects the values (float64) of many groups, ex. to calculate exact medians. the values are kept in memory
+    until they need more than the budget, then they are appended to files in a temporary directory and read
+    back chunk by chunk.
+
+    usage:
+        with ValueStore(budget=256*1024*1024) as store:
+            store.add(('LDCs',2019),values)
+            median = np.median(store.get_values(('LDCs',2019)))
+    """
+
+    def __init__(self, budget=256*1024*1024):
+        """
+        @param budget: how many bytes of values are kept in memory
+        """
+        self.budget = budget
+        self.arrays = {}
+        self.counts = {}
+        self.nbytes = 0
+        self.directory = None
+        self.filenames = {}
+
+    def add(self, key, values):
+        """
+        @param key: the group of the values, anything hashable
+        @param values: a numpy array, the values of a group are kept in the order they are added
+        """
+        values = np.ascontiguousarray(values,dtype=np.float64)
+        self.counts[key] = self.counts.get(key,0) + len(values)
+        if len(values) == 0:
+            return
+        self.arrays.setdefault(key,[]).append(values)
+        self.nbytes += values.nbytes
+        if self.nbytes > self.budget:
+            self.spill()
+
+    def spill(self):
+        """
+        appends the values in memory to the files of their groups
+        """
+        if self.directory is None:
+            self.directory = tempfile.mkdtemp(prefix="water-data-")
+        for (key, arrays) in self.arrays.items():
+            if key not in self.filenames:
+                self.filenames[key] = "%s/%d.float64" %(self.directory,len(self.filenames))
+            with open(self.filenames[key],'ab') as fd:
+                for i in arrays:
+                    i.tofile(fd)
+        self.arrays = {}
+        self.nbytes = 0
+
+    def count(self, key):
+        return self.counts.get(key,0)
+
+    def iter_chunks(self, key, chunksize=1000000):
+        """
+        yields the values of a group as numpy arrays, only one chunk of the values on disk is read at a time
+        """
+        if key in self.filenames:
+            with open(self.filenames[key],'rb') as fd:
+                while True:
+                    chunk = np.fromfile(fd,dtype=np.float64,count=chunksize)
+                    if len(chunk) == 0:
+                        break
+                    yield chunk
+        for i in self.arrays.get(key,[]):
+            yield i
+
+    def get_values(self, key):
+        """
+        @return: all values of a group as one numpy array
+        """
+        chunks = list(self.iter_chunks(key))
+        return np.concatenate(chunks) if len(chunks) > 0 else np.empty(0,dtype=np.float64)
+
+    def close(self):
+        if self.directory is not None:
+            shutil.rmtree(self.directory,ignore_errors=True)
+            self.directory = None
+        self.arrays = {}
+        self.filenames = {}
+        self.nbytes = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class FrameStore:
+    """
+    collects the DataFrames of many groups, ex. the rows of the microdata. like the ValueStore the frames are
+    kept in memory until they need more than the budget, then they are written to files in a temporary directory
+    and read back one by one.
+
+    usage:
+        with FrameStore(budget=256*1024*1024) as store:
+            store.add('microdata',df)
+            for chunk in store.iter_frames('microdata'):
+                ...
+    """
+
+    def __init__(self, budget=256*1024*1024):
+        """
+        @param budget: how many bytes of frames are kept in memory
+        """
+        self.budget = budget
+        self.frames = {}
+        self.empty = {}
+        self.nbytes = 0
+        self.directory = None
+        self.filenames = {}
+
+    def add(self, key, df):
+        """
+        @param key: the group of the frame, anything hashable
+        @param df: a DataFrame, the frames of a group are kept in the order they are added. empty frames are
+                   only kept as long as the group has no rows, they keep the features and types
+        """
+        if len(df) == 0:
+            self.empty.setdefault(key,df)
+            return
+        self.frames.setdefault(key,[]).append(df)
+        self.nbytes += df.memory_usage(index=True,deep=True).sum()
+        if self.nbytes > self.budget:
+            self.spill()
+
+    def spill(self):
+        """
+        writes the frames in memory to files, one file per frame
+        """
+        if self.directory is None:
+            self.directory = tempfile.mkdtemp(prefix="water-data-")
+        for (key, frames) in self.frames.items():
+            for df in frames:
+                filename = "%s/frame-%d.p" %(self.directory,sum([len(i) for i in self.filenames.values()]))
+                with open(filename,'wb') as fd:
+                    pickle.dump(df,fd,protocol=pickle.HIGHEST_PROTOCOL)
+                self.filenames.setdefault(key,[]).append(filename)
+        self.frames = {}
+        self.nbytes = 0
+
+    def iter_frames(self, key):
+        """
+        yields the frames of a group, only one frame written to a file is read at a time. a group without
+        rows yields one empty frame
+        """
+        found = False
+        for filename in self.filenames.get(key,[]):
+            found = True
+            with open(filename,'rb') as fd:
+                yield pickle.load(fd)
+        for df in self.frames.get(key,[]):
+            found = True
+            yield df
+        if not found and key in self.empty:
+            yield self.empty[key]
+
+    def close(self):
+        if self.directory is not None:
+            shutil.rmtree(self.directory,ignore_errors=True)
+            self.directory = None
+        self.frames = {}
+        self.empty = {}
+        self.filenames = {}
+        self.nbytes = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class Aggregate:
+    """
+    the partial aggregates of one generate_*-function for one time window. add() is called for every batch of
+    rows, the generate_*-function takes the merged result with the parameter 'aggregate'.
+    """
+
+    def __init__(self, **params):
+        self.params = params
+
+    def check(self, **params):
+        """
+        raises a ValueError if the result is requested with other parameters than it was collected with
+        """
+        if params != self.params:
+            raise ValueError("collected with %s, requested with %s" %(self.params,params))
+
+class HistogramAggregate(Aggregate):
+    """
+    collects the values of generate_histograms_about_projectsize, the histograms are calculated from the
+    collected values in two passes (bounds of the windows, counts of the bins)
+    """
+
+    def __init__(self, store, key, valuename='USD_Commitment_Defl', filterzerocommitment=True):
+        Aggregate.__init__(self,valuename=valuename,filterzerocommitment=filterzerocommitment)
+        self.store = store
+        self.key = key
+
+    def add(self, df):
+        values = df[self.params['valuename']].to_numpy(dtype=np.float64)
+        if self.params['filterzerocommitment']:
+            values = values[values != 0.0]
+        self.store.add(self.key,values)
+
+    def get_chunks(self, valuename, filterzerocommitment):
+        """
+        @return: a generator of DataFrames with the collected values, numbered across all chunks
+        """
+        self.check(valuename=valuename,filterzerocommitment=filterzerocommitment)
+        start = 0
+        for chunk in self.store.iter_chunks(self.key):
+            yield pd.DataFrame({valuename: chunk},index=pd.RangeIndex(start,start+len(chunk)))
+            start += len(chunk)
+
+    def get_windows(self, windowsize, bins=50):
+        """
+        @return: the same as waterData.get_histogram_windows for the collected values
+        """
+        bounds = [(np.float64(lower), np.float64(upper)) for (lower, upper) in windowsize]
+        result = [{'window': i, 'count': 0, 'sum': 0.0, 'min': np.inf, 'max': -np.inf,
+                   'edges': None, 'counts': None, 'histogram': None} for i in bounds]
+
+        for chunk in self.store.iter_chunks(self.key):
+            chunk = chunk[~np.isnan(chunk)]
+            for entry in result:
+                (lower, upper) = entry['window']
+                window = chunk[(chunk > lower) & (chunk < upper)]
+                if len(window) > 0:
+                    entry['count'] += len(window)
+                    entry['sum'] += window.sum()
+                    entry['min'] = min(entry['min'],window.min())
+                    entry['max'] = max(entry['max'],window.max())
+
+        for entry in result:
+            if entry['count'] > 0:
+                entry['edges'] = get_histogram_edges(entry['min'],entry['max'],bins=bins)
+                entry['counts'] = np.zeros(bins,dtype=np.int64)
+
+        # the bins are counted per chunk, intervals are closed on the right side
+        for chunk in self.store.iter_chunks(self.key):
+            chunk = np.sort(chunk[~np.isnan(chunk)])
+            for entry in result:
+                if entry['count'] > 0:
+                    (lower, upper) = entry['window']
+                    window = chunk[np.searchsorted(chunk,lower,side='right'):np.searchsorted(chunk,upper,side='left')]
+                    entry['counts'] += np.diff(np.searchsorted(window,entry['edges'],side='right'))
+
+        for entry in result:
+            if entry['count'] > 0:
+                entry['histogram'] = get_histogram_series(entry['edges'],entry['counts'])
+            del entry['min']
+            del entry['max']
+        return result
+
+class SunburstAggregate(Aggregate):
+    """
+    collects the cube of generate_sunburst_for_grouping, the cubes of the batches are merged by summing them up
+    """
+
+    # how many cubes of batches are kept before they are merged
+    merge_cubes = 16
+
+    def __init__(self, valuename='USD_Commitment_Defl', incomegroups=default_incomegroups, filterzerocommitment=True,
+                 groupings=default_groupings):
+        Aggregate.__init__(self,valuename=valuename,incomegroups=incomegroups,
+                           filterzerocommitment=filterzerocommitment,groupings=groupings)
+        self.cubes = []
+
+    def add(self, df):
+        df = select_sunburst_data(df,**self.params)
+        self.cubes.append(get_grouping_cube(df,self.params['valuename'],groupings=self.params['groupings']))
+        if len(self.cubes) >= self.merge_cubes:
+            self.merge()
+
+    def merge(self):
+        if len(self.cubes) > 1:
+            # the cubes are summed up again, missing values stay groups of their own
+            self.cubes = [get_grouping_cube(concat_water_data(self.cubes).reset_index(drop=True),
+                                            self.params['valuename'],groupings=self.params['groupings'])]
+
+    def get_cube(self, valuename, incomegroups, filterzerocommitment, groupings):
+        """
+        @return: the merged cube as returned by waterData.get_grouping_cube
+        """
+        self.check(valuename=valuename,incomegroups=incomegroups,filterzerocommitment=filterzerocommitment,
+                   groupings=groupings)
+        self.merge()
+        return self.cubes[0]
+
+class BarchartAggregate(Aggregate):
+    """
+    collects the statistics of generate_barchart_for_incomegroup_distribution. sum and count are summed up per
+    batch, the values are kept in a ValueStore for the exact median.
+    """
+
+    def __init__(self, store, key, valuename='USD_Commitment_Defl', incomegroups=default_incomegroups,
+                 filterzerocommitment=True):
+        Aggregate.__init__(self,valuename=valuename,incomegroups=incomegroups,
+                           filterzerocommitment=filterzerocommitment)
+        self.store = store
+        self.key = key
+        self.sums = {}
+        self.counts = {}
+
+    def add(self, df):
+        valuename = self.params['valuename']
+        df = select_barchart_data(df,**self.params)
+        years = df['CommitmentDate'].dt.year.rename('CommitmentYear')
+        for ((year, incomegroup), values) in df.groupby([years,'IncomegroupName'],observed=True)[valuename]:
+            group = (year, incomegroup)
+            self.sums[group] = self.sums.get(group,0.0) + values.sum()
+            self.counts[group] = self.counts.get(group,0) + values.count()
+            self.store.add(self.key + group,values.dropna().to_numpy())
+
+    def get_statistics(self, valuename, incomegroups, filterzerocommitment):
+        """
+        @return: the same as waterData.get_incomegroup_statistics for the collected rows
+        """
+        self.check(valuename=valuename,incomegroups=incomegroups,filterzerocommitment=filterzerocommitment)
+        groups = sorted(self.sums)
+        statistics = pd.DataFrame({'sum': [self.sums[i] for i in groups],
+                                   'mean': [self.sums[i] / self.counts[i] if self.counts[i] > 0 else np.nan
+                                            for i in groups],
+                                   'median': [np.median(self.store.get_values(self.key + i))
+                                              if self.counts[i] > 0 else np.nan for i in groups],
+                                   'count': np.array([self.counts[i] for i in groups],dtype=np.int64)},
+                                  index=pd.MultiIndex.from_tuples(groups,names=['CommitmentYear','IncomegroupName']))
+        return statistics
+
+# the partial aggregates of the generate_*-functions
+generator_aggregates = {generate_histograms_about_projectsize: lambda store, key, valuename:
+                            HistogramAggregate(store,key,valuename=valuename),
+                        generate_barchart_for_incomegroup_distribution: lambda store, key, valuename:
+                            BarchartAggregate(store,key,valuename=valuename),
+                        generate_sunburst_for_grouping: lambda store, key, valuename:
+                            SunburstAggregate(valuename=valuename)}
+
+
+def get_batch_size(partition_filename, columns, memory_budget):
+    """
+    estimates how many rows of a partition can be read and enriched at once within the memory budget
+
+    @param partition_filename: the partition to read
+    @param columns: the features to read
+    @param memory_budget: how many bytes a batch may use
+
+    @return: the number of rows
+    """
+    probe = next(pq.ParquetFile(partition_filename).iter_batches(batch_size=batch_probe_rows,columns=columns),None)
+    if probe is None or probe.num_rows == 0:
+        return batch_probe_rows
+    rowsize = probe.to_pandas().memory_usage(deep=True).sum() / probe.num_rows
+    return max(batch_probe_rows,int(memory_budget / (rowsize * batch_memory_factor)))
+
+def iter_enriched_batches(setname="sane", datadir="data/", datasets=datasets, cachedir="data/cache",
+                          features=default_features, series=default_series, memory_budget=1024*1024*1024,
+                          workers=1, backend=None):
+    """
+    reads the partitions batch by batch and merges the worldbank series into every batch. the batches are the
+    same as the rows of waterData.build_enriched_data, numbered across all batches.
+
+    @param memory_budget: how many bytes a batch may use while it is enriched
+    @param the other parameters: see waterData.build_enriched_data
+
+    @return: a generator of DataFrames
+    """
+    wbdf = fetch_series(series=series,cachedir=cachedir,backend=backend)
+    codemapping = get_oecd_iso3_code_mapping(cachedir=cachedir,datadir=datadir,setname=setname,datasets=datasets)
+
+    partition_filenames = build_partitions(datasets[setname],datadir=datadir,cachedir=cachedir,workers=workers)
+    # like the concatenated partitions, only the features stored in at least one partition are part of the rows
+    stored = set([i for f in partition_filenames for i in pq.read_schema(f).names])
+    features = [i for i in features if i in stored]
+
+    start = 0
+    for partition_filename in partition_filenames:
+        stored = set(pq.read_schema(partition_filename).names)
+        columns = [i for i in features if i in stored] + ['__index_level_0__']
+        batch_size = get_batch_size(partition_filename,columns,memory_budget)
+
+        print("Reading Data from partition: %s (%d rows per batch)" %(partition_filename,batch_size))
+        for batch in pq.ParquetFile(partition_filename).iter_batches(batch_size=batch_size,columns=columns):
+            idf = extract_features(batch.to_pandas(),features=features)
+            # features missing in older zip-files are empty, like in the concatenated partitions
+            for i in features:
+                if i not in idf:
+                    idf[i] = np.nan
+            idf = idf[features].reset_index()
+
+            df = merge_wbseries_with_oecd_data(idf,wbdf,codemapping=codemapping,cachedir=cachedir)
+            df.index = pd.RangeIndex(start,start+len(df))
+            start += len(df)
+            yield df
+
+def run_pipeline_out_of_core(setname="sane", valuenames=default_valuenames, resultdir="results/", datadir="data/",
+                             cachedir="data/cache", windows=[(1980,datetime.now().year)], generators=None,
+                             renderer=inline_renderer, workers=1, force=False, microdataformats=['csv','json'],
+                             compression=None, backend=None, memory_budget=1024*1024*1024):
+    """
+    creates the same results as waterData.run_pipeline without loading the whole set. the partitions are read,
+    enriched and filtered batch by batch, the generate_*-functions get the merged partial aggregates of every
+    batch. besides a batch only the aggregates, the values for the exact medians and histograms (8 bytes per
+    selected row) and the rows of the microdata are kept. the values and the rows get a quarter of the budget
+    each, they are written to a temporary directory if they exceed it.
+
+    @param memory_budget: how many bytes may be used, a batch gets half of it
+    @param the other parameters: see waterData.run_pipeline
+    """
+    if generators is None:
+        generators = [generate_histograms_about_projectsize,
+                      generate_barchart_for_incomegroup_distribution,
+                      generate_sunburst_for_grouping]
+    unknown = [i.__name__ for i in generators if i not in generator_aggregates]
+    if len(unknown) > 0:
+        raise ValueError("no partial aggregates for: %s" %(", ".join(unknown)))
+
+    features = default_features + ["Recipientstat "+i for i in default_series]
+    with ValueStore(budget=memory_budget // 4) as store, FrameStore(budget=memory_budget // 4) as microdata:
+        aggregates = {}
+        for valuename in valuenames:
+            for name in default_focus_groups:
+                for window in windows:
+                    for generator in generators:
+                        key = (valuename, name, window, generator.__name__)
+                        aggregates[key] = generator_aggregates[generator](store,key,valuename)
+        for df in iter_enriched_batches(setname=setname,datadir=datadir,cachedir=cachedir,
+                                        memory_budget=memory_budget // 2,workers=workers,backend=backend):
+            for (name, params) in default_focus_groups.items():
+                fdf = df if params is None else filter_donor_sector_flow_recipient(df,filterzerocommitment=False,
+                                                                                   **params)
+                for window in windows:
+                    (wdf, targetdir) = select_commitment_years(fdf,startyear=window[0],stopyear=window[1])
+                    for valuename in valuenames:
+                        for generator in generators:
+                            aggregates[(valuename, name, window, generator.__name__)].add(wdf)
+
+            for valuename in valuenames:
+                for (recipientcodes, basefilename) in default_microdata_selections:
+                    rows = filter_donor_sector_flow_recipient(df,recipientcodes=recipientcodes,
+                                                              filterzerocommitment=True,valuename=valuename)
+                    microdata.add((valuename, basefilename),rows[[i for i in features if i in rows]])
+
+        for ((valuename, name, (startyear, stopyear), generatorname), aggregate) in aggregates.items():
+            generator = [i for i in generators if i.__name__ == generatorname][0]
+            generator(None,startyear=startyear,stopyear=stopyear,targetdir="%s%s/%s/" %(resultdir,valuename,name),
+                      valuename=valuename,renderer=renderer,force=force,aggregate=aggregate)
+
+        for valuename in valuenames:
+            for (recipientcodes, basefilename) in default_microdata_selections:
+                # the rows are written batch by batch as they were collected
+                save_micro_data(lambda: microdata.iter_frames((valuename, basefilename)),
+                                targetdir="%s%s/microdata/" %(resultdir,valuename),basefilename=basefilename,
+                                features=features,formats=microdataformats,compression=compression,force=force)
+
+        # the images are rendered before the values are removed
+        renderer.wait()
@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+
+import pandas as pd
+import os
+
+from tools import datasets, build_partitions, get_source_fingerprints, get_partition_filename, remove_stale_partitions
+from tools import get_set_filename
+
+# a project is identified by donor, agency and the projectnumber of the donor. rows without a projectnumber
+# are identified by their CrsID. missing keys are kept as missing, rows without any of them form one project
+# per donor and agency, so the projects sum up to the rows
+project_key_features = ['DonorCode','AgencyCode','ProjectId']
+
+project_amount_features = ['USD_Commitment_Defl','USD_Disbursement_Defl','USD_Received_Defl','USD_GrantEquiv']
+
+# taken from the latest row of a project
+project_name_features = ['ProjectTitle','DonorName','AgencyName','RecipientCode','RecipientName','SectorName','PurposeName']
+
+# increase whenever the aggregation changes, older project tables are rebuilt
+project_table_version = 2
+
+
+def get_project_key(values):
+    """
+    @param values: a Series with the values of a key feature
+    @return: the values as strings (object), missing values stay missing
+    """
+    values = values.astype(object)
+    return values.where(values.isnull(),values.astype(str)).where(values.notnull(),None)
+
+def aggregate_projects(df):
+    """
+    aggregates rows of the crs to one row per project. the result can be aggregated again with
+    merge_project_aggregates, so partial tables of different zip-files are combined without the rows.
+
+    @param df: a DataFrame with the rows of the crs
+    @return: a DataFrame with the project_key_features as columns and the aggregates
+    """
+    projectids = df['ProjectNumber'].astype(object)
+    df = df.copy(deep=False)
+    df['ProjectId'] = projectids.where(projectids.notnull(),"CrsID:" + df['CrsID'].astype(object))
+    for i in project_key_features:
+        df[i] = get_project_key(df[i])
+    df['ReportYear'] = df['Year'].dt.year
+
+    # the names of the latest row are kept, sorting first allows to use 'last'
+    df = df.sort_values('ReportYear',kind='mergesort')
+    groups = df.groupby(project_key_features,sort=False,dropna=False)
+
+    aggregations = dict([(i, (i,'sum')) for i in project_amount_features if i in df] +
+                        [(i, (i,'last')) for i in project_name_features if i in df] +
+                        [('Rows', ('ReportYear','size')),
+                         ('FirstYear', ('ReportYear','min')),
+                         ('LastYear', ('ReportYear','max')),
+                         ('FirstCommitmentDate', ('CommitmentDate','min')),
+                         ('LastCommitmentDate', ('CommitmentDate','max')),
+                         ('ExpectedStartDate', ('ExpectedStartDate','min')),
+                         ('CompletionDate', ('CompletionDate','max'))])
+    return groups.agg(**aggregations).reset_index()
+
+def merge_project_aggregates(tables):
+    """
+    combines the results of aggregate_projects (ex. of several zip-files) to one row per project
+
+    @param tables: an array of DataFrames as returned by aggregate_projects
+    @return: a DataFrame like aggregate_projects, sorted by project_key_features
+    """
+    df = pd.concat(tables,ignore_index=True)
+    df = df.sort_values('LastYear',kind='mergesort')
+    for i in project_key_features:
+        df[i] = get_project_key(df[i])
+    groups = df.groupby(project_key_features,sort=True,dropna=False)
+
+    aggregations = dict([(i, (i,'sum')) for i in project_amount_features if i in df] +
+                        [(i, (i,'last')) for i in project_name_features if i in df] +
+                        [('Rows', ('Rows','sum')),
+                         ('FirstYear', ('FirstYear','min')),
+                         ('LastYear', ('LastYear','max')),
+                         ('FirstCommitmentDate', ('FirstCommitmentDate','min')),
+                         ('LastCommitmentDate', ('LastCommitmentDate','max')),
+                         ('ExpectedStartDate', ('ExpectedStartDate','min')),
+                         ('CompletionDate', ('CompletionDate','max'))])
+    result = groups.agg(**aggregations).reset_index()
+    result['Years'] = result['LastYear'] - result['FirstYear'] + 1
+    return result
+
+def get_project_partition(zipname, fingerprint, partition_filename, cachedir="data/cache"):
+    """
+    returns the projects of a single zip-file, they are aggregated once and stored next to the partition
+
+    @return: a DataFrame as returned by aggregate_projects
+    """
+    projects_filename = get_partition_filename(zipname,fingerprint,cachedir=cachedir,
+                                               kind="projects-v%d" %(project_table_version))
+    if os.path.exists(projects_filename):
+        return pd.read_parquet(projects_filename,engine="pyarrow")
+
+    print("Aggregating projects: %s" %(partition_filename))
+    df = pd.read_parquet(partition_filename,engine="pyarrow",
+                         columns=['DonorCode','AgencyCode','ProjectNumber','CrsID','Year','CommitmentDate',
+                                  'ExpectedStartDate','CompletionDate'] +
+                                 project_amount_features + project_name_features)
+    projects = aggregate_projects(df)
+
+    print("Writing projects: %s" %(projects_filename))
+    os.makedirs(os.path.dirname(projects_filename),exist_ok=True)
+    projects.to_parquet(projects_filename,engine="pyarrow",index=False)
+    remove_stale_partitions(projects_filename)
+    return projects
+
+def build_project_table(setname="playset", datadir='data/', datasets=datasets, cachedir="data/cache", workers=1):
+    """
+    builds the project table of a set. every zip-file is aggregated only once, the table of the set is combined
+    from these partial tables and stored as 'cachedir/projects/<setname>-<hash>.parquet'. the hash depends on
+    the zip-files, so adding or changing a zip-file only aggregates this file again.
+
+    @return: the filename of the project table
+    """
+    zipnames = datasets[setname]
+    fingerprints = get_source_fingerprints(zipnames,datadir=datadir,cachedir=cachedir)
+    table_filename = get_set_filename(setname,fingerprints,"projects",project_table_version,cachedir=cachedir)
+    if os.path.exists(table_filename):
+        return table_filename
+
+    partition_filenames = build_partitions(zipnames,datadir=datadir,cachedir=cachedir,workers=workers)
+    table = merge_project_aggregates([get_project_partition(i,fingerprints[i],f,cachedir=cachedir)
+                                      for (i, f) in zip(zipnames,partition_filenames)])
+
+    print("Writing project table: %s" %(table_filename))
+    os.makedirs(os.path.dirname(table_filename),exist_ok=True)
+    table.to_parquet(table_filename,engine="pyarrow",index=False,row_group_size=100000)
+    remove_stale_partitions(table_filename)
+    return table_filename
+
+def read_project_table(setname="playset", datadir='data/', datasets=datasets, cachedir="data/cache",
+                       columns=None, donorcodes=None, recipientcodes=None, years=None,
+                       mincommitment=None, filters=None):
+    """
+    reads the project table of a set, it is built if needed. one row per project (DonorCode, AgencyCode, ProjectId)
+    with the sums of the amounts, the number of rows, the first and last year of reporting and the dates.
+
+    @param setname: one of 'fullset', 'sane commitment', 'sane disbursement','sane','playset'
+    @param columns: an array of features to load. None loads every feature
+    @param donorcodes: only projects of the listed donor country codes
+    @param recipientcodes: only projects of the listed recipient codes (of the latest row)
+    @param years: a tupel (startyear, stopyear), only projects reported within these years. one of them may be None
+    @param mincommitment: only projects with at least this sum of USD_Commitment_Defl
+    @param filters: additional filters as list of tupels (column, operator, value) as used by pyarrow
+
+    @return: a DataFrame with one row per project
+    """
+    result = list(filters) if filters else []
+    if type(donorcodes) == type([]) and len(donorcodes) > 0:
+        result.append(('DonorCode','in',donorcodes))
+    if type(recipientcodes) == type([]) and len(recipientcodes) > 0:
+        result.append(('RecipientCode','in',recipientcodes))
+    if years:
+        (startyear, stopyear) = years
+        if startyear:
+            result.append(('LastYear','>=',startyear))
+        if stopyear:
+            result.append(('FirstYear','<=',stopyear))
+    if mincommitment is not None:
+        result.append(('USD_Commitment_Defl','>=',mincommitment))
+
+    table_filename = build_project_table(setname,datadir=datadir,datasets=datasets,cachedir=cachedir)
+    print("Reading project table: %s" %(table_filename))
+    return pd.read_parquet(table_filename,engine="pyarrow",columns=columns,
+                           filters=result if len(result) > 0 else None)
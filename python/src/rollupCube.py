@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+
+import pandas as pd
+import numpy as np
+import pyarrow.parquet as pq
+import os
+
+from tools import datasets, build_partitions, get_source_fingerprints, get_partition_filename, remove_stale_partitions
+from tools import get_set_filename, concat_water_data, read_water_data
+
+# the finest grain of the cube, every rollup is a grouping of some of these features. 'Year' is the year of the report
+cube_dimensions = ['Year','DonorCode','RecipientCode','SectorCode','PurposeCode','FlowCode','IncomegroupName']
+
+cube_valuenames = ['USD_Commitment_Defl','USD_Disbursement_Defl','USD_GrantEquiv']
+
+# the filters of query and read_rows, as parameter and feature
+cube_filters = [('donorcodes','DonorCode'),('recipientcodes','RecipientCode'),('sectorcodes','SectorCode'),
+                ('purposecodes','PurposeCode'),('flowcodes','FlowCode'),('incomegroups','IncomegroupName')]
+
+# increase whenever the aggregation changes, older cubes are rebuilt
+cube_version = 1
+
+
+def get_count_name(valuename):
+    """
+    @return: the name of the column with the number of rows with a value other than NaN or 0.0 for valuename
+    """
+    return valuename + "_count"
+
+def get_cube_measures(valuenames=cube_valuenames):
+    return valuenames + [get_count_name(i) for i in valuenames] + ['Rows']
+
+def sum_by(df, by, columns):
+    """
+    sums up columns grouped by the features in by. rows with missing values in some of the features are kept
+    as their own group (like get_grouping_cube in waterData)
+
+    @param df: the DataFrame to aggregate
+    @param by: an array of featurenames, an empty array sums up everything
+    @param columns: the features to sum up
+
+    @return: a DataFrame with the features of by and the columns, sorted by the features of by
+    """
+    if len(by) == 0:
+        return pd.DataFrame(dict([(i, [df[i].sum()]) for i in columns]))
+
+    # group on the integer codes of the features, missing values are coded as -1
+    codes = pd.DataFrame(dict([(i, df[i]) for i in columns]),copy=False)
+    uniques = {}
+    for i in by:
+        (codes["__" + i], uniques[i]) = pd.factorize(df[i],sort=True)
+
+    result = codes.groupby(["__" + i for i in by],sort=True)[columns].sum().reset_index()
+    for i in by:
+        # reindex turns the missing values (-1) into NaN, categoricals stay categoricals
+        values = pd.Series(uniques[i]).reindex(result["__" + i].to_numpy())
+        result[i] = pd.Series(values.array,index=result.index)
+    return result[by + columns]
+
+def aggregate_cube(df, valuenames=cube_valuenames):
+    """
+    aggregates rows of the crs to the grain of the cube. the result can be aggregated again, so the cubes
+    of different zip-files are combined without the rows.
+
+    @param df: a DataFrame with the rows of the crs
+    @param valuenames: the features to sum up
+
+    @return: a DataFrame with the cube_dimensions, the sums and counts of the valuenames and the number of rows
+    """
+    values = pd.DataFrame(dict([(i, df[i] if i in df else np.nan) for i in cube_dimensions if i != 'Year']),
+                          index=df.index)
+    values['Year'] = df['Year'].dt.year
+    for i in valuenames:
+        values[i] = df[i]
+        values[get_count_name(i)] = (df[i].notnull() & (df[i] != 0.0)).astype(np.int64)
+    values['Rows'] = np.int64(1)
+
+    return sum_by(values,cube_dimensions,get_cube_measures(valuenames))
+
+def get_cube_partition(zipname, fingerprint, partition_filename, cachedir="data/cache"):
+    """
+    returns the cube of a single zip-file, it is aggregated once and stored next to the partition
+
+    @return: a DataFrame as returned by aggregate_cube
+    """
+    cube_filename = get_partition_filename(zipname,fingerprint,cachedir=cachedir,kind="cube-v%d" %(cube_version))
+    if os.path.exists(cube_filename):
+        return pd.read_parquet(cube_filename,engine="pyarrow")
+
+    print("Aggregating cube: %s" %(partition_filename))
+    stored = set(pq.read_schema(partition_filename).names)
+    df = pd.read_parquet(partition_filename,engine="pyarrow",
+                         columns=[i for i in cube_dimensions + cube_valuenames if i in stored])
+    cube = aggregate_cube(df)
+
+    print("Writing cube: %s" %(cube_filename))
+    os.makedirs(os.path.dirname(cube_filename),exist_ok=True)
+    cube.to_parquet(cube_filename,engine="pyarrow",index=False)
+    remove_stale_partitions(cube_filename)
+    return cube
+
+def build_rollup_cube(setname="playset", datadir='data/', datasets=datasets, cachedir="data/cache", workers=1):
+    """
+    builds the cube of a set. every zip-file is aggregated only once, the cube of the set is combined from
+    these partial cubes and stored as 'cachedir/cube/<setname>-<hash>.parquet'.
+
+    @return: the filename of the cube
+    """
+    zipnames = datasets[setname]
+    fingerprints = get_source_fingerprints(zipnames,datadir=datadir,cachedir=cachedir)
+    cube_filename = get_set_filename(setname,fingerprints,"cube",cube_version,cachedir=cachedir)
+    if os.path.exists(cube_filename):
+        return cube_filename
+
+    partition_filenames = build_partitions(zipnames,datadir=datadir,cachedir=cachedir,workers=workers)
+    cube = concat_water_data([get_cube_partition(i,fingerprints[i],f,cachedir=cachedir)
+                              for (i, f) in zip(zipnames,partition_filenames)])
+    cube = sum_by(cube,cube_dimensions,get_cube_measures())
+    for i in cube_dimensions[1:]:
+        cube[i] = cube[i].astype('category')
+
+    print("Writing cube: %s" %(cube_filename))
+    os.makedirs(os.path.dirname(cube_filename),exist_ok=True)
+    cube.to_parquet(cube_filename,engine="pyarrow",index=False,row_group_size=100000)
+    remove_stale_partitions(cube_filename)
+    return cube_filename
+
+class RollupCube:
+    """
+    the sums and counts of the cube_valuenames for every combination of the cube_dimensions. rollups over
+    any of the dimensions are answered from the cube, only requests for the rows themselves read the partitions.
+
+    usage:
+        cube = RollupCube.load(setname='sane')
+        cube.query(by=['Year','IncomegroupName'],donorcodes=['5'],sectorcodes=['140'],years=(2010,None))
+        df = cube.read_rows(donorcodes=['5'],sectorcodes=['140'],years=(2010,None))
+    """
+
+    def __init__(self, cube, setname="playset", datadir='data/', datasets=datasets, cachedir="data/cache"):
+        """
+        @param cube: a DataFrame as stored by build_rollup_cube
+        @param setname, datadir, datasets, cachedir: where to find the rows for read_rows
+        """
+        self.cube = cube
+        self.setname = setname
+        self.datadir = datadir
+        self.datasets = datasets
+        self.cachedir = cachedir
+
+    @classmethod
+    def load(cls, setname="playset", datadir='data/', datasets=datasets, cachedir="data/cache", workers=1):
+        """
+        reads the cube of a set, it is built if needed
+
+        @param setname: one of 'fullset', 'sane commitment', 'sane disbursement','sane','playset'
+        @param workers: how many missing partitions are built in parallel
+        """
+        cube_filename = build_rollup_cube(setname,datadir=datadir,datasets=datasets,cachedir=cachedir,workers=workers)
+        print("Reading cube: %s" %(cube_filename))
+        return cls(pd.read_parquet(cube_filename,engine="pyarrow"),setname=setname,datadir=datadir,
+                   datasets=datasets,cachedir=cachedir)
+
+    def get_mask(self, years=None, **codes):
+        mask = np.ones(len(self.cube),dtype=bool)
+        if years:
+            (startyear, stopyear) = years
+            if startyear:
+                mask &= (self.cube['Year'] >= startyear).to_numpy()
+            if stopyear:
+                mask &= (self.cube['Year'] <= stopyear).to_numpy()
+
+        for (parameter, feature) in cube_filters:
+            values = codes.get(parameter)
+            if type(values) == type([]) and len(values) > 0:
+                mask &= self.cube[feature].isin(values).to_numpy()
+        return mask
+
+    def query(self, by=[], valuenames=cube_valuenames, counts=True, years=None, donorcodes=None,
+              recipientcodes=None, sectorcodes=None, purposecodes=None, flowcodes=None, incomegroups=None):
+        """
+        sums up the valuenames for the groups of by. the results are the same as grouping the rows of
+        read_water_data, rows with missing values in the features of by are kept as their own group.
+
+        @param by: an array of cube_dimensions to group by, an empty array sums up every selected row
+        @param valuenames: the sums to return, see cube_valuenames
+        @param counts: also return the number of rows with a value other than NaN or 0.0 ('<valuename>_count')
+                       and the number of rows ('Rows')
+        @param years: a tupel (startyear, stopyear) including both years, one of them may be None
+        @param donorcodes: an array of donor country codes. Use None or array of size 0 to skip this filter
+        @param recipientcodes: an array of recipient codes. Use None or array of size 0 to skip this filter
+        @param sectorcodes: an array of sector codes. Use None or array of size 0 to skip this filter
+        @param purposecodes: an array of purpose codes. Use None or array of size 0 to skip this filter
+        @param flowcodes: an array of flow codes. Use None or array of size 0 to skip this filter
+        @param incomegroups: an array of incomegroup names. Use None or array of size 0 to skip this filter
+
+        @return: a DataFrame with the features of by and the aggregates as columns
+        """
+        unknown = [i for i in by if i not in cube_dimensions] + [i for i in valuenames if i not in cube_valuenames]
+        if len(unknown) > 0:
+            raise ValueError("not part of the cube, use read_rows instead: %s" %(", ".join(unknown)))
+
+        mask = self.get_mask(years=years,donorcodes=donorcodes,recipientcodes=recipientcodes,
+                             sectorcodes=sectorcodes,purposecodes=purposecodes,flowcodes=flowcodes,
+                             incomegroups=incomegroups)
+        columns = valuenames + ([get_count_name(i) for i in valuenames] + ['Rows'] if counts else [])
+        return sum_by(self.cube[mask],by,columns)
+
+    def read_rows(self, columns=None, years=None, donorcodes=None, recipientcodes=None, sectorcodes=None,
+                  purposecodes=None, flowcodes=None, incomegroups=None):
+        """
+        reads the rows selected by the same filters as query from the partitions, for requests the cube
+        can not answer
+
+        @param columns: an array of features to load. None loads every feature
+
+        @return: a DataFrame as returned by read_water_data
+        """
+        filters = [(f, 'in', c) for (f, c) in [('RecipientCode',recipientcodes),('PurposeCode',purposecodes),
+                                               ('FlowCode',flowcodes),('IncomegroupName',incomegroups)]
+                   if type(c) == type([]) and len(c) > 0]
+        return read_water_data(self.setname,datadir=self.datadir,datasets=self.datasets,cachedir=self.cachedir,
+                               columns=columns,years=years,donorcodes=donorcodes,sectorcodes=sectorcodes,
+                               filters=filters)
@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+
+import pandas as pd
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pyarrow.compute as pc
+import os
+import re
+
+from tools import datasets, build_partitions, get_source_fingerprints, get_partition_filename, remove_stale_partitions
+from tools import concat_water_data
+
+text_features = ['ProjectTitle','ShortDescription','LongDescription']
+
+# increase whenever the tokenization or the layout of the index changes, older indexes are rebuilt
+textindex_version = 1
+
+# every row of the index-file holds the positions of the rows containing a token. the index-file is sorted
+# by token, so small rowgroups allow pyarrow to skip everything but the requested tokens
+textindex_row_group_size = 5000
+
+# [prefix*] "a phrase" or word
+query_pattern = re.compile(r'"([^"]*)"|(\S+)')
+
+
+def normalize_text(texts):
+    """
+    normalizes texts for the index: accents are removed (é -> e) and the case is folded with casefold,
+    which also expands ß to ss (Straße -> strasse). queries are normalized the same way
+
+    @param texts: a pandas Series of texts, missing texts are treated as empty
+    """
+    texts = texts.astype(object).fillna("").astype(str).str.normalize('NFKD')
+    return texts.str.replace('[\u0300-\u036f]','',regex=True).str.casefold()
+
+def tokenize(text):
+    """
+    splits a text into the tokens used by the index
+
+    @param text: a string
+    @return: an array of tokens
+    """
+    return re.findall(r'\w+',normalize_text(pd.Series([text]))[0])
+
+def get_textindex_filename(zipname, fingerprint, cachedir="data/cache"):
+    return get_partition_filename(zipname,fingerprint,cachedir=cachedir,kind="textindex-v%d" %(textindex_version))
+
+def build_text_index(partition_filename, textindex_filename, features=text_features):
+    """
+    creates the inverted index of the text-features of a partition. for every (token, feature) the sorted
+    positions of the rows containing the token are stored.
+
+    @param partition_filename: the partition as returned by tools.build_partitions
+    @param textindex_filename: the filename of the index as returned by get_textindex_filename
+    @param features: the text-features to index
+    """
+    print("Building text index: %s" %(textindex_filename))
+    stored = set(pq.read_schema(partition_filename).names)
+    df = pd.read_parquet(partition_filename,engine="pyarrow",columns=[i for i in features if i in stored])
+
+    tables = []
+    for i in df.columns:
+        tokens = normalize_text(df[i]).str.findall(r'\w+')
+        tokens.index = np.arange(len(tokens),dtype=np.int32)
+        tokens = tokens.explode().dropna()
+
+        # sorted tokens and rows, every (token,row) only once
+        (codes, uniques) = pd.factorize(tokens.to_numpy(),sort=True)
+        rows = tokens.index.to_numpy(dtype=np.int32)
+        order = np.lexsort((rows,codes))
+        (codes, rows) = (codes[order], rows[order])
+        keep = np.ones(len(codes),dtype=bool)
+        keep[1:] = (codes[1:] != codes[:-1]) | (rows[1:] != rows[:-1])
+        (codes, rows) = (codes[keep], rows[keep])
+
+        offsets = np.zeros(len(uniques) + 1,dtype=np.int32)
+        offsets[1:] = np.cumsum(np.bincount(codes,minlength=len(uniques)))
+        tables.append(pa.table({'token': pa.array(uniques.astype(str),type=pa.string()),
+                                'feature': pa.array([i]*len(uniques),type=pa.string()),
+                                'rows': pa.ListArray.from_arrays(pa.array(offsets),pa.array(rows))}))
+
+    table = pa.concat_tables(tables).sort_by([('token','ascending'),('feature','ascending')])
+    os.makedirs(os.path.dirname(textindex_filename),exist_ok=True)
+    pq.write_table(table,textindex_filename,row_group_size=textindex_row_group_size)
+    remove_stale_partitions(textindex_filename)
+
+def build_text_indexes(setname="playset", datadir='data/', datasets=datasets, cachedir="data/cache", workers=1):
+    """
+    builds the missing partitions and text indexes of a set
+
+    @return: an array of tupels (zipname, partition filename, index filename)
+    """
+    zipnames = datasets[setname]
+    partition_filenames = build_partitions(zipnames,datadir=datadir,cachedir=cachedir,workers=workers)
+    fingerprints = get_source_fingerprints(zipnames,datadir=datadir,cachedir=cachedir)
+
+    result = []
+    for (i, partition_filename) in zip(zipnames,partition_filenames):
+        textindex_filename = get_textindex_filename(i,fingerprints[i],cachedir=cachedir)
+        if not os.path.exists(textindex_filename):
+            build_text_index(partition_filename,textindex_filename)
+        result.append((i,partition_filename,textindex_filename))
+    return result
+
+def parse_query(query):
+    """
+    splits a query into terms, all terms have to match:
+      water          - the token 'water'
+      wat*           - any token starting with 'wat'
+      "water supply" - the tokens 'water' and 'supply' next to each other
+
+    @return: an array of tupels (kind, tokens) with kind 'token', 'prefix' or 'phrase'
+    """
+    terms = []
+    for (phrase, word) in query_pattern.findall(query):
+        if phrase:
+            tokens = tokenize(phrase)
+            if len(tokens) == 1:
+                terms.append(('token',tokens))
+            elif len(tokens) > 1:
+                terms.append(('phrase',tokens))
+        elif word.endswith("*") and len(tokenize(word)) == 1:
+            terms.append(('prefix',tokenize(word)))
+        else:
+            terms += [('token',[i]) for i in tokenize(word)]
+    return terms
+
+def lookup_terms(textindex_filename, terms, features):
+    """
+    reads the positions of the rows matching every term (ignoring the order of the tokens of a phrase)
+
+    @return: a sorted numpy array of row positions
+    """
+    exact = sorted(set(sum([tokens for (kind, tokens) in terms if kind != 'prefix'],[])))
+    prefixes = sorted(set([tokens[0] for (kind, tokens) in terms if kind == 'prefix']))
+
+    # one read for all terms, only the rowgroups with the tokens are read
+    filters = [[('token','>=',i),('token','<',i + '\U0010ffff')] for i in prefixes]
+    if len(exact) > 0:
+        filters.append([('token','in',exact)])
+    table = pq.read_table(textindex_filename,filters=filters)
+    table = table.filter(pc.is_in(table['feature'],value_set=pa.array(features)))
+
+    tokens = table['token'].to_numpy(zero_copy_only=False)
+    rowlists = table['rows'].to_numpy(zero_copy_only=False)
+
+    rows = None
+    for (kind, termtokens) in terms:
+        for i in termtokens:
+            if kind == 'prefix':
+                matches = [r for (t, r) in zip(tokens,rowlists) if t.startswith(i)]
+            else:
+                matches = [r for (t, r) in zip(tokens,rowlists) if t == i]
+            matching = np.unique(np.concatenate(matches)) if len(matches) > 0 else np.empty(0,dtype=np.int32)
+            rows = matching if rows is None else rows[np.isin(rows,matching,assume_unique=True)]
+    return rows if rows is not None else np.empty(0,dtype=np.int32)
+
+def match_phrases(table, terms, features):
+    """
+    @param table: a pyarrow table with the text-features of the candidate rows
+    @return: a boolean numpy array, True for the rows containing every phrase of the terms
+    """
+    mask = np.ones(table.num_rows,dtype=bool)
+    for (kind, tokens) in terms:
+        if kind != 'phrase':
+            continue
+        phrase = " " + " ".join(tokens) + " "
+        found = np.zeros(table.num_rows,dtype=bool)
+        for i in features:
+            texts = normalize_text(table[i].to_pandas()).str.findall(r'\w+').str.join(" ")
+            found |= (" " + texts + " ").str.contains(phrase,regex=False).to_numpy()
+        mask &= found
+    return mask
+
+def search(query, setname="playset", datadir='data/', datasets=datasets, cachedir="data/cache",
+           features=text_features, donorcodes=None, sectorcodes=None, recipientcodes=None, flowcodes=None,
+           years=None):
+    """
+    searches the text-features of a set with the inverted index. the indexes are stored next to the
+    partitions and built if they are missing. ex.: search('"water supply" ocp brunn*',donorcodes=['5'])
+
+    @param query: the terms to search, see parse_query
+    @param setname: one of 'fullset', 'sane commitment', 'sane disbursement','sane','playset'
+    @param datadir: the basedir where the zip-files can be found
+    @param datasets: a dict with datasets containing lists of zip-filenames
+    @param cachedir: where to store/find the partitions and indexes
+    @param features: the text-features to search in
+    @param donorcodes: an array of donor country codes. Use None or array of size 0 to skip this filter
+    @param sectorcodes: an array of sector codes. Use None or array of size 0 to skip this filter
+    @param recipientcodes: an array of recipient codes. Use None or array of size 0 to skip this filter
+    @param flowcodes: an array of flow codes. Use None or array of size 0 to skip this filter
+    @param years: a tupel (startyear, stopyear) including both years, one of them may be None
+
+    @return: a DataFrame with the columns 'Source' (zip-filename) and 'Row' (the row within the zip-file,
+             which is the index of the data returned by read_water_data)
+    """
+    terms = parse_query(query)
+    result = []
+    for (zipname, partition_filename, textindex_filename) in build_text_indexes(setname,datadir=datadir,
+                                                                                datasets=datasets,
+                                                                                cachedir=cachedir):
+        rows = lookup_terms(textindex_filename,terms,features) if len(terms) > 0 else None
+        if rows is not None and len(rows) == 0:
+            continue
+
+        # the other filters and phrases are checked for the candidates only
+        stored = set(pq.read_schema(partition_filename).names)
+        phrasefeatures = [i for i in features if i in stored and any(kind == 'phrase' for (kind, t) in terms)]
+        columns = list(phrasefeatures)
+        codefilters = [(f, c) for (f, c) in [('DonorCode',donorcodes),('SectorCode',sectorcodes),
+                                              ('RecipientCode',recipientcodes),('FlowCode',flowcodes)]
+                       if type(c) == type([]) and len(c) > 0]
+        columns += [f for (f, c) in codefilters] + (['Year'] if years else [])
+        if len(columns) > 0:
+            table = pq.read_table(partition_filename,columns=columns)
+            if rows is None:
+                rows = np.arange(table.num_rows,dtype=np.int32)
+            table = table.take(pa.array(rows))
+
+            mask = match_phrases(table,terms,phrasefeatures)
+            for (feature, codes) in codefilters:
+                mask &= pc.is_in(table[feature].cast(pa.string()),
+                                         value_set=pa.array(codes,type=pa.string())).to_numpy(zero_copy_only=False)
+            if years:
+                commitmentyears = pc.year(table['Year']).to_numpy(zero_copy_only=False)
+                (startyear, stopyear) = years
+                if startyear:
+                    mask &= commitmentyears >= startyear
+                if stopyear:
+                    mask &= commitmentyears <= stopyear
+            rows = rows[mask]
+        elif rows is None:
+            rows = np.arange(pq.read_metadata(partition_filename).num_rows,dtype=np.int32)
+
+        result.append(pd.DataFrame({'Source': zipname, 'Row': rows}))
+
+    if len(result) == 0:
+        return pd.DataFrame({'Source': pd.Series([],dtype=object), 'Row': pd.Series([],dtype=np.int32)})
+    return pd.concat(result,ignore_index=True)
+
+def read_search_results(results, setname="playset", datadir='data/', datasets=datasets, cachedir="data/cache",
+                        columns=None):
+    """
+    reads the rows found by search
+
+    @param results: the result of search
+    @param columns: an array of features to load. None loads every feature
+
+    @return: a DataFrame like read_water_data, indexed by the row within the zip-file
+    """
+    dfs = []
+    zipnames = datasets[setname]
+    for (zipname, partition_filename) in zip(zipnames,build_partitions(zipnames,datadir=datadir,cachedir=cachedir)):
+        rows = results.loc[results['Source'] == zipname,'Row'].to_numpy()
+        if len(rows) == 0:
+            continue
+        stored = pq.read_schema(partition_filename).names
+        partitioncolumns = None if columns is None else [i for i in columns if i in stored] + ['__index_level_0__']
+        table = pq.read_table(partition_filename,columns=partitioncolumns)
+        dfs.append(table.take(pa.array(rows)).to_pandas())
+
+    return concat_water_data(dfs)
@@ -5,6 +5,12 @@ import numpy as np
 from worldbankApi import get_regionnames
 import pickle
 import os
+import json
+import glob
+import re
+import hashlib
+import pyarrow.parquet as pq
+from concurrent.futures import ProcessPoolExecutor
 
 
 # worldbank and creditor reporting system use different names for the countries
@@ -59,209 +65,805 @@ datasets = {
     #"playset": ['crs2019.zip']
 }
 
-def read_water_data(setname = "playset", datadir='data/', datasets=datasets,cachedir="data/cache"):
+# the schema used to parse the raw csv-files of the crs. codes and names are repeated across millions
+# of rows and are loaded as categoricals, identifiers of single projects are kept as text
+crs_code_features = ['DonorCode','InitialReport','AgencyCode','RecipientCode','RegionCode','IncomegroupCode',
+                     'FlowCode','Bi_Multi','Category','Finance_t','Aid_t','CurrencyCode','PurposeCode',
+                     'SDGfocus','SectorCode','ChannelCode','ParentChannelCode','BudgetIdent','Gender',
+                     'Environment','PDGG','Trade','RMNCH']
+
+crs_name_features = ['DonorName','AgencyName','RecipientName','RegionName','IncomegroupName','FlowName',
+                     'PurposeName','SectorName','ChannelName']
+
+crs_id_features = ['CrsID','ProjectNumber']
+
+# amounts in million USD - float32 keeps about 7 significant digits, this is only safe for a
+# reduced memory footprint, not for summing up millions of rows
+crs_amount_features = ['USD_Commitment','USD_Disbursement','USD_Received','USD_Commitment_Defl',
+                       'USD_Disbursement_Defl','USD_Received_Defl','USD_Adjustment','USD_Adjustment_Defl',
+                       'USD_AmountUntied','USD_AmountPartialTied','USD_AmountTied','USD_AmountUntied_Defl',
+                       'USD_AmountPartialTied_Defl','USD_Amounttied_Defl','USD_IRTC','USD_Expert_Commitment',
+                       'USD_Expert_Extended','USD_Export_Credit','USD_GrantEquiv','USD_Interest',
+                       'USD_Outstanding','USD_Arrears_Principal','USD_Arrears_Interest']
+
+crs_dtypes = dict([(i,'category') for i in crs_code_features + crs_name_features] +
+                  [(i,np.unicode_) for i in crs_id_features])
+
+# increase whenever the parsing of the zip-files changes, cached partitions of older versions are rebuilt
+crs_schema_version = 2
+
+crs_date_features = ["CommitmentDate",'ExpectedStartDate','Year','CompletionDate','Repaydate1','Repaydate2']
+
+
+def read_crs_zip(filename):
+    """
+    parses a single zip-file of the crs (iso8859_15 encoded, seperated by '|' and quoted by '"')
+
+    @param filename: path of the zip-file
+
+    @return: a pandas DataFrame with the content of the file
+    """
+    return pd.read_csv(filename,sep="|",
+                       header=0,quotechar='"',
+                       encoding="iso8859_15",
+                       compression="zip",low_memory=False,
+                       dtype=crs_dtypes,
+                       parse_dates=crs_date_features)
+
+def get_source_fingerprints(zipnames, datadir='data/', cachedir="data/cache"):
+    """
+    returns a fingerprint for each zip-file based on its content and the version of the schema. the
+    hashes are kept in 'cachedir/crs/fingerprints.json' and only recalculated if size or mtime of a
+    file changed. if a zip-file is missing the last known fingerprint is used.
+
+    @param zipnames: an array of zip-filenames as listed in datasets
+    @param datadir: the basedir where the zip-files can be found
+    @param cachedir: the basedir of the cache
+
+    @return: a dict with the zip-filenames as keys and the fingerprints as values
+    """
+    fingerprints_filename = "%s/crs/fingerprints.json" %(cachedir)
+    known = {}
+    if os.path.exists(fingerprints_filename):
+        with open(fingerprints_filename) as fd:
+            known = json.load(fd)
+
+    result = {}
+    for i in zipnames:
+        entry = known.get(i)
+        if not os.path.exists(datadir+i):
+            if entry is None:
+                raise FileNotFoundError("%s%s is missing and was never cached" %(datadir,i))
+            print("Warning: %s%s is missing, using the cached partition" %(datadir,i))
+        else:
+            stat = os.stat(datadir+i)
+            if entry is None or entry['size'] != stat.st_size or entry['mtime'] != stat.st_mtime:
+                print("hashing: %s%s" %(datadir,i))
+                sha1 = hashlib.sha1()
+                with open(datadir+i,'rb') as fd:
+                    for block in iter(lambda: fd.read(1 << 20), b''):
+                        sha1.update(block)
+                entry = {'size': stat.st_size, 'mtime': stat.st_mtime, 'sha1': sha1.hexdigest()}
+                known[i] = entry
+
+        result[i] = "%s-v%d" %(entry['sha1'][:16],crs_schema_version)
+
+    os.makedirs(os.path.dirname(fingerprints_filename),exist_ok=True)
+    with open(fingerprints_filename,'w') as fd:
+        json.dump(known,fd,indent=1)
+
+    return result
+
+def get_partition_filename(zipname, fingerprint, cachedir="data/cache", kind=None):
+    """
+    returns the filename of the columnar cache-file (parquet) of a single zip-file of the crs. the
+    fingerprint is part of the filename, so a changed zip-file or schema never serves a stale cache.
+
+    @param zipname: the name of the zip-file as listed in datasets (ex.: 'crs2019.zip')
+    @param fingerprint: the fingerprint of the zip-file as returned by get_source_fingerprints
+    @param cachedir: the basedir of the cache
+    @param kind: None for the partition itself, otherwise the name of a dataset derived from the partition
+    """
+    subdir = "crs" if kind is None else "crs/" + kind
+    return "%s/%s/%s-%s.parquet" %(cachedir,subdir,os.path.splitext(zipname)[0],fingerprint)
+
+def remove_stale_partitions(partition_filename):
+    """
+    removes the cache-files of older versions of the same zip-file and kind
+
+    @param partition_filename: the filename of the current cache-file
+    """
+    stem = partition_filename.rsplit("-",2)[0]
+    pattern = re.compile(re.escape(os.path.basename(stem)) + r"-[0-9a-f]{16}-v[0-9]+\.parquet")
+    for i in glob.glob(glob.escape(stem) + "-*.parquet"):
+        if i != partition_filename and pattern.fullmatch(os.path.basename(i)):
+            print("Removing stale partition: %s" %(i))
+            os.remove(i)
+
+def get_set_filename(setname, fingerprints, kind, version, cachedir="data/cache"):
+    """
+    returns the filename of a cache-file derived from all zip-files of a set, ex. a table aggregated over
+    the set. the hash of the fingerprints is part of the filename, so a changed zip-file creates a new file.
+
+    @param setname: the name of the set, see datasets
+    @param fingerprints: a dict with the zip-filenames of the set and their fingerprints (see get_source_fingerprints)
+    @param kind: the name of the derived dataset, used as directory
+    @param version: the version of the derived dataset
+    @param cachedir: the basedir of the cache
+    """
+    sha1 = hashlib.sha1(("v%d" %(version)).encode("utf-8"))
+    for i in fingerprints:
+        sha1.update(("%s:%s;" %(i,fingerprints[i])).encode("utf-8"))
+    return "%s/%s/%s-%s-v%d.parquet" %(cachedir,kind,setname.replace(" ","_"),sha1.hexdigest()[:16],version)
+
+def build_partition(zipname, partition_filename, datadir='data/'):
+    """
+    parses a zip-file of the crs and stores it as a columnar cache-file. the rownumber within the
+    zip-file is kept as index.
+
+    @param zipname: the name of the zip-file as listed in datasets (ex.: 'crs2019.zip')
+    @param partition_filename: the filename of the partition as returned by get_partition_filename
+    @param datadir: the basedir where the zip-file can be found
+
+    @return: the filename of the partition
+    """
+    print("reading: %s/%s" %(datadir,zipname))
+    df = read_crs_zip(datadir+zipname)
+
+    print("Writing partition: %s" %(partition_filename))
+    os.makedirs(os.path.dirname(partition_filename),exist_ok=True)
+    # smaller rowgroups make the min/max statistics usable for skipping data while reading
+    df.to_parquet(partition_filename,engine="pyarrow",index=True,row_group_size=100000)
+    remove_stale_partitions(partition_filename)
+
+    return partition_filename
+
+def get_partition_filters(years=None, donorcodes=None, sectorcodes=None, filters=None):
+    """
+    creates filters (in the format used by pyarrow) that are applied while reading the partitions
+
+    @param years: a tupel (startyear, stopyear) including both years, one of them may be None
+    @param donorcodes: an array of donor country codes. Use None or array of size 0 to skip this filter
+    @param sectorcodes: an array of sector codes. Use None or array of size 0 to skip this filter
+    @param filters: additional filters as list of tupels (column, operator, value)
+
+    @return: a list of tupels or None if nothing should be filtered
+    """
+    result = list(filters) if filters else []
+    if years:
+        startyear, stopyear = years
+        if startyear:
+            result.append(('Year','>=',pd.Timestamp(year=startyear,month=1,day=1)))
+        if stopyear:
+            result.append(('Year','<',pd.Timestamp(year=stopyear+1,month=1,day=1)))
+
+    if type(donorcodes) == type([]) and len(donorcodes) > 0:
+        result.append(('DonorCode','in',donorcodes))
+
+    if type(sectorcodes) == type([]) and len(sectorcodes) > 0:
+        result.append(('SectorCode','in',sectorcodes))
+
+    return result if len(result) > 0 else None
+
+def build_partitions(zipnames, datadir='data/', cachedir="data/cache", workers=1):
+    """
+    builds the missing or outdated partitions of the given zip-files. with more than one worker every
+    zip-file is parsed in a separate process, each process writes its own partition.
+
+    @param zipnames: an array of zip-filenames as listed in datasets
+    @param datadir: the basedir where the zip-files can be found
+    @param cachedir: the basedir of the cache
+    @param workers: how many zip-files are parsed in parallel. None uses one process per cpu
+
+    @return: an array with the filenames of the partitions in the order of zipnames
+    """
+    fingerprints = get_source_fingerprints(zipnames,datadir=datadir,cachedir=cachedir)
+    partition_filenames = [get_partition_filename(i,fingerprints[i],cachedir=cachedir) for i in zipnames]
+    missing = [(i,f) for (i,f) in zip(zipnames,partition_filenames) if not os.path.exists(f)]
+
+    if len(missing) > 1 and (workers is None or workers > 1):
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(build_partition,[i for (i,f) in missing],
+                              [f for (i,f) in missing],[datadir]*len(missing)))
+    else:
+        for (i,f) in missing:
+            build_partition(i,f,datadir=datadir)
+
+    return partition_filenames
+
+def concat_water_data(dfs):
+    """
+    concatenates DataFrames read from different zip-files or chunks. categorical features would be
+    converted to plain objects by pandas if the categories differ, so the categories are unified first.
+
+    @param dfs: an array of DataFrames
+
+    @return: the concatenated DataFrame
     """
-    Reads a specified (sub)-set or the full filelist
+    dfs = [i for i in dfs]
+    if len(dfs) == 0:
+        return pd.DataFrame()
+
+    categories = {}
+    for i in dfs[0].columns:
+        if all(i in df and df[i].dtype.name == 'category' for df in dfs):
+            categories[i] = pd.api.types.union_categoricals([df[i] for df in dfs],sort_categories=True).categories
+
+    # the columns are replaced in shallow copies, the frames of the caller (maybe slices) are not changed
+    if len(categories) > 0:
+        dfs = [df.copy(deep=False) for df in dfs]
+        for df in dfs:
+            for (i, c) in categories.items():
+                df[i] = df[i].cat.set_categories(c)
+
+    return pd.concat(dfs)
+
+def read_water_data(setname = "playset", datadir='data/', datasets=datasets,cachedir="data/cache",
+                    columns=None, years=None, donorcodes=None, sectorcodes=None, filters=None,
+                    workers=1, float32amounts=False):
+    """
+    Reads a specified (sub)-set or the full filelist. Every zip-file is parsed only once and stored
+    as a columnar partition in the cachedir, so only the requested columns and rows are loaded. Sets
+    share the partitions and only new or changed zip-files are parsed again.
+
     @setname: one of 'fullset', 'sane commitment', 'sane disbursement','sane','playset'
     @datadir: the basedir where the files can be found
     @datasets: a dict with datasets containing lists of zip-filenames to read from the datadir
+    @cachedir: where to store/find the partitions
+    @columns: an array of features to load. None loads every feature, features not stored in the partitions are ignored
+    @years: only load data submitted within (startyear, stopyear) - both years are included
+    @donorcodes: only load data of the listed donor country codes
+    @sectorcodes: only load data of the listed sector codes
+    @filters: additional filters as list of tupels (column, operator, value) as used by pyarrow
+    @workers: how many missing partitions are built in parallel. None uses one process per cpu
+    @float32amounts: load the amounts (see crs_amount_features) as float32 instead of float64
 
-    @return: returns a pandas DataFrame with the data
+    @return: returns a pandas DataFrame with the data, codes and names are categoricals
     """
-    df = pd.DataFrame()
+    partitionfilters = get_partition_filters(years=years,donorcodes=donorcodes,
+                                             sectorcodes=sectorcodes,filters=filters)
+    dfs = []
+    for partition_filename in build_partitions(datasets[setname],datadir=datadir,
+                                               cachedir=cachedir,workers=workers):
+        print("Reading Data from partition: %s" %(partition_filename))
+        # the projection is applied by the reader, the other columns are never read
+        if columns is not None:
+            stored = set(pq.read_schema(partition_filename).names)
+            partitioncolumns = [i for i in columns if i in stored]
+        else:
+            partitioncolumns = None
+        dfs.append(pd.read_parquet(partition_filename,engine="pyarrow",
+                                   columns=partitioncolumns,filters=partitionfilters))
 
-    cached_df_filename = "%s/%s.p" %(cachedir,setname)
-    try:
-        with open(cached_df_filename, 'rb') as fd:
-            print("Reading Datafrom cached file: %s" %(cached_df_filename))
-            df = pickle.load(fd)
-    except:
-    
-        filelist = datasets[setname]
-    
-        for i in filelist:
-            print("reading: %s/%s" %(datadir,i))
-            df = df.append(pd.read_csv(datadir+i,sep="|",
-                                       header=0,quotechar='"',
-                                       encoding="iso8859_15",
-                                       compression="zip",low_memory=False,
-                                       dtype={
-                                           'DonorCode': np.unicode_,
-                                           'InitialReport': np.unicode_,
-                                           'AgencyCode': np.unicode_,
-                                           'RecipientCode': np.unicode_,
-                                           'RegionCode': np.unicode_,
-                                           'IncomegroupCode': np.unicode_,
-                                           'FlowCode': np.unicode_,
-                                           'Bi_Multi': np.unicode_,
-                                           'Category': np.unicode_,
-                                           'Finance_t': np.unicode_,
-                                           'CrsID': np.unicode_,
-                                           'Aid_t': np.unicode_,
-                                           'ProjectNumber': np.unicode_,
-                                           'CurrencyCode': np.unicode_,
-                                           'PurposeCode': np.unicode_,
-                                           'SDGfocus': np.unicode_,
-                                           'SectorCode': np.unicode_,
-                                           'ChannelCode': np.unicode_,
-                                           'ParentChannelCode': np.unicode_,
-                                           'BudgetIdent': np.unicode_,
-                                           'Gender': np.unicode_,
-                                           'Environment': np.unicode_,
-                                           'PDGG': np.unicode_,
-                                           'Trade': np.unicode_,
-                                           'RMNCH': np.unicode_
-                                       },
-                                       parse_dates=["CommitmentDate",'ExpectedStartDate','Year',
-                                                    'CompletionDate','Repaydate1','Repaydate2']))
-        print("Writing cached_df_file: %s" %(cached_df_filename))
-        os.makedirs(cachedir,exist_ok=True)    
-
-        with open(cached_df_filename, 'wb') as fd:
-            pickle.dump(df, fd)
+    df = concat_water_data(dfs)
+    if float32amounts:
+        for i in crs_amount_features:
+            if i in df:
+                df[i] = df[i].astype(np.float32)
 
     return df
 
-def get_oecd_iso3_code_mapping(cachedir="data/cache", datadir="data/"):
+def get_donor_sector_flow_recipient_mask(df, donorcodes=None, sectorcodes=None, flowcodes=None,
+                                         recipientcodes=None, filterzerocommitment=False,
+                                         valuename='USD_Commitment_Defl'):
+    """
+    creates a boolean mask selecting the rows of the given donors, sectors, flows and recipients.
+
+    @param df: the DataFrame to create the mask for
+    @param donorcodes: an array of donor country codes. Use None or array of size 0 to skip this filter
+    @param sectorcodes: an array of sector codes. Use None or array of size 0 to skip this filter
+    @param flowcodes: an array of flow codes. Use None or array of size 0 to skip this filter
+    @param recipientcodes: an array of recipient codes. Use None or array of size 0 to skip this filter
+    @param filterzerocommitment: filter out rows without or with a value of zero for 'valuename'
+    @param valuename: defaults to USD_Commitment_Defl
+
+    @return: a boolean Series aligned with df
+    """
+    mask = pd.Series(True,index=df.index)
+    if filterzerocommitment:
+        mask &= df[valuename].notnull() & (df[valuename] != 0.0)
+
+    for (feature, codes) in [('DonorCode',donorcodes),('SectorCode',sectorcodes),
+                             ('FlowCode',flowcodes),('RecipientCode',recipientcodes)]:
+        if type(codes) == type([]) and len(codes) > 0:
+            mask &= df[feature].isin(codes)
+
+    return mask
+
+class FilterIndex:
+    """
+    precomputes the row-positions of every value of the code-features once, so repeated selections of donors,
+    sectors, flows and recipients are answered by intersecting small sorted arrays instead of comparing every row.
+    the results are the same as with get_donor_sector_flow_recipient_mask.
+
+    usage:
+        index = FilterIndex(df)
+        rows = index.query(donorcodes=['5'],sectorcodes=['140'])
+        df_focus = index.select(rows)
+    """
+
+    def __init__(self, df, features=['DonorCode','SectorCode','FlowCode','RecipientCode']):
+        """
+        @param df: the DataFrame to index. it must not be changed while the index is used
+        @param features: the features to index
+        """
+        self.df = df
+        self.rows = {}
+        self.nonzero = {}
+        for i in features:
+            (codes, uniques) = pd.factorize(df[i])
+            # the positions sorted by value, missing values (-1) come first and are never selected
+            order = np.argsort(codes,kind='stable')
+            bounds = np.cumsum(np.bincount(codes[codes >= 0],minlength=len(uniques)))
+            order = order[len(codes) - bounds[-1]:] if len(uniques) > 0 else order[:0]
+            self.rows[i] = dict(zip(list(uniques),np.split(order,bounds[:-1])))
+
+    def get_rows(self, feature, values):
+        """
+        @return: the sorted positions of the rows with one of the values in feature
+        """
+        # every value once, a repeated value would add its rows twice
+        arrays = [self.rows[feature][i] for i in set(values) if i in self.rows[feature]]
+        if len(arrays) == 0:
+            return np.empty(0,dtype=np.intp)
+        return arrays[0] if len(arrays) == 1 else np.sort(np.concatenate(arrays))
+
+    def get_nonzero_rows(self, valuename):
+        """
+        @return: the sorted positions of the rows with a value other than NaN or 0.0 for valuename
+        """
+        if valuename not in self.nonzero:
+            values = self.df[valuename]
+            self.nonzero[valuename] = np.flatnonzero((values.notnull() & (values != 0.0)).to_numpy())
+        return self.nonzero[valuename]
+
+    def query(self, donorcodes=None, sectorcodes=None, flowcodes=None, recipientcodes=None,
+              filterzerocommitment=False, valuename='USD_Commitment_Defl'):
+        """
+        selects the rows of the given donors, sectors, flows and recipients. the parameters are the same as
+        for get_donor_sector_flow_recipient_mask
+
+        @return: a sorted numpy array with the positions of the selected rows
+        """
+        selections = []
+        for (feature, codes) in [('DonorCode',donorcodes),('SectorCode',sectorcodes),
+                                 ('FlowCode',flowcodes),('RecipientCode',recipientcodes)]:
+            if type(codes) == type([]) and len(codes) > 0:
+                selections.append(self.get_rows(feature,codes))
+        if filterzerocommitment:
+            selections.append(self.get_nonzero_rows(valuename))
+
+        if len(selections) == 0:
+            return np.arange(len(self.df))
+
+        # start with the smallest selection, every intersection can only get smaller
+        selections.sort(key=len)
+        rows = selections[0]
+        for i in selections[1:]:
+            rows = rows[np.isin(rows,i,assume_unique=True)]
+        return rows
+
+    def select(self, rows):
+        """
+        @param rows: row-positions as returned by query
+        @return: a DataFrame with the selected rows
+        """
+        return self.df.iloc[rows]
+
+def iter_water_data(setname = "playset", datadir='data/', datasets=datasets, features=None,
+                    donorcodes=None, sectorcodes=None, flowcodes=None, recipientcodes=None,
+                    filterzerocommitment=False, valuename='USD_Commitment_Defl', chunksize=100000):
+    """
+    Reads a specified (sub)-set chunk by chunk directly from the zip-files and yields only the rows
+    and features that are requested. The memory used is bound by the chunksize instead of the size of the set.
+
+    @param setname: one of 'fullset', 'sane commitment', 'sane disbursement','sane','playset'
+    @param datadir: the basedir where the files can be found
+    @param datasets: a dict with datasets containing lists of zip-filenames to read from the datadir
+    @param features: an array of features to keep. None keeps every feature
+    @param donorcodes: an array of donor country codes. Use None or array of size 0 to skip this filter
+    @param sectorcodes: an array of sector codes. Use None or array of size 0 to skip this filter
+    @param flowcodes: an array of flow codes. Use None or array of size 0 to skip this filter
+    @param recipientcodes: an array of recipient codes. Use None or array of size 0 to skip this filter
+    @param filterzerocommitment: filter out rows without or with a value of zero for 'valuename'
+    @param valuename: defaults to USD_Commitment_Defl
+    @param chunksize: how many rows are parsed at once
+
+    @return: a generator of DataFrames - use concat_water_data to combine them
+    """
+    usecols = None
+    if type(features) == type([]) and len(features) > 0:
+        wanted = set(features) | set(['DonorCode','SectorCode','FlowCode','RecipientCode',valuename])
+        # not every file of the crs contains every feature
+        usecols = lambda x: x in wanted
+
+    for i in datasets[setname]:
+        print("streaming: %s/%s" %(datadir,i))
+        header = pd.read_csv(datadir+i,sep="|",header=0,quotechar='"',encoding="iso8859_15",
+                             compression="zip",nrows=0)
+        columns = [c for c in header.columns if usecols is None or usecols(c)]
+
+        for chunk in pd.read_csv(datadir+i,sep="|",
+                                 header=0,quotechar='"',
+                                 encoding="iso8859_15",
+                                 compression="zip",
+                                 usecols=columns,
+                                 dtype=crs_dtypes,
+                                 parse_dates=[c for c in crs_date_features if c in columns],
+                                 chunksize=chunksize):
+            mask = get_donor_sector_flow_recipient_mask(chunk,donorcodes=donorcodes,sectorcodes=sectorcodes,
+                                                        flowcodes=flowcodes,recipientcodes=recipientcodes,
+                                                        filterzerocommitment=filterzerocommitment,
+                                                        valuename=valuename)
+            chunk = chunk[mask]
+            if usecols is not None:
+                chunk = chunk[[c for c in features if c in chunk]]
+
+            if len(chunk) > 0:
+                yield chunk
+
+# increase whenever the building of the countrycode-mapping or the overrides change
+oecd_iso3_mapping_version = 1
+
+# the zip-files of the mapping stored without a hash in its filename
+oecd_iso3_mapping_zipnames = datasets['fullset']
+
+# oecd-country-codes and iso3-codes that are (maybe) missing in the datasets or named differently
+oecd_iso3_overrides = {
+    '376': 'AIA', # Anguilla
+    '831': 'COK', # Cook Islands
+    '443': 'FLK', # Falkland Islands (Malvinas)
+    '258': 'MYT', # Mayotte
+    '385': 'MSR', # Montserrat
+    '361': 'ANT', # Netherlands Antilles
+    '856': 'NIU', # Niue
+    '276': 'SHN', # Saint Helena, Ascension and Tristan da Cunha
+    '868': 'TKL', # Tokelau
+    '876': 'WLF', # Wallis and Futuna
+    '88': 'MKD',  # Macedonia, the former Yugoslav Republic of
+    '69': 'SVK',  # Slovakia
+    '280': 'SWZ', # Swaziland / Eswatini
+    '75': 'HUN',  # Hungary
+    '82': 'EST',  # Estonia
+    '68': 'CZE',  # Czech Republic
+    '72': 'BGR',  # Bulgaria
+    '83': 'LVA',  # Latvia
+    '84': 'LTU',  # Lithuania
+}
+
+####### no ISO3Codes for regions
+# Africa, America, Asia, Bilateral, Caribbean & Central America, Caribbean,
+# Central America, Central Asia, East African Community, Eastern Africa, Europe,
+# Far East Asia, Melanesia, Middle Africa, Middle East, North of Sahara, Oceania,
+# South & Central Asia, South America, South Asia, South of Sahara, Southern Africa,
+# Western Africa: '298','498','798','9998','389','1031','1032','619','237','1027','89','789',
+#                 '1033','1028','589','189','889','689','489','679','289','1029','1030'
+# Chinese Taipei - no iso3code: '732'
+
+crs_codename_features = ['DonorCode','DonorName','RecipientCode','RecipientName']
+
+def get_crs_codenames(zipname, fingerprint, datadir='data/', cachedir="data/cache"):
+    """
+    returns the distinct pairs of code and name of the donors and recipients of a single zip-file of the crs.
+    the pairs are stored as small cache-file next to the partition. if the partition does not exist, only
+    the four columns are read from the zip-file chunk by chunk.
+
+    @param zipname: the name of the zip-file as listed in datasets (ex.: 'crs2019.zip')
+    @param fingerprint: the fingerprint of the zip-file as returned by get_source_fingerprints
+    @param datadir: the basedir where the zip-file can be found
+    @param cachedir: the basedir of the cache
+
+    @return: a DataFrame with the columns DonorCode, DonorName, RecipientCode and RecipientName (text)
+    """
+    codenames_filename = get_partition_filename(zipname,fingerprint,cachedir=cachedir,kind="codenames")
+    if os.path.exists(codenames_filename):
+        return pd.read_parquet(codenames_filename,engine="pyarrow")
+
+    partition_filename = get_partition_filename(zipname,fingerprint,cachedir=cachedir)
+    if os.path.exists(partition_filename):
+        df = pd.read_parquet(partition_filename,engine="pyarrow",columns=crs_codename_features)
+        df = df.astype(str,copy=False).where(df.notnull()).drop_duplicates()
+    else:
+        print("reading codes and names: %s%s" %(datadir,zipname))
+        chunks = pd.read_csv(datadir+zipname,sep="|",header=0,quotechar='"',encoding="iso8859_15",
+                             compression="zip",usecols=crs_codename_features,dtype=str,chunksize=500000)
+        df = pd.concat([i.drop_duplicates() for i in chunks]).drop_duplicates()
+
+    df = df[crs_codename_features].reset_index(drop=True)
+    print("Writing codes and names: %s" %(codenames_filename))
+    os.makedirs(os.path.dirname(codenames_filename),exist_ok=True)
+    df.to_parquet(codenames_filename,engine="pyarrow",index=False)
+    remove_stale_partitions(codenames_filename)
+    return df
+
+def build_oecd_iso3_code_mapping(zipnames, datadir="data/", cachedir="data/cache"):
+    """
+    builds the mapping of oecd-country-codes to iso3-countrycodes by matching the names of the donors and
+    recipients with the names used by the worldbank. the overrides are not applied
+
+    @param zipnames: the zip-files of the crs to take the codes and names from
+    @param datadir: where to find the oecd-data
+    @param cachedir: the basedir of the cache
+
+    @return: a dict with both mappings (oecd-code to iso3-code and iso3-code to oecd-code)
+    """
+    fingerprints = get_source_fingerprints(zipnames,datadir=datadir,cachedir=cachedir)
+    df = pd.concat([get_crs_codenames(i,fingerprints[i],datadir=datadir,cachedir=cachedir) for i in zipnames])
+
+    # donors first, later pairs of the same code or name win
+    codenamemap = pd.concat([df[['DonorCode','DonorName']].set_axis(['Code','Name'],axis=1),
+                             df[['RecipientCode','RecipientName']].set_axis(['Code','Name'],axis=1)])
+    codenamemap = codenamemap.dropna().drop_duplicates()
+    codenamemap['Name'] = codenamemap['Name'].replace(crs_to_worldbank_countrynames)
+
+    wb_regions = get_regionnames(cachedir=cachedir)
+    dfmap = codenamemap.merge(wb_regions[['id','name']],how='inner',left_on='Name',right_on="name")
+    dfmap = dfmap[(dfmap['id'] != "") & (dfmap['Code'] != "")]
+
+    crs_wb_country_idmap = dict(zip(dfmap['Code'],dfmap['id']))
+    crs_wb_country_idmap.update(zip(dfmap['id'],dfmap['Code']))
+    return crs_wb_country_idmap
+
+def get_oecd_iso3_code_mapping(cachedir="data/cache", datadir="data/", setname="fullset", datasets=datasets,
+                               rebuild=False):
     """
     returns a mapping of oecd-country-codes to iso3-Countrycodes. Since the mapping does not overlap,
-    one dict with bothmappings is returned
+    one dict with bothmappings is returned. the mapping including the overrides is stored in a small
+    versioned json-file ('cachedir/oecdiso3-v<version>.json'), it is built again if the version changes.
+    a mapping of other zip-files than the fullset is stored as 'cachedir/oecdiso3-v<version>-<hash>.json',
+    so a smaller set only needs its own zip-files.
 
     @param cachedir: stores the result in a cache-file 
     @param datadir: where to finde the oecd-data
+    @param setname: the set of zip-files to take the codes and names from
+    @param datasets: a dict with datasets containing lists of zip-filenames
+    @param rebuild: build the mapping again, ex. after new zip-files were added
     """
+    zipnames = datasets[setname]
+    mapping_filename = "%s/oecdiso3-v%d.json" %(cachedir,oecd_iso3_mapping_version)
+    if zipnames != oecd_iso3_mapping_zipnames:
+        sha1 = hashlib.sha1(";".join(zipnames).encode("utf-8")).hexdigest()[:16]
+        mapping_filename = "%s/oecdiso3-v%d-%s.json" %(cachedir,oecd_iso3_mapping_version,sha1)
+    if not rebuild and os.path.exists(mapping_filename):
+        print("Reading countrycode-mapping: %s" %(mapping_filename))
+        with open(mapping_filename) as fd:
+            return json.load(fd)['mapping']
 
-    cached_filename = "%s/oecdiso3.p" %(cachedir)
-    crs_wb_country_idmap = {}
-    try:
-        with open(cached_filename, 'rb') as fd:
-            print("Reading countrycode-mapping cached file: %s" %(cached_filename))
+    # the mapping cached before the versioned file was introduced is used as it is
+    legacy_filename = "%s/oecdiso3.p" %(cachedir)
+    if not rebuild and zipnames == oecd_iso3_mapping_zipnames and os.path.exists(legacy_filename):
+        print("Importing countrycode-mapping cached file: %s" %(legacy_filename))
+        with open(legacy_filename, 'rb') as fd:
             crs_wb_country_idmap = pickle.load(fd)
-    except:
-        df = read_water_data(datadir=datadir,setname="fullset",cachedir=cachedir)
-        wb_regions = get_regionnames(cachedir=cachedir)
-        
-        recipients = df[['RecipientCode','RecipientName']].groupby(["RecipientCode","RecipientName"]).count().reset_index()
-        recipients.rename(columns={"RecipientCode": "Code", "RecipientName": "Name"}, inplace=True)
+    else:
+        crs_wb_country_idmap = build_oecd_iso3_code_mapping(zipnames,datadir=datadir,cachedir=cachedir)
 
-        donors = df[['DonorCode','DonorName']].groupby(["DonorCode","DonorName"]).count().reset_index()
-        donors.rename(columns={"DonorCode": "Code", "DonorName": "Name"},inplace=True)
+    for (code, iso3) in oecd_iso3_overrides.items():
+        crs_wb_country_idmap[code] = iso3
+        crs_wb_country_idmap[iso3] = code
 
-        codenamemap = donors.append(recipients)
+    print("Writing countrycode-mapping: %s" %(mapping_filename))
+    os.makedirs(cachedir,exist_ok=True)
+    with open(mapping_filename,'w') as fd:
+        json.dump({'version': oecd_iso3_mapping_version, 'setname': setname,
+                   'mapping': crs_wb_country_idmap},fd,indent=1,sort_keys=True)
 
-        codenamemap.replace(inplace=True,to_replace=crs_to_worldbank_countrynames)
-        dfmap = codenamemap.merge(wb_regions,how='outer',left_on='Name',right_on="name")
+    return crs_wb_country_idmap
 
 
-        for row in dfmap[['Code','Name','name','id','region']].iterrows():
-            row = row[1]
-            if row['id'] and row['id'] is not np.nan and row['Code'] and row['Code'] is not np.nan :
-                crs_wb_country_idmap[row['Code']] = row['id']
-                crs_wb_country_idmap[row['id']] = row['Code']
-        print("Writing cached_file: %s" %(cached_filename))
-        with open(cached_filename, 'wb') as fd:
-            pickle.dump(crs_wb_country_idmap, fd)
-
-    finally:
-        # adding some values that are (maybe) missing in the datasets
-        #AIA Anguilla 
-        crs_wb_country_idmap['376'] = 'AIA' 
-        crs_wb_country_idmap['AIA'] = '376'
-        # COK Cook Islands 
-        crs_wb_country_idmap['831'] = 'COK'
-        crs_wb_country_idmap['COK'] = '831'
-        # FLK Falkland Islands (Malvinas) 
-        crs_wb_country_idmap['443'] = 'FLK'
-        crs_wb_country_idmap['FLK'] = '443'
-        # MYT Mayotte
-        crs_wb_country_idmap['258'] = 'MYT'
-        crs_wb_country_idmap['MYT'] = '258'
-        # MSR Montserrat 
-        crs_wb_country_idmap['385'] = 'MSR'
-        crs_wb_country_idmap['MSR'] = '385'
-        # ANT Netherlands Antilles 
-        crs_wb_country_idmap['361'] = 'ANT'
-        crs_wb_country_idmap['ANT'] = '361'
-        # NIU Niue 
-        crs_wb_country_idmap['856'] = 'NIU'
-        crs_wb_country_idmap['NIU'] = '856'
-        # SHN Saint Helena, Ascension and Tristan da Cunha 
-        crs_wb_country_idmap['276'] = 'SHN'
-        crs_wb_country_idmap['SHN'] = '276'
-        # TKL Tokelau 
-        crs_wb_country_idmap['868'] = 'TKL'
-        crs_wb_country_idmap['TKL'] = '868'
-        # WLF Wallis and Futuna 
-        crs_wb_country_idmap['876'] = 'WLF'
-        crs_wb_country_idmap['WLF'] = '876'
-        # MKD Macedonia, the former Yugoslav Republic of 
-        crs_wb_country_idmap['88'] = 'MKD'
-        crs_wb_country_idmap['MKD'] = '88'
-        # SVK Slovakia
-        crs_wb_country_idmap['69'] = 'SVK'
-        crs_wb_country_idmap['SVK'] = '69'
-        # SWZ Swaziland  / Eswatini
-        crs_wb_country_idmap['280'] = 'SWZ'
-        crs_wb_country_idmap['SWZ'] = '280'
-        # HUN Hungary 
-        crs_wb_country_idmap['75'] = 'HUN'
-        crs_wb_country_idmap['HUN'] = '75'
-        # EST Estonia
-        crs_wb_country_idmap['82'] = 'EST'
-        crs_wb_country_idmap['EST'] = '82'
-        # CZE Czech Republic
-        crs_wb_country_idmap['68'] = 'CZE'
-        crs_wb_country_idmap['CZE'] = '68'
-        # BGR Bulgaria 
-        crs_wb_country_idmap['72'] = 'BGR'
-        crs_wb_country_idmap['BGR'] = '72'
-        # LVA Latvia 
-        crs_wb_country_idmap['83'] = 'LVA'
-        crs_wb_country_idmap['LVA'] = '83'
-        # LTU Lithuania
-        crs_wb_country_idmap['84'] = 'LTU'
-        crs_wb_country_idmap['LTU'] = '84'
-
-        ####### no ISO3Codes for regions
-        # Africa, America, Asia, Bilateral, Caribbean & Central America, Caribbean,
-        # Central America, Central Asia, East African Community, Eastern Africa, Europe,
-        # Far East Asia, Melanesia, Middle Africa, Middle East, North of Sahara, Oceania,
-        # South & Central Asia, South America, South Asia, South of Sahara, Southern Africa,
-        # Western Africa
-        
-        #for i in ['298','498','798','9998','389','1031','1032','619','237','1027','89','789',
-        #          '1033','1028','589','189','889','689','489','679','289','1029','1030']:
-        #    crs_wb_country_idmap[i]=""
-
-        # Chinese Taipei - no iso3code
-        #crs_wb_country_idmap['732'] = ""
-
-        # generic catch
-        #crs_wb_country_idmap[''] = ''
-        #crs_wb_country_idmap[np.nan] = ''
-        
-        
-        return crs_wb_country_idmap
-
-
-def extract_features(idf,features):
-    
+def extract_features(idf,features=None,copy=False):
     """
+    selects features/columns of a DataFrame. the columns of the result share their data with idf, nothing is
+    copied. adding, replacing or dropping columns of the result does not change idf, values changed in place do.
+
     @param idf: the dataframe to extract the features/columns from
-    @param features: an array containing the featurenames to extract
+    @param features: an array containing the featurenames to extract. missing features are skipped, None selects all features
+    @param copy: True returns a copy of the data like DataFrame.copy()
 
     """
-    df = pd.DataFrame()
     if type(features) == type([]) and len(features) > 0:
-        for i in features:
-            if i in idf:
-                df[i] = idf[i]
+        columns = [i for i in features if i in idf]
     else:
-        df = idf.copy()
-            
+        columns = list(idf.columns)
+
+    return pd.DataFrame(dict([(i, idf[i]) for i in columns]),index=idf.index,copy=copy)
+
+def get_cached_lookup(name, sources, params, build, cachedir="data/cache"):
+    """
+    returns a lookup table that is built only once from some (small) source-files and stored in the
+    cachedir. the cache-file is named after a hash of the sources and the parameters, so changes of
+    either are never served from an outdated cache.
+
+    @param name: the first part of the filename of the cache-file
+    @param sources: an array of filenames the lookup is built from
+    @param params: anything (printable) the lookup depends on
+    @param build: a function without arguments returning the lookup
+    @param cachedir: where to store/find the cache-file
+    """
+    sha1 = hashlib.sha1(repr(params).encode("utf-8"))
+    for i in sources:
+        with open(i,'rb') as fd:
+            sha1.update(fd.read())
+
+    cached_filename = "%s/%s-%s.p" %(cachedir,name,sha1.hexdigest()[:16])
+    try:
+        with open(cached_filename, 'rb') as fd:
+            return pickle.load(fd)
+    except:
+        lookup = build()
+        os.makedirs(cachedir,exist_ok=True)
+        print("Writing cached_file: %s" %(cached_filename))
+        with open(cached_filename, 'wb') as fd:
+            pickle.dump(lookup, fd)
+        return lookup
+
+def get_output_fingerprint(df, params):
+    """
+    calculates a fingerprint of the data and the parameters a result (json/png-files) is generated from.
+    the values and the index of every row are hashed, so any change of the selected data changes the fingerprint
+
+    @param df: the DataFrame the result is generated from. an iterable of DataFrames is hashed chunk by chunk
+               and results in the same fingerprint as the concatenated DataFrame
+    @param params: anything (printable) the result depends on
+
+    @return: the hexdigest (sha1) as string
+    """
+    sha1 = hashlib.sha1(repr(params).encode("utf-8"))
+    for (n, chunk) in enumerate([df] if isinstance(df, pd.DataFrame) else df):
+        if n == 0:
+            sha1.update(repr([(i, str(chunk[i].dtype)) for i in chunk.columns]).encode("utf-8"))
+        sha1.update(pd.util.hash_pandas_object(chunk, index=True).to_numpy().tobytes())
+    return sha1.hexdigest()
+
+def is_output_current(manifest_filename, fingerprint, force=False):
+    """
+    checks if a result was already generated from the same data and parameters. the manifest-file
+    is written by write_output_manifest after all files of the result were created
+
+    @param manifest_filename: the manifest-file of the result
+    @param fingerprint: the fingerprint as returned by get_output_fingerprint
+    @param force: if True, the result is never considered as current
+
+    @return: True if the manifest has the same fingerprint and all listed files exist
+    """
+    if force:
+        return False
+    try:
+        with open(manifest_filename, 'r') as fd:
+            manifest = json.load(fd)
+    except:
+        return False
+
+    return manifest.get('fingerprint') == fingerprint and all(os.path.exists(i) for i in manifest['files'])
+
+def remove_output_manifest(manifest_filename):
+    """
+    removes the manifest-file of a result before it is generated again, so a partly written result is never
+    considered as current
+    """
+    if os.path.exists(manifest_filename):
+        os.remove(manifest_filename)
+
+def write_output_manifest(manifest_filename, fingerprint, files):
+    """
+    stores the fingerprint and the files of a generated result
+
+    @param manifest_filename: the manifest-file of the result
+    @param fingerprint: the fingerprint as returned by get_output_fingerprint
+    @param files: an array of the created filenames
+    """
+    with open(manifest_filename, 'w') as fd:
+        json.dump({'fingerprint': fingerprint, 'files': files}, fd, indent=1)
+
+def get_incomegroup_keys(ioecddf, datefeature="CommitmentDate", oecdidfeature="RecipientCode"):
+    """
+    creates the (countrycode, year) keys used to look up historical incomegroups for every row
+
+    @param ioecddf: microdata-Dataframe of oecd
+    @param datefeature: which feature to use as year - must be a datetime-feature
+    @param oecdidfeature: the feature to use as countrycodes
+
+    @return: a MultiIndex aligned with the rows of ioecddf
+    """
+    codes = ioecddf[oecdidfeature]
+    if codes.dtype.name == 'category':
+        codes = codes.cat.rename_categories(codes.cat.categories.astype(str))
+    else:
+        codes = codes.astype(str)
+
+    # NaT results in NaN, which never matches
+    return pd.MultiIndex.from_arrays([codes, ioecddf[datefeature].dt.year.astype(np.float64)])
+
+def apply_incomegroup_lookup(ioecddf, lookup, targetname, keys=None,
+                             datefeature="CommitmentDate", oecdidfeature="RecipientCode"):
+    """
+    adds a feature 'targetname' with the values of a (countrycode, year)-lookup. The data of ioecddf
+    is not copied, the feature is added to a shallow copy.
+
+    @param ioecddf: microdata-Dataframe of oecd
+    @param lookup: a Series indexed by (countrycode, year)
+    @param targetname: how to name the new feature
+    @param keys: precomputed keys as returned by get_incomegroup_keys
+    @param datefeature: which feature to use as year - must be a datetime-feature
+    @param oecdidfeature: the feature to use as countrycodes
+
+    @return: a shallow copy of ioecddf with the new feature
+    """
+    if keys is None:
+        keys = get_incomegroup_keys(ioecddf,datefeature=datefeature,oecdidfeature=oecdidfeature)
+
+    df = ioecddf.copy(deep=False)
+    df[targetname] = lookup.reindex(keys).values
 
     return df
 
+def get_historical_incomegroups_wb(oecd_iso3, datadir="data/", datafilename="OGHIST.csv", cachedir="data/cache",
+                                   valuemap={'L': 'LDCs',
+                                             'LM': 'LMICs',
+                                             'UM':'UMICs',
+                                             'H': 'HICs',
+                                             'LM*':'LMICs'}):
+    """
+    returns the historical incomegroup classification of the worldbank as lookup table indexed by
+    (oecd-countrycode, year). see apply_historical_incomegroups_wb for details about the data.
+
+    @param oecd_iso3: the mapping from oecd-country-codes to iso3-country-codes
+    @param datadir: the directory where to find the historical classification data.
+    @param datafilename: the filename of the historical classification
+    @param cachedir: where to store/find the lookup table
+    @param valuemap: the historical data uses different values for classification then the oecd, mapping is used to replace them.
+
+    @return: a Series indexed by (RecipientCode, year)
+    """
+    def build():
+        # read the historical classification in Incomegroups from the worldbank
+        icgroup_df = pd.read_csv(datadir+datafilename,header=0,quotechar='"',low_memory=False,sep=";",na_values=['..'])
+
+        # the historical data some datapoints
+        # fill missing values with the value from the next valid year
+        icgroup_df = icgroup_df.set_index(['id','Country']).fillna(method='backfill',axis=1).reset_index()
+        icgroup_df = icgroup_df.melt(id_vars=('id','Country'),var_name="Year")
+
+        # replace the values used for classification with the values used by oecd
+        icgroup_df = icgroup_df.replace({'value': valuemap})
+        icgroup_df['id'] = icgroup_df['id'].replace(oecd_iso3)
+        icgroup_df['Year'] = icgroup_df['Year'].astype(np.float64)
+
+        return icgroup_df.drop_duplicates(subset=['id','Year']).set_index(['id','Year'])['value']
+
+    return get_cached_lookup("incomegroups-wb",[datadir+datafilename],(sorted(oecd_iso3.items()),valuemap),
+                             build,cachedir=cachedir)
+
+def get_historical_incomegroups_oecd(datadir="data/", datafilename="oecd-incomegroup-history.csv", cachedir="data/cache",
+                                     valuemap = {
+                                         "High Income Countries": "HICs",
+                                         "Least Developed Countries": "LDCs",
+                                         "Lower Middle Income Countries": "LMICs",
+                                         "More Advanced Developing Countries and Territories": "MADCTs",
+                                         "Other Low Income Countries": "Other LICs",
+                                         "Upper Middle Income Countries": "UMICs"}):
+    """
+    returns the historical incomegroup classification of the oecd as lookup table indexed by
+    (oecd-countrycode, year)
+
+    @param datadir: the directory where to find the historical classification data.
+    @param datafilename: the filename of the historical classification
+    @param cachedir: where to store/find the lookup table
+    @param valuemap: the historical data uses different values for classification then the oecd. the mapping is used to replace them.
+
+    @return: a Series indexed by (RecipientCode, year)
+    """
+    def build():
+        hist_oecd_ig=pd.read_csv(filepath_or_buffer=datadir + datafilename,
+                                 dtype={'year': np.float64, 'RecipientCode': np.unicode_},
+                                 usecols=['year','incomegroup','RecipientCode'],
+                                 delimiter=";")
+        hist_oecd_ig.replace({'incomegroup': valuemap},inplace=True)
+
+        return hist_oecd_ig.drop_duplicates(subset=['RecipientCode','year']).set_index(['RecipientCode','year'])['incomegroup']
+
+    return get_cached_lookup("incomegroups-oecd",[datadir+datafilename],valuemap,build,cachedir=cachedir)
+
 def apply_historical_incomegroups_wb(ioecddf,oecd_iso3,
                                      datadir="data/",datafilename="OGHIST.csv",
                                      datefeature="CommitmentDate",
@@ -271,7 +873,8 @@ def apply_historical_incomegroups_wb(ioecddf,oecd_iso3,
                                                'LM': 'LMICs',
                                                'UM':'UMICs',
                                                'H': 'HICs',
-                                               'LM*':'LMICs'}
+                                               'LM*':'LMICs'},
+                                     cachedir="data/cache"
                                      ):
     """
     The Incomegroup classification of the oecd for counties is stated as "active data", meaning it's a feature
@@ -290,44 +893,14 @@ def apply_historical_incomegroups_wb(ioecddf,oecd_iso3,
     @param valuemap: the historical data uses different values for classification then the oecd, mapping is used to replace them.
     @param oecdidfeature: the feature to as countriecodes
     @param targetname: how to name the new feature
+    @param cachedir: where to store/find the lookup table
 
-    
+    @return: a shallow copy of the original 'ioecddf' with the new feature 'targetname'
     """
-    # read the historical classification in Incomegroups from the worldbank
-    icgroup_df = pd.read_csv(datadir+datafilename,header=0,quotechar='"',low_memory=False,sep=";",na_values=['..'])
-
-    # the historical data some datapoints
-    # fill missing values with the value from the next valid year 
-    # this is a little dirty in code
-    T = icgroup_df.T
-    T = T.fillna(method ='backfill') 
-
-    icgroup_df = T.T
-    icgroup_df = icgroup_df.melt(id_vars=('id','Country'),var_name="Year")
-
-    # replace the values used for classification with the values used by oecd
-    icgroup_df = icgroup_df.replace({'value': valuemap})
-    icgroup_df = icgroup_df.replace({'id': oecd_iso3})
-
-    # create a mergeable unique feature
-    icgroup_df['mergefield'] = icgroup_df['Year'].apply(lambda x: str(x))
-    icgroup_df['mergefield'] = icgroup_df['mergefield'] + icgroup_df['id']
-
-    df = ioecddf.copy()
-        
-
-    # create a mergefield within the dataframe
-    df['mergefield'] = df[datefeature].apply(lambda x: "%.0f" %(x.year)) # NaN cannot be converted to Int
-    df['mergefield'] = df['mergefield'] + df[oecdidfeature]
-    #display(df.sample())
-    df = df.merge(icgroup_df.add_prefix("worldbank "),
-                  right_on='worldbank mergefield',
-                  how="left",left_on='mergefield',indicator=True)
-    df.drop(columns=['mergefield','worldbank id','worldbank Country',
-                     'worldbank Year','worldbank mergefield','_merge'],inplace=True)
-    df.rename(columns={'worldbank value': targetname},inplace=True)
-
-    return df
+    lookup = get_historical_incomegroups_wb(oecd_iso3,datadir=datadir,datafilename=datafilename,
+                                            cachedir=cachedir,valuemap=valuemap)
+    return apply_incomegroup_lookup(ioecddf,lookup,targetname,
+                                    datefeature=datefeature,oecdidfeature=oecdidfeature)
 
 def apply_historical_incomegroups_oecd(ioecddf,
                                        datadir="data/",datafilename="oecd-incomegroup-history.csv",
@@ -340,7 +913,8 @@ def apply_historical_incomegroups_oecd(ioecddf,
                                            "Lower Middle Income Countries": "LMICs",
                                            "More Advanced Developing Countries and Territories": "MADCTs",
                                            "Other Low Income Countries": "Other LICs",
-                                           "Upper Middle Income Countries": "UMICs"}
+                                           "Upper Middle Income Countries": "UMICs"},
+                                       cachedir="data/cache"
                                      ):
     """
     add the historical incomegroup classification data to the oecd-dataframe
@@ -352,31 +926,36 @@ def apply_historical_incomegroups_oecd(ioecddf,
     @param valuemap: the historical data uses different values for classification then the oecd. the mapping is used to replace them.
     @param oecdidfeature: the feature to as countriecodes
     @param targetname: how to name the new feature
+    @param cachedir: where to store/find the lookup table
 
-    @return: a copy of the original 'ioecddf' with the new feature 'targetname'
+    @return: a shallow copy of the original 'ioecddf' with the new feature 'targetname'
     """
+    lookup = get_historical_incomegroups_oecd(datadir=datadir,datafilename=datafilename,
+                                              cachedir=cachedir,valuemap=valuemap)
+    return apply_incomegroup_lookup(ioecddf,lookup,targetname,
+                                    datefeature=datefeature,oecdidfeature=oecdidfeature)
 
-    df = ioecddf.copy()
-    df['mergefield'] = df[datefeature].apply(lambda x: "%.0f" %(x.year))
-    df['mergefield'] = df['mergefield'] + df[oecdidfeature]
-    
-    hist_oecd_ig=pd.read_csv(filepath_or_buffer=datadir + datafilename,
-                             dtype={'year': np.unicode_, 'RecipientCode': np.unicode_},
-                             usecols=['year','incomegroup','RecipientCode'],
-                             delimiter=";")
-    hist_oecd_ig.replace({'incomegroup': valuemap},inplace=True)
-
-    hist_oecd_ig.rename(inplace=True,
-                        columns={'incomegroup': targetname,'RecipientCode':'hist_oecd_ig_id'})
+def apply_historical_incomegroups(ioecddf,oecd_iso3,datadir="data/",cachedir="data/cache",
+                                  datefeature="CommitmentDate",oecdidfeature="RecipientCode"):
+    """
+    adds both historical incomegroup classifications (worldbank and oecd) as the features
+    'IncomegroupName (WB)' and 'IncomegroupName (oecd hist)' in a single pass.
 
-    hist_oecd_ig['mergefield'] = hist_oecd_ig['year'] 
-    hist_oecd_ig['mergefield'] = hist_oecd_ig['mergefield'] + hist_oecd_ig['hist_oecd_ig_id']
-    hist_oecd_ig.drop(columns=['hist_oecd_ig_id','year'],inplace=True)
+    @param ioecddf: microdata-Dataframe of oecd
+    @param oecd_iso3: the mapping from oecd-country-codes to iso3-country-codes
+    @param datadir: the directory where to find the historical classification data.
+    @param cachedir: where to store/find the lookup tables
+    @param datefeature: which feature to use to merge on - must be a datetime-feature
+    @param oecdidfeature: the feature to as countriecodes
 
-    df = df.merge(hist_oecd_ig,on="mergefield",how="left")
-    df.drop(columns=['mergefield'],inplace=True)
+    @return: a shallow copy of the original 'ioecddf' with the new features
+    """
+    keys = get_incomegroup_keys(ioecddf,datefeature=datefeature,oecdidfeature=oecdidfeature)
+    df = apply_incomegroup_lookup(ioecddf,get_historical_incomegroups_wb(oecd_iso3,datadir=datadir,cachedir=cachedir),
+                                  "IncomegroupName (WB)",keys=keys)
+    df = apply_incomegroup_lookup(df,get_historical_incomegroups_oecd(datadir=datadir,cachedir=cachedir),
+                                  "IncomegroupName (oecd hist)",keys=keys)
     return df
-            
 
 def merge_wbseries_with_oecd_data(ioecddf, iwbdf, codemapping,cachedir="data/cache",mergedonor=True, mergerecipient=True):
     """
@@ -395,51 +974,48 @@ def merge_wbseries_with_oecd_data(ioecddf, iwbdf, codemapping,cachedir="data/cac
     @return: a DataFrame with enrichments for the Donor and Recipient
     """
     
-    odf = pd.DataFrame()
-    
     # first we kick out everything that cannot be merged, b/c it's not in the mapping
-    oecddf = ioecddf.copy()
+    mask = pd.Series(True,index=ioecddf.index)
     if mergedonor:
-        oecddf = ioecddf[ioecddf['DonorCode'].isin(list(codemapping))]
-    #print(oecddf.describe())
+        mask &= ioecddf['DonorCode'].isin(list(codemapping))
     if mergerecipient:
-        oecddf = oecddf[oecddf['RecipientCode'].isin(list(codemapping))]
-    #print(oecddf.describe())
+        mask &= ioecddf['RecipientCode'].isin(list(codemapping))
+    # the merge-keys are added to a shallow copy, the data itself is not copied
+    odf = (ioecddf if mask.all() else ioecddf[mask]).copy(deep=False)
+
     wbdf = iwbdf[iwbdf['Country'].isin(list(codemapping))].reset_index()
-    #print(wbdf.describe())
 
     # merge some additional infos about the countries from country-data
     cdf = get_regionnames(cachedir=cachedir)
     wbdf = wbdf.merge(cdf, right_on="id", how="left", left_on="Country")
-    #print(wbdf.describe())
-    
-    # create a mergefield on worldbank data
-    wbdf['mergefield'] = wbdf['Year'].apply(lambda x: str(x))
-    wbdf['mergefield'] = wbdf['mergefield'] + wbdf['id']
-    
-    odf = oecddf.copy()
-    
-    # create two mergefields for Donor and Recipients
+
+    # merge on (year, iso3code) - the year of the worldbank data is a string
+    wbdf['mergeyear'] = pd.to_numeric(wbdf['Year']).astype(np.float64)
+    wbdf['mergeiso3'] = wbdf['id']
+    wbdf.drop(columns=['index','Year','Country'],inplace=True)
+
+    # NaT in CommitmentDate results in NaN, which never matches
+    odf['mergeyear'] = odf['CommitmentDate'].dt.year.astype(np.float64)
+
+    # the codes are mapped per category/unique value instead of per row
     if mergedonor:
-        odf['donormerge'] = odf['CommitmentDate'].apply(lambda x: str(x.year))
-        odf['donormerge'] = odf['donormerge'] + odf['DonorCode'].apply(lambda x: str(codemapping[x]))
-        odf = odf.merge(wbdf.add_prefix("Donorstat "),
-                        right_on='Donorstat mergefield',
-                        how="left",left_on='donormerge')
-        odf.drop(columns=['Donorstat mergefield','donormerge','Donorstat index','Donorstat Year','Donorstat name','Donorstat Country'],inplace=True)
+        odf['mergeiso3'] = odf['DonorCode'].map(codemapping).astype(str)
+        odf = odf.merge(wbdf.drop(columns=['name']).add_prefix("Donorstat "),
+                        left_on=['mergeyear','mergeiso3'],
+                        right_on=['Donorstat mergeyear','Donorstat mergeiso3'],how="left")
+        odf.drop(columns=['Donorstat mergeyear','Donorstat mergeiso3'],inplace=True)
         odf.rename(columns={'Donorstat id': 'Donorstat iso3Code'},inplace=True)
 
     if mergerecipient:
-        odf['recipientmerge'] = odf['CommitmentDate'].apply(lambda x: str(x.year))
-        odf['recipientmerge'] = odf['recipientmerge'] + odf['RecipientCode'].apply(lambda x: str(codemapping[x]))
+        odf['mergeiso3'] = odf['RecipientCode'].map(codemapping).astype(str)
         odf = odf.merge(wbdf.add_prefix("Recipientstat "),
-                        right_on='Recipientstat mergefield',
-                        how="left",left_on="recipientmerge")
-        odf.drop(columns=['Recipientstat mergefield','recipientmerge','Recipientstat index','Recipientstat Year','Recipientstat Country'],inplace=True)
+                        left_on=['mergeyear','mergeiso3'],
+                        right_on=['Recipientstat mergeyear','Recipientstat mergeiso3'],how="left")
+        odf.drop(columns=['Recipientstat mergeyear','Recipientstat mergeiso3'],inplace=True)
         odf.rename(columns={'Recipientstat id': 'Recipientstat iso3Code'},inplace=True)
 
-    
-    
+    odf.drop(columns=['mergeyear','mergeiso3'],inplace=True,errors='ignore')
+
     return odf
 
 if __name__ == "__main__":
@@ -447,13 +1023,5 @@ if __name__ == "__main__":
     wbdf = fetch_series()
     oecddf = read_water_data()
     idf = extract_features(oecddf).reset_index()
-    df = merge_wbseries_with_oecd_data(idf,wbdf)
+    df = merge_wbseries_with_oecd_data(idf,wbdf,get_oecd_iso3_code_mapping())
     print(df.describe())
-    #print(get_oecd_iso3_code_mapping())
-
-
-
-
-
-
-    
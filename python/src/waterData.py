@@ -1,37 +1,115 @@
 #!/usr/bin/env python
 
-from pandas import DataFrame, read_csv, Grouper
+from pandas import DataFrame
 import pandas as pd
 
 import matplotlib.pyplot as plt
-import matplotlib.dates as mdates
 
 import numpy as np
 import os
 from datetime import datetime
-import json
 import csv
-import pickle
 import plotly.express as px
+import pyarrow as pa
+import pyarrow.parquet as pq
 
 from worldbankApi import fetch_series, default_series
-from tools import extract_features, read_water_data, merge_wbseries_with_oecd_data, get_oecd_iso3_code_mapping
+from tools import datasets, extract_features, read_water_data, merge_wbseries_with_oecd_data, get_oecd_iso3_code_mapping
+from tools import get_donor_sector_flow_recipient_mask, FilterIndex, get_output_fingerprint, is_output_current
+from tools import remove_output_manifest, write_output_manifest
+from chartRenderer import ChartRenderer, inline_renderer
 
 default_features=['DonorName','RecipientName','DonorCode','RecipientCode','IncomegroupName',
-                  'USD_Commitment_Defl','USD_Received_Defl','ShortDescription','AgencyName',
+                  'USD_Commitment_Defl','USD_Disbursement_Defl','USD_Received_Defl','ShortDescription','AgencyName',
                   'FlowCode','SectorCode', 'ProjectTitle','PurposeName','SectorName',
                   'ChannelName','ChannelReportedName', 'ExpectedStartDate','CompletionDate',
                   'LongDescription','CommitmentDate','USD_GrantEquiv','TypeRepayment', "NumberRepayment",
                   "Interest1","Interest2","Repaydate1",'Repaydate2',"USD_Interest", 'Finance_t']
 
+default_valuenames = ['USD_Commitment_Defl','USD_Disbursement_Defl','USD_GrantEquiv']
+
+default_recipientcodes = ["285","248","282","238","278","266","228","645","666","142","437","428","549", "136"]
+
+default_incomegroups = ['LDCs','LMICs','UMICs']
+
+# the subdirectories of the results of run_pipeline and the parameters of filter_donor_sector_flow_recipient
+# selecting their rows. None selects every row
+default_focus_groups = {"dataoverview": None,
+                        "germany": {'sectorcodes': None, 'recipientcodes': None},
+                        "germany-water": {'recipientcodes': None},
+                        "germany-water-selected": {}}
+
+# the recipients and basefilenames of the microdata of german water projects stored by run_pipeline
+default_microdata_selections = [(None,"microdata"),(default_recipientcodes,"microdata_selectedrecipients")]
+
+default_windowsize = [("-inf",0.0),(0.0,"inf"),(0.0,8.0),(0.0,3.0),(0.0,1.0),(0.0,0.2),("-inf",-0.2),(1.0,60.0),
+                      (60.0,"inf"),(200.0,"inf"),(500.0,"inf")]
+
+
+
+default_groupings = [['IncomegroupName','SectorName'],
+                     ['IncomegroupName','PurposeName'],
+                     ['IncomegroupName','SectorName','PurposeName'],
+                     ['RecipientName','SectorName'],
+                     ['RecipientName','PurposeName'],
+                     ['RecipientName','SectorName','PurposeName'],
+                     ['AgencyName','RecipientName'],
+                     ['AgencyName','PurposeName'],
+                     ['AgencyName','IncomegroupName'],
+                     ['AgencyName','SectorName']]
+
+
+def get_grouping_cube(df, valuename, groupings=default_groupings):
+    """
+    aggregates the sum of 'valuename' on the finest grain of all groupings (every feature used in any
+    grouping). rows with missing values in some of the features are kept, so every grouping can be
+    rolled up from the cube with the same result as grouping the data itself.
+
+    @param df: the DataFrame to aggregate
+    @param valuename: the feature to sum up
+    @param groupings: an array of groupings (arrays of featurenames)
+
+    @return: a DataFrame with one row per combination of the features
+    """
+    features = sorted(set(sum(groupings,[])))
+
+    # group on the integer codes of the features, missing values are coded as -1 and kept
+    codes = DataFrame(index=df.index)
+    uniques = {}
+    for i in features:
+        (codes[i], uniques[i]) = pd.factorize(df[i])
+    codes[valuename] = df[valuename]
+
+    cube = codes.groupby(features)[valuename].sum().reset_index()
+    for i in features:
+        cube[i] = pd.Series(uniques[i].take(cube[i].to_numpy(),allow_fill=True,fill_value=np.nan),index=cube.index)
+
+    return cube
+
+def rollup_grouping_cube(cube, grouping, valuename):
+    """
+    sums up the cube created by get_grouping_cube for one grouping
+
+    @param cube: the result of get_grouping_cube
+    @param grouping: an array of featurenames
+    @param valuename: the feature to sum up
+
+    @return: a DataFrame with the features of the grouping and 'valuename' as columns
+    """
+    return cube.groupby(grouping,observed=True)[valuename].sum().sort_index().reset_index()
 
 
 def generate_sunburst_for_grouping(idf,startyear = None, stopyear = datetime.now().year,
                                    targetdir = "results/dataoverview/",
                                    basefilename = "projects_grouping",
-                                   incomegroups=['LDCs','LMICs','UMICs'],
+                                   incomegroups=default_incomegroups,
                                    valuename='USD_Commitment_Defl',
-                                   filterzerocommitment = True):
+                                   filterzerocommitment = True,
+                                   groupings = default_groupings,
+                                   renderer = inline_renderer,
+                                   force = False,
+                                   aggregate = None,
+                                   prefiltered = False):
     """
     create graph that group data into
     * Incomegroup + Sector
@@ -47,55 +125,210 @@ def generate_sunburst_for_grouping(idf,startyear = None, stopyear = datetime.now
     @param valuename: the name of the feature/column to use. defaults to 'USD_Commitment_Defl'
     @param basefilename: the filename and format (based on extension) of the resulting image
     @incomegroups: only consider the listed incomegroups. expects an array of IncomegroupNames. There are: LDCs,LMICs,MADCTs,Other LICs,Part I unallocated by income, UMICs. project specific per default only LDCs, LMICs and UMICs are taken into account. with None or empty array every group is considered
+    @groupings: an array of groupings (arrays of featurenames), defaults to default_groupings
+    @renderer: the ChartRenderer creating the images
+    @force: generate the results even if the manifest shows they are up to date
+    @aggregate: the cube collected by outOfCore.SunburstAggregate for this window, idf is not used then
+    @prefiltered: idf contains only the data of the years already, see select_commitment_years
 
     """
 
-    all_incomegroups = ["LDCs","LMICs","MADCTs","Other LICs","Part I unallocated by income", "UMICs"]
+    if aggregate is None:
+        (idf, targetdir) = select_commitment_years(idf,startyear=startyear,stopyear=stopyear,targetdir=targetdir,
+                                                   prefiltered=prefiltered)
+        df = select_sunburst_data(idf,valuename,incomegroups=incomegroups,
+                                  filterzerocommitment=filterzerocommitment,groupings=groupings)
+    else:
+        targetdir = get_window_targetdir(targetdir,startyear=startyear,stopyear=stopyear)
+        df = aggregate.get_cube(valuename,incomegroups,filterzerocommitment,groupings)
+
+    os.makedirs(targetdir,exist_ok=True)
+
+    manifest = "%s%s.manifest.json" %(targetdir,basefilename)
+    fingerprint = get_output_fingerprint(df,('sunburst',basefilename,valuename,incomegroups,filterzerocommitment,
+                                              groupings,renderer.images))
+    if is_output_current(manifest,fingerprint,force=force):
+        print("Skipping: %s, the results are up to date" %(manifest))
+        return
+    remove_output_manifest(manifest)
+
+    # aggregate once on the finest grain, every grouping is rolled up from this (small) cube
+    cube = get_grouping_cube(df,valuename,groupings=groupings) if aggregate is None else df
+
+    files = []
+    for i in groupings:
+        dfg = rollup_grouping_cube(cube,i,valuename)
+        with open("%s%s-%s.json" %(targetdir,basefilename,"-".join(i)),"w") as fd:
+                fd.write(dfg.to_json(orient="index"))
+        files.append("%s%s-%s.json" %(targetdir,basefilename,"-".join(i)))
+
+        renderer.render(render_sunburst,"%s%s-%s.png" %(targetdir,basefilename,"-".join(i)),dfg,i,valuename)
+        if renderer.images:
+            files.append("%s%s-%s.png" %(targetdir,basefilename,"-".join(i)))
+
+    renderer.finish(write_output_manifest,manifest,fingerprint,files)
+
+def select_sunburst_data(idf, valuename, incomegroups=default_incomegroups, filterzerocommitment=True,
+                         groupings=default_groupings):
+    """
+    selects the rows and features generate_sunburst_for_grouping aggregates, see there for the parameters
+
+    @return: a new DataFrame with 'valuename' and the features of the groupings
+    """
     df = DataFrame()
 
     # filter for needed features
-    for i in ['CommitmentDate','IncomegroupName',valuename,'SectorName','PurposeName','RecipientName','AgencyName']:
+    for i in [valuename] + sorted(set(sum(groupings,['IncomegroupName']))):
         df[i] = idf[i]
 
+    if filterzerocommitment:
+        df = df[df[valuename].notnull()]
+        df = df[df[valuename] != 0.0]
+
+    if type(incomegroups) == type([]) and len(incomegroups) > 0:
+        df = df[df['IncomegroupName'].isin(incomegroups)]
+
+    return df
+
+
+def get_histogram_edges(mn, mx, bins=50):
+    """
+    @return: the edges of the bins between the smallest and largest value, the same as pandas.cut(..., bins=bins)
+             would create
+    """
+    if mn == mx:
+        mn -= 0.001 * abs(mn) if mn != 0 else 0.001
+        mx += 0.001 * abs(mx) if mx != 0 else 0.001
+        edges = np.linspace(mn, mx, bins + 1, endpoint=True)
+    else:
+        edges = np.linspace(mn, mx, bins + 1, endpoint=True)
+        edges[0] -= (mx - mn) * 0.001
+    return edges
+
+def get_histogram_series(edges, counts):
+    """
+    @return: a Series with the counts per interval, sorted descending like pandas.value_counts
+    """
+    return pd.Series(counts,index=pd.cut(edges[-1:],bins=edges).categories).sort_values(ascending=False)
+
+def get_histogram_windows(values, windowsize, bins=50):
+    """
+    calculates the number of projects, the sum and the histogram for every window. the values are sorted
+    once, each window is a slice of the sorted values found by binary search. the bins are the same as
+    pandas.cut(..., bins=bins) would create.
+
+    @param values: a numpy array with the values, NaN is ignored
+    @param windowsize: an array of tupels (lower bound, upper bound) - both bounds are excluded
+    @param bins: how many buckets shall be created
+
+    @return: an array of dicts with the keys 'window','count','sum','edges','counts' and 'histogram' (a Series
+             with the counts per interval, sorted descending like pandas.value_counts)
+    """
+    values = np.sort(values[~np.isnan(values)])
+    result = []
+    for win in windowsize:
+        (lower, upper) = (np.float64(win[0]), np.float64(win[1]))
+        window = values[np.searchsorted(values,lower,side='right'):np.searchsorted(values,upper,side='left')]
+        entry = {'window': (lower, upper), 'count': len(window), 'sum': window.sum(),
+                 'edges': None, 'counts': None, 'histogram': None}
+
+        if len(window) > 0:
+            edges = get_histogram_edges(window[0],window[-1],bins=bins)
+
+            # intervals are closed on the right side
+            entry['edges'] = edges
+            entry['counts'] = np.diff(np.searchsorted(window,edges,side='right'))
+            entry['histogram'] = get_histogram_series(edges,entry['counts'])
+        result.append(entry)
+
+    return result
+
+def get_window_targetdir(targetdir, startyear=None, stopyear=None):
+    """
+    @return: the targetdir with the years appended, ex. 'results/from_2010_upto_2018/'
+    """
     if startyear:
-        df = df[df['CommitmentDate'] > datetime(year=startyear-1,month=12,day=31)]
         targetdir = targetdir + "from_" + str(startyear) + "_"
     if stopyear:
-        df = df[df['CommitmentDate'] < datetime(year=stopyear+1,month=1,day=1)]
         targetdir = targetdir + "upto_" + str(stopyear)
     if startyear or stopyear:
         targetdir = targetdir + "/"
+    return targetdir
 
-    df = df.drop(columns=['CommitmentDate'])
+def select_commitment_years(idf, startyear=None, stopyear=None, targetdir="", prefiltered=False):
+    """
+    selects the data with a CommitmentDate from the 1-1-startyear upto the 31-12-stopyear and appends
+    the years to the targetdir.
 
-    os.makedirs(targetdir,exist_ok=True)
+    @param idf: the DataFrame to select from
+    @param startyear: the first year to include or None
+    @param stopyear: the last year to include or None
+    @param targetdir: the directory the years are appended to
+    @param prefiltered: idf contains only the data of these years already (ex. a window of generate_reports),
+                        it is not filtered again
 
-    if filterzerocommitment:
-        df = df[df[valuename].notnull()]
-        df = df[df[valuename] != 0.0]
+    @return: a tupel (selected DataFrame, targetdir)
+    """
+    targetdir = get_window_targetdir(targetdir,startyear=startyear,stopyear=stopyear)
 
-    if type(incomegroups) == type([]) and len(incomegroups) > 0:
-        df = df[df['IncomegroupName'].isin(incomegroups)]
+    if not (startyear or stopyear) or prefiltered:
+        return (idf, targetdir)
 
+    mask = pd.Series(True,index=idf.index)
+    if startyear:
+        mask &= idf['CommitmentDate'] > datetime(year=startyear-1,month=12,day=31)
+    if stopyear:
+        mask &= idf['CommitmentDate'] < datetime(year=stopyear+1,month=1,day=1)
 
-    for i in [['IncomegroupName','SectorName'],
-              ['IncomegroupName','PurposeName'],
-              ['IncomegroupName','SectorName','PurposeName'],
-              ['RecipientName','SectorName'],
-              ['RecipientName','PurposeName'],
-              ['RecipientName','SectorName','PurposeName'],
-              ['AgencyName','RecipientName'],
-              ['AgencyName','PurposeName'],
-              ['AgencyName','IncomegroupName'],
-              ['AgencyName','SectorName']]:
+    return (idf[mask], targetdir)
 
-        dfg = df.groupby(i).sum().reset_index()
-        with open("%s%s-%s.json" %(targetdir,basefilename,"-".join(i)),"w") as fd:
-                fd.write(dfg.to_json(orient="index"))
+def sort_by_commitmentdate(idf):
+    """
+    sorts the rows by CommitmentDate, rows without a CommitmentDate are moved to the end. data that is sorted
+    already is returned as it is, so the sort can be done once for many calls of generate_reports
+
+    @param idf: a DataFrame with the feature CommitmentDate
+    @return: the sorted DataFrame
+    """
+    dates = idf['CommitmentDate']
+    dated = int(dates.notnull().sum())
+    if dates.iloc[:dated].notnull().all() and dates.iloc[:dated].is_monotonic_increasing:
+        return idf
+    return idf.sort_values('CommitmentDate',kind='mergesort',na_position='last')
+
+def generate_reports(idf, windows=[(None,datetime.now().year)],
+                     generators=None, **kwargs):
+    """
+    generates the reports of several generators for a list of time windows. the data is sorted by
+    CommitmentDate once, the data of every window is a slice found by binary search and handed to
+    the generators, so many (yearly) windows cost about as much as a single pass over the data.
+
+    @param idf: the DataFrame that shall be used as base for the images and json-files
+    @param windows: an array of tupels (startyear, stopyear), both may be None. ex.: [(2010,None),(2015,2017)] + [(i,i) for i in range(2010,2020)]
+    @param generators: an array of the generate_*-functions to call for every window. defaults to
+                       histograms, barcharts and sunbursts
+    @param kwargs: additional parameters for the generators like targetdir, valuename or renderer
 
-        fig = px.sunburst(dfg, path=i, values=valuename)
-        fig.write_image("%s%s-%s.png" %(targetdir,basefilename,"-".join(i)),scale=3)
+    """
+    if generators is None:
+        generators = [generate_histograms_about_projectsize,
+                      generate_barchart_for_incomegroup_distribution,
+                      generate_sunburst_for_grouping]
+
+    # NaT is sorted to the end, rows without a CommitmentDate are only part of windows without years
+    df = sort_by_commitmentdate(idf)
+    years = df['CommitmentDate'].dt.year.to_numpy()
+    dated = int(np.count_nonzero(~np.isnan(years)))
+
+    for (startyear, stopyear) in windows:
+        start = int(np.searchsorted(years[:dated],startyear,side='left')) if startyear else 0
+        stop = int(np.searchsorted(years[:dated],stopyear,side='right')) if stopyear else dated
+        if not (startyear or stopyear):
+            stop = len(df)
 
+        window = df.iloc[start:stop]
+        for generator in generators:
+            generator(window,startyear=startyear,stopyear=stopyear,prefiltered=True,**kwargs)
 
 
 def generate_histograms_about_projectsize(idf,startyear = None, stopyear = datetime.now().year,
@@ -104,14 +337,16 @@ def generate_histograms_about_projectsize(idf,startyear = None, stopyear = datet
                                           filterzerocommitment = True,
                                           valuename="USD_Commitment_Defl",
                                           bins = 50, subplotwidth = 7, ncols = 3,
-                                          windowsize = [("-inf",0.0),(0.0,"inf"),(0.0,8.0),(0.0,3.0),
-                                                        (0.0,1.0),(0.0,0.2),("-inf",-0.2),(1.0,60.0),
-                                                        (60.0,"inf"),(200.0,"inf"),(500.0,"inf")]
+                                          windowsize = default_windowsize,
+                                          renderer = inline_renderer,
+                                          force = False,
+                                          aggregate = None,
+                                          prefiltered = False
                                           ):
     """
     generates some histograms and jsondata about the general data. The results are stored in the targetdir. the start and stop year is
     appended to the dirpath, if provided.
-    Data without or with 0.0 as value for USD_Commitment_Defl are filtered out per default
+    Data without or with 0.0 as value for 'valuename' are filtered out per default
 
     @param idf (DataFrame): the inputDataFrame that shall be used as base for the images and json-files
     @param startyear (int): select a specific year as start. for example 2011 to get graphs beginning at 1-1-2011 upto the end of the data
@@ -125,63 +360,146 @@ def generate_histograms_about_projectsize(idf,startyear = None, stopyear = datet
     @param subplitwidth: width and height of a singe subplot
     @param ncols: number of subplots per row in the graph
     @param basefilename: the filename and format (based on extension) of the resulting image
+    @param renderer: the ChartRenderer creating the image
+    @param force: generate the results even if the manifest shows they are up to date
+    @param aggregate: the values collected by outOfCore.HistogramAggregate for this window, idf is not used then
+    @param prefiltered: idf contains only the data of the years already, see select_commitment_years
+    """
+
+    if aggregate is None:
+        # filter on Commitmentdate
+        (idf, targetdir) = select_commitment_years(idf,startyear=startyear,stopyear=stopyear,targetdir=targetdir,
+                                                   prefiltered=prefiltered)
+
+        values = idf[valuename].to_numpy(dtype=np.float64)
+        if filterzerocommitment:
+            values = values[values != 0.0]
+        data = DataFrame({valuename: values})
+    else:
+        targetdir = get_window_targetdir(targetdir,startyear=startyear,stopyear=stopyear)
+        data = aggregate.get_chunks(valuename,filterzerocommitment)
+
+    os.makedirs(targetdir,exist_ok=True)
+
+    manifest = "%s%s.manifest.json" %(targetdir,basefilename)
+    fingerprint = get_output_fingerprint(data,('histograms',basefilename,valuename,bins,
+                                               subplotwidth,ncols,windowsize,renderer.images))
+    if is_output_current(manifest,fingerprint,force=force):
+        print("Skipping: %s, the results are up to date" %(manifest))
+        return
+    remove_output_manifest(manifest)
+
+    # calculate the data for each defined window
+    files = []
+    if aggregate is None:
+        windows = get_histogram_windows(values,windowsize,bins=bins)
+    else:
+        windows = aggregate.get_windows(windowsize,bins=bins)
+    for win in windows:
+        (lower, upper) = win['window']
+        if win['count'] > 0:
+            with open("%s%s-%.2f-%.2f.json" %(targetdir,basefilename,lower,upper),"w") as fd:
+                fd.write(win['histogram'].to_json(orient="index"))
+            files.append("%s%s-%.2f-%.2f.json" %(targetdir,basefilename,lower,upper))
+
+        else:
+            print("Warning no Data for: %s%s-%.2f-%.2f.json" %(targetdir,basefilename,lower,upper))
+
+    renderer.render(render_histograms,targetdir+basefilename,windows,ncols,subplotwidth)
+    if renderer.images:
+        files.append(targetdir+basefilename)
+
+    renderer.finish(write_output_manifest,manifest,fingerprint,files)
+
+def render_histograms(filename, windows, ncols, subplotwidth):
     """
+    creates the image of generate_histograms_about_projectsize with one subplot per window
 
-    nrows = int(len(windowsize) / ncols) + 1
+    @param filename: the filename and format (based on extension) of the image
+    @param windows: the result of get_histogram_windows
+    @param ncols: number of subplots per row in the graph
+    @param subplotwidth: width and height of a singe subplot
+    """
+    nrows = int(len(windows) / ncols) + 1
     fig, axes = plt.subplots(nrows=nrows, ncols=ncols,figsize=( ncols * subplotwidth, nrows * subplotwidth ))
 
-    rdf = idf.copy()
+    for (i,win) in enumerate(windows):
+        (lower, upper) = win['window']
+        print("creating: %s for subplot: %.2f < x < %.2f" %(filename,lower,upper))
 
-    # filter on Commitmentdate
+        ax = axes[int(i/ncols)][i % ncols]
+        ax.set_title(" %.2f < x < %.2f \n %d projects with total of %.2f mUSD" % (lower,upper,win['count'],win['sum']))
+        ax.grid(True)
 
-    if startyear:
-        rdf = rdf[rdf['CommitmentDate'] > datetime(year=startyear-1,month=12,day=31)]
-        targetdir = targetdir + "from_" + str(startyear) + "_"
-    if stopyear:
-        rdf = rdf[rdf['CommitmentDate'] < datetime(year=stopyear+1,month=1,day=1)]
-        targetdir = targetdir + "upto_" + str(stopyear)
-    if startyear or stopyear:
-        targetdir = targetdir + "/"
+        if win['count'] > 0:
+            # plot the precalculated bins, the json-file contains the same numbers
+            ax.hist(win['edges'][:-1],bins=win['edges'],weights=win['counts'])
+            ax.set_ylabel("Frequency")
 
-    if filterzerocommitment:
-        rdf = rdf[rdf['USD_Commitment_Defl'].notnull()]
-        rdf = rdf[rdf['USD_Commitment_Defl'] != 0.0]
+    plt.savefig(filename,bbox_inches='tight')
+    plt.close(fig)
 
-    os.makedirs(targetdir,exist_ok=True)
+def render_sunburst(filename, dfg, path, valuename):
+    """
+    creates the sunburst-image of a grouping
+
+    @param filename: the filename and format (based on extension) of the image
+    @param dfg: the grouped data as returned by rollup_grouping_cube
+    @param path: the features of the grouping
+    @param valuename: the feature used as values
+    """
+    fig = px.sunburst(dfg, path=path, values=valuename)
+    fig.write_image(filename,scale=3)
+
+def get_incomegroup_statistics(df, valuename):
+    """
+    aggregates sum, mean, median and count of 'valuename' per year of the CommitmentDate and IncomegroupName
+    in a single pass
 
-    # generate subplots for each defined window
-    for (i,win) in enumerate(windowsize):
-        print("filtering for and creating: %s for subplot: %.2f < x < %.2f" %(targetdir + basefilename,np.float64(win[0]),np.float64(win[1])))
-        df = rdf.copy()
+    @param df: a DataFrame with the features CommitmentDate, IncomegroupName and 'valuename'
+    @param valuename: the feature to aggregate
 
-        df = df[df['USD_Commitment_Defl'] > np.float64(win[0])]
-        df = df[df['USD_Commitment_Defl'] < np.float64(win[1])]
+    @return: a DataFrame indexed by (CommitmentYear, IncomegroupName) with the columns sum, mean, median and count
+    """
+    years = df['CommitmentDate'].dt.year.rename('CommitmentYear')
+    return df.groupby([years,'IncomegroupName'],observed=True)[valuename].agg(['sum','mean','median','count']).sort_index()
 
-        projectcount = df['USD_Commitment_Defl'].count()
-        commitsum = df['USD_Commitment_Defl'].sum()
+def get_incomegroup_table(statistics, all_incomegroups=["LDCs","LMICs","MADCTs","Other LICs","Part I unallocated by income", "UMICs"]):
+    """
+    creates the wide table used for the barcharts from the result of get_incomegroup_statistics. Besides the
+    statistics, the share of every incomegroup in the yearly sum and count is added as 'sum-percent' and 'count-percent'
 
-        df[valuename].plot(kind='hist',grid=True,ax=axes[int(i/ncols)][i % ncols],bins=bins,
-                                      title=" %.2f < x < %.2f \n %d projects with total of %.2f mUSD" % (np.float64(win[0]),np.float64(win[1]),projectcount,commitsum))
-        # create a json_file with the plotdata - XXX don't calculate the bins twice
+    @param statistics: a DataFrame as returned by get_incomegroup_statistics
+    @param all_incomegroups: the incomegroups considered for the percent view
 
-        if df[valuename].count() > 0:
-            dfh=pd.cut(df[valuename],bins=bins).value_counts()
-            with open("%s%s-%.2f-%.2f.json" %(targetdir,basefilename,np.float64(win[0]),np.float64(win[1])),"w") as fd:
-                fd.write(dfh.to_json(orient="index"))
+    @return: a DataFrame indexed by the year (as string) with the columns (statistic, IncomegroupName)
+    """
+    tables = {}
+    for i in ['sum','mean','median','count']:
+        table = statistics[i].unstack().fillna(0.0)
+        table.index = pd.Index([str(int(x)) for x in table.index],name='CommitmentYear')
+        table.columns = pd.Index([str(x) for x in table.columns],name='IncomegroupName')
+        tables[i] = table
 
-        else:
-            print("Warning no Data for: %s%s-%.2f-%.2f.json" %(targetdir,basefilename,np.float64(win[0]),np.float64(win[1])))
+    # the percent view only considers the known incomegroups
+    for i in ['sum','count']:
+        table = tables[i][[x for x in all_incomegroups if x in tables[i]]]
+        table = table.div(table.sum(axis=1),axis=0) * 100
+        tables[i+'-percent'] = table.replace([np.inf, -np.inf], np.nan)
 
-    plt.savefig(targetdir+basefilename,bbox_inches='tight')
-    plt.close(plt.gcf())
+    return pd.concat(tables,axis=1,names=['statistic'])
 
 def generate_barchart_for_incomegroup_distribution(idf,startyear = None, stopyear = datetime.now().year,
                                                    targetdir = "results/dataoverview/",
                                                    basefilename = "incomegroups.png",
                                                    filterzerocommitment = True,
                                                    valuename="USD_Commitment_Defl",
-                                                   incomegroups=['LDCs','LMICs','UMICs'],
-                                                   figsize=(30,56)):
+                                                   incomegroups=default_incomegroups,
+                                                   figsize=(30,56),
+                                                   renderer = inline_renderer,
+                                                   force = False,
+                                                   aggregate = None,
+                                                   prefiltered = False):
     """
     generates six barchart-graphics showing the distribution of commitments and projectnumer among the different incomegroups (LDCs,LICs...) over time. also creates the json-files of the aggregated data.
 
@@ -193,31 +511,63 @@ def generate_barchart_for_incomegroup_distribution(idf,startyear = None, stopyea
     @param valuename: defaults to USD_Commitment_Defl
     @param basefilename: the filename and format (based on extension) of the resulting image
     @incomegroups: only consider the listed incomegroups. expects an array of IncomegroupNames. There are: LDCs,LMICs,MADCTs,Other LICs,Part I unallocated by income, UMICs. project specific per default only LDCs, LMICs and UMICs are taken into account. with None or empty array every group is considered
+    @renderer: the ChartRenderer creating the image
+    @force: generate the results even if the manifest shows they are up to date
+    @aggregate: the statistics collected by outOfCore.BarchartAggregate for this window, idf is not used then
+    @prefiltered: idf contains only the data of the years already, see select_commitment_years
 
     """
 
     all_incomegroups = ["LDCs","LMICs","MADCTs","Other LICs","Part I unallocated by income", "UMICs"]
 
+    if aggregate is None:
+        (idf, targetdir) = select_commitment_years(idf,startyear=startyear,stopyear=stopyear,targetdir=targetdir,
+                                                   prefiltered=prefiltered)
+        df = select_barchart_data(idf,valuename,incomegroups=incomegroups,filterzerocommitment=filterzerocommitment)
+    else:
+        targetdir = get_window_targetdir(targetdir,startyear=startyear,stopyear=stopyear)
+        df = aggregate.get_statistics(valuename,incomegroups,filterzerocommitment)
 
-    nrows = 8
+    os.makedirs(targetdir,exist_ok=True)
 
-    fig, axes = plt.subplots(nrows=nrows, ncols=1,figsize=figsize)
+    manifest = "%s%s.manifest.json" %(targetdir,basefilename)
+    fingerprint = get_output_fingerprint(df,('barcharts',basefilename,valuename,incomegroups,filterzerocommitment,
+                                              figsize,renderer.images))
+    if is_output_current(manifest,fingerprint,force=force):
+        print("Skipping: %s, the results are up to date" %(manifest))
+        return
+    remove_output_manifest(manifest)
+
+    # one aggregation for all statistics, every subplot and json-file uses this table
+    statistics = get_incomegroup_statistics(df,valuename) if aggregate is None else df
+    if len(statistics) == 0:
+        print("Warning no Data for: %s%s" %(targetdir,basefilename))
+        return
+    table = get_incomegroup_table(statistics,all_incomegroups=all_incomegroups)
+
+    files = []
+    for (statistic, suffix) in [('sum-percent','sum-percent'),('sum','sum-absolut'),('mean','mean'),
+                                ('median','median'),('count-percent','count-percent'),('count','count-absolut')]:
+        with open("%s%s-%s.json" %(targetdir,basefilename,suffix),"w") as fd:
+            fd.write(table[statistic].to_json(orient="index"))
+        files.append("%s%s-%s.json" %(targetdir,basefilename,suffix))
+
+    renderer.render(render_incomegroup_barcharts,targetdir+basefilename,table,figsize)
+    if renderer.images:
+        files.append(targetdir+basefilename)
+
+    renderer.finish(write_output_manifest,manifest,fingerprint,files)
+
+def select_barchart_data(idf, valuename, incomegroups=default_incomegroups, filterzerocommitment=True):
+    """
+    selects the rows and features generate_barchart_for_incomegroup_distribution aggregates, see there for the parameters
 
+    @return: a new DataFrame with the features CommitmentDate, IncomegroupName and 'valuename'
+    """
     df = DataFrame()
     for i in ['CommitmentDate','IncomegroupName',valuename]:
         df[i] = idf[i]
 
-    if startyear:
-        df = df[df['CommitmentDate'] > datetime(year=startyear-1,month=12,day=31)]
-        targetdir = targetdir + "from_" + str(startyear) + "_"
-    if stopyear:
-        df = df[df['CommitmentDate'] < datetime(year=stopyear+1,month=1,day=1)]
-        targetdir = targetdir + "upto_" + str(stopyear)
-    if startyear or stopyear:
-        targetdir = targetdir + "/"
-
-    os.makedirs(targetdir,exist_ok=True)
-
     if filterzerocommitment:
         df = df[df[valuename].notnull()]
         df = df[df[valuename] != 0.0]
@@ -225,120 +575,37 @@ def generate_barchart_for_incomegroup_distribution(idf,startyear = None, stopyea
     if type(incomegroups) == type([]) and len(incomegroups) > 0:
         df = df[df['IncomegroupName'].isin(incomegroups)]
 
-    # group by year and IncomegroupName
-    df = df.set_index("CommitmentDate")
-
-    groupeddf = df.groupby([Grouper(freq="A"), 'IncomegroupName'])[valuename]
-
-    # resolve grouping, unstack, fill missing and reset_index()
-    ddf = groupeddf.sum().unstack().fillna(0.0).reset_index()
-    # get a percent view in a new DataFrame
-    df2 = DataFrame()
-    for i in all_incomegroups:
-        try:
-            df2[i]=ddf[i]
-        except Exception as e:
-            pass
-    df2['CommitmentYear'] = ddf.reset_index()['CommitmentDate'].apply(lambda x: str(x.year))
-
-    df2=df2.set_index('CommitmentYear')
-
-    countrytypesum = DataFrame(df2.T.sum())
-    for i in all_incomegroups:
-        try:
-            df2[i] = (df2[i] / countrytypesum[0]) * 100
-        except Exception as e:
-            pass
-    df2.replace([np.inf, -np.inf], np.nan, inplace=True)
-
-    df2.plot(width=0.9,grid=True,kind='bar', ax=axes[1],title="mUSD per IncomeGroup (Prozent)")
-    df2.plot(width=0.9,grid=True,kind='bar', stacked=True, ax=axes[2],title="mUSD per IncomeGroup (Prozent)")
-
-    with open("%s%s-sum-percent.json" %(targetdir,basefilename),"w") as fd:
-        fd.write(df2.to_json(orient="index"))
-
-    # an absolut view
-    # create index on year as string and drop old index
-    ddf["CommitmentYear"]=ddf["CommitmentDate"].apply(lambda x: str(x.year))
-    ddf = ddf.drop(columns=["CommitmentDate"]).set_index("CommitmentYear")
-
-    # plot absolut sum
-    ddf.plot(width=0.9,grid=True,kind='bar',ax=axes[0], title="mUSD per IncomeGroup (sum)")
-
-    with open("%s%s-sum-absolut.json" %(targetdir,basefilename),"w") as fd:
-        fd.write(ddf.to_json(orient="index"))
-
-    # create bar-char with mean
-    ddf = groupeddf.mean().unstack().fillna(0.0).reset_index()
-
-    # create index on year as string and drop old index
-    ddf["CommitmentYear"]=ddf["CommitmentDate"].apply(lambda x: str(x.year))
-    ddf = ddf.drop(columns=["CommitmentDate"]).set_index("CommitmentYear")
-
-    ddf.plot(width=0.9,grid=True,kind='bar',ax=axes[3], title="mUSD per IncomeGroup (mean)")
-    with open("%s%s-mean.json" %(targetdir,basefilename),"w") as fd:
-        fd.write(ddf.to_json(orient="index"))
-
-
-    # create bar-char with median
-    ddf = groupeddf.median().unstack().fillna(0.0).reset_index()
-
-    # create index on year as string and drop old index
-    ddf["CommitmentYear"]=ddf["CommitmentDate"].apply(lambda x: str(x.year))
-    ddf = ddf.drop(columns=["CommitmentDate"]).set_index("CommitmentYear")
-
-    ddf.plot(width=0.9,grid=True,kind='bar',ax=axes[4], title="mUSD per IncomeGroup (median)")
-    with open("%s%s-median.json" %(targetdir,basefilename),"w") as fd:
-        fd.write(ddf.to_json(orient="index"))
-
-    ddf = groupeddf.count().unstack().fillna(0.0).reset_index()
-
-    # get a percent view in a new DataFrame
-    df2 = DataFrame()
-    for i in all_incomegroups:
-        try:
-            df2[i]=ddf[i]
-        except Exception as e:
-            pass
-    df2['CommitmentYear'] = ddf.reset_index()['CommitmentDate'].apply(lambda x: str(x.year))
-
-    df2=df2.set_index('CommitmentYear')
-
-    countrytypesum = DataFrame(df2.T.sum())
-    for i in all_incomegroups:
-        try:
-            df2[i] = (df2[i] / countrytypesum[0]) * 100
-        except Exception as e:
-            pass
-    df2.replace([np.inf, -np.inf], np.nan, inplace=True)
-
-    df2.plot(width=0.9,grid=True,kind='bar', ax=axes[6],title="projects per IncomeGroup (Prozent)")
-    df2.plot(width=0.9,grid=True,kind='bar', stacked=True,ax=axes[7],title="projects per IncomeGroup (Prozent)")
-    with open("%s%s-count-percent.json" %(targetdir,basefilename),"w") as fd:
-        fd.write(df2.to_json(orient="index"))
-
-
-    # create index on year as string and drop old index
-    ddf["CommitmentYear"]=ddf["CommitmentDate"].apply(lambda x: str(x.year))
-    ddf = ddf.drop(columns=["CommitmentDate"]).set_index("CommitmentYear")
-
-    ddf.plot(width=0.9,grid=True,kind='bar',ax=axes[5], title="projects per IncomeGroup (count)")
-    with open("%s%s-count-absolut.json" %(targetdir,basefilename),"w") as fd:
-        fd.write(ddf.to_json(orient="index"))
+    return df
 
+def render_incomegroup_barcharts(filename, table, figsize):
+    """
+    creates the image of generate_barchart_for_incomegroup_distribution
 
+    @param filename: the filename and format (based on extension) of the image
+    @param table: the result of get_incomegroup_table
+    @param figsize: the size of the image
+    """
+    nrows = 8
 
+    fig, axes = plt.subplots(nrows=nrows, ncols=1,figsize=figsize)
 
+    table['sum'].plot(width=0.9,grid=True,kind='bar',ax=axes[0], title="mUSD per IncomeGroup (sum)")
+    table['sum-percent'].plot(width=0.9,grid=True,kind='bar', ax=axes[1],title="mUSD per IncomeGroup (Prozent)")
+    table['sum-percent'].plot(width=0.9,grid=True,kind='bar', stacked=True, ax=axes[2],title="mUSD per IncomeGroup (Prozent)")
+    table['mean'].plot(width=0.9,grid=True,kind='bar',ax=axes[3], title="mUSD per IncomeGroup (mean)")
+    table['median'].plot(width=0.9,grid=True,kind='bar',ax=axes[4], title="mUSD per IncomeGroup (median)")
+    table['count'].plot(width=0.9,grid=True,kind='bar',ax=axes[5], title="projects per IncomeGroup (count)")
+    table['count-percent'].plot(width=0.9,grid=True,kind='bar', ax=axes[6],title="projects per IncomeGroup (Prozent)")
+    table['count-percent'].plot(width=0.9,grid=True,kind='bar', stacked=True,ax=axes[7],title="projects per IncomeGroup (Prozent)")
 
-    plt.savefig(targetdir+basefilename,bbox_inches='tight')
-    plt.close(plt.gcf())
+    plt.savefig(filename,bbox_inches='tight')
+    plt.close(fig)
 
 
 
 def filter_donor_sector_flow_recipient(idf,donorcodes=['5'],sectorcodes=['140'],flowcodes=['11','13'],
-                                       recipientcodes=["285","248","282","238","278","266",
-                                                       "228","645","666","142","437","428","549", "136"],
-                                       filterzerocommitment=True):
+                                       recipientcodes=default_recipientcodes,
+                                       filterzerocommitment=True, valuename='USD_Commitment_Defl', filterindex=None):
     """
     Filters a given DataFrame for donors, sectors, flows and/or recipients. Only the provided will be taken into account.
     Since this dataanlyse is for specific project the defaults are choosen for germany, water, ODA Grands and ODA Loans. the default recipients are:
@@ -364,110 +631,216 @@ def filter_donor_sector_flow_recipient(idf,donorcodes=['5'],sectorcodes=['140'],
     @param recipientcodes: an array of recipient codes (label/text) used by the oecd to identify a recipient country
     @param valuename: defaults to USD_Commitment_Defl
     @param filterzerocommitment: filter out commitments with a value of zero
+    @param filterindex: a FilterIndex of idf. if given, the rows are selected by the index instead of comparing every row
     @return: returns a new DataFrame with applied filters
     """
+    if filterindex is not None:
+        rows = filterindex.query(donorcodes=donorcodes,sectorcodes=sectorcodes,flowcodes=flowcodes,
+                                 recipientcodes=recipientcodes,filterzerocommitment=filterzerocommitment,
+                                 valuename=valuename)
+        return filterindex.select(rows)
+
+    mask = get_donor_sector_flow_recipient_mask(idf,donorcodes=donorcodes,sectorcodes=sectorcodes,
+                                                flowcodes=flowcodes,recipientcodes=recipientcodes,
+                                                filterzerocommitment=filterzerocommitment,
+                                                valuename=valuename)
+    return idf[mask]
+
+def iter_micro_data(idf, features=None, rows=None, chunksize=100000):
+    """
+    yields the selected rows and features of a DataFrame in chunks, only one chunk is copied at a time
 
-    df = idf.copy()
-    if filterzerocommitment:
-        df = df[df[valuename].notnull()]
-        df = df[df[valuename] != 0.0]
-
-    if type(donorcodes) == type([]) and len(donorcodes) > 0:
-        df = df[df['DonorCode'].isin(donorcodes)]
-
-    if type(sectorcodes) == type([]) and len(sectorcodes) > 0:
-        df = df[df['SectorCode'].isin(sectorcodes)]
-
-    if type(flowcodes) == type([]) and len(flowcodes) > 0:
-        df = df[df['FlowCode'].isin(flowcodes)]
-
-    if type(recipientcodes) == type([]) and len(recipientcodes)> 0:
-        df = df[df['RecipientCode'].isin(recipientcodes)]
+    @param idf: the dataframe to extract the features/columns from
+    @param features: which features to take (array of strings). If None, all features are taken
+    @param rows: the positions of the rows to take (ex. from FilterIndex.query). If None, all rows are taken
+    @param chunksize: the number of rows per chunk
+    """
+    if type(features) == type([]) and len(features)>0:
+        columns = [idf.columns.get_loc(i) for i in features if i in idf]
+    else:
+        columns = list(range(len(idf.columns)))
+    if rows is None:
+        rows = np.arange(len(idf))
 
-    return df
+    # an empty selection still results in one (empty) chunk, so the header of the csv-file is written
+    for i in range(0,max(len(rows),1),chunksize):
+        yield idf.iloc[rows[i:i+chunksize],columns]
 
-def save_micro_data(idf, targetdir = "results/microdata/",basefilename = 'microdata',features=None):
+def get_parquet_chunk_schema(chunk):
+    """
+    derives the schema of a parquet-file from its first chunk. columns without any value in the chunk
+    are stored as text, so later chunks with values still fit the schema
     """
-    stores a csv and a jsonfile with the selected features of a dataframe
+    schema = pa.Schema.from_pandas(chunk,preserve_index=True)
+    for (n, field) in enumerate(schema):
+        if pa.types.is_null(field.type):
+            schema = schema.set(n,field.with_type(pa.string()))
+    return schema
+
+def save_micro_data(idf, targetdir = "results/microdata/",basefilename = 'microdata',features=None, force=False,
+                    rows=None, formats=['csv','json'], compression=None, chunksize=100000):
+    """
+    stores the selected features of a dataframe as csv, json, ndjson and/or parquet. the files are written chunk
+    by chunk, so only one chunk of rows is held in memory (besides idf)
 
-    @param idf: the dataframe to extract the features/columns from
+    @param idf: the dataframe to extract the features/columns from. a function returning an iterable of
+                DataFrames (ex. outOfCore.FrameStore.iter_frames) is stored chunk by chunk as one DataFrame,
+                rows and chunksize are not used then
     @param targetdir: the directory to store data in. it is created if it is missing
-    @param basefilename: the first part of the filename to use for the csv/json-files
+    @param basefilename: the first part of the filename to use for the files
     @param features: which features to store (array of strings). If None, all features are stored
+    @param force: store the files even if the manifest shows they are up to date
+    @param rows: the positions of the rows to store (ex. from FilterIndex.query). If None, all rows are stored
+    @param formats: an array of the formats to store: 'csv', 'json' (an object with a key per row), 'ndjson'
+                    (one json-object per line) and 'parquet'
+    @param compression: None, 'gzip' or 'zstd'. the text formats get the extension .gz or .zst, parquet-files
+                        are compressed internally
+    @param chunksize: the number of rows written at once
     """
 
     os.makedirs(targetdir,exist_ok=True)
-    if type(features) == type([]) and len(features)>0:
-        df = extract_features(idf,features=features)
-
-        df.to_csv(path_or_buf="%s/%s.csv" %(targetdir,basefilename),
-                   sep = ",", columns=features, quoting=csv.QUOTE_NONNUMERIC)
-        df.reset_index().to_json(path_or_buf="%s/%s.json" %(targetdir,basefilename),
-                                 orient="index")
+    if isinstance(idf, pd.DataFrame):
+        chunks = lambda: iter_micro_data(idf,features=features,rows=rows,chunksize=chunksize)
     else:
-        idf.to_csv(path_or_buf="%s/%s.csv" %(targetdir,basefilename),
-                   sep = ",", quoting=csv.QUOTE_NONNUMERIC)
-        idf.reset_index().to_json(path_or_buf="%s/%s.json" %(targetdir,basefilename),
-                                  orient="index")
-
-
+        chunks = lambda: (extract_features(i,features=features) for i in idf())
+
+    extension = {None: "", 'gzip': ".gz", 'zstd': ".zst"}[compression]
+    filenames = dict([(i, "%s/%s.%s%s" %(targetdir,basefilename,i,"" if i == 'parquet' else extension))
+                      for i in formats])
+
+    manifest = "%s/%s.manifest.json" %(targetdir,basefilename)
+    fingerprint = get_output_fingerprint(chunks(),('microdata',basefilename,features,formats,compression))
+    if is_output_current(manifest,fingerprint,force=force):
+        print("Skipping: %s, the files are up to date" %(manifest))
+        return
+    remove_output_manifest(manifest)
+
+    streams = dict([(i, pa.output_stream(filenames[i],compression=compression))
+                    for i in formats if i != 'parquet'])
+    parquetwriter = None
+    start = 0
+    try:
+        if 'json' in streams:
+            streams['json'].write(b"{")
+
+        for chunk in chunks():
+            print("Writing: %s/%s rows %d-%d" %(targetdir,basefilename,start,start+len(chunk)))
+            if 'csv' in streams:
+                streams['csv'].write(chunk.to_csv(sep = ",", header=(start == 0),
+                                                  quoting=csv.QUOTE_NONNUMERIC).encode("utf-8"))
+
+            # the rows are numbered across all chunks like reset_index() of the whole selection
+            records = chunk.reset_index()
+            records.index = records.index + start
+            if 'json' in streams and len(records) > 0:
+                streams['json'].write(("," if start > 0 else "").encode("utf-8") +
+                                      records.to_json(orient="index")[1:-1].encode("utf-8"))
+            if 'ndjson' in streams and len(records) > 0:
+                streams['ndjson'].write(records.to_json(orient="records",lines=True).rstrip("\n").encode("utf-8") + b"\n")
+
+            if 'parquet' in formats:
+                if parquetwriter is None:
+                    schema = get_parquet_chunk_schema(chunk)
+                    parquetwriter = pq.ParquetWriter(filenames['parquet'],schema,compression=compression or 'snappy')
+                parquetwriter.write_table(pa.Table.from_pandas(chunk,schema=schema,preserve_index=True))
+
+            start += len(chunk)
+
+        if 'json' in streams:
+            streams['json'].write(b"}")
+    finally:
+        for i in streams.values():
+            i.close()
+        if parquetwriter is not None:
+            parquetwriter.close()
+
+
+    write_output_manifest(manifest,fingerprint,list(filenames.values()))
+
+
+def build_enriched_data(setname="sane", datadir="data/", cachedir="data/cache", features=default_features,
+                        series=default_series, workers=1, backend=None, datasets=datasets):
+    """
+    reads the oecd-data, the worldbank series and the countrycode-mapping once and merges them. the result
+    contains every valuename, so all metrics are evaluated on the same frame
+
+    @param setname: the set of zip-files to read, see tools.datasets
+    @param datadir: where to find the zip-files
+    @param cachedir: where to store/find cached data
+    @param features: the features of the oecd-data to keep
+    @param series: the series of the worldbank merged for donors and recipients
+    @param workers: how many missing partitions are built in parallel
+    @param backend: where to fetch the worldbank data, see worldbankApi.ApiBackend and worldbankApi.FixtureBackend
+    @param datasets: a dict with datasets containing lists of zip-filenames, the countrycode-mapping is built
+                     from the zip-files of the set as well
+
+    @return: a DataFrame with the oecd-data and the 'Donorstat '- and 'Recipientstat '-features
+    """
+    oecddf = read_water_data(setname=setname,datadir=datadir,datasets=datasets,cachedir=cachedir,columns=features,
+                             workers=workers)
+    wbdf = fetch_series(series=series,cachedir=cachedir,backend=backend)
+    codemapping = get_oecd_iso3_code_mapping(cachedir=cachedir,datadir=datadir,setname=setname,datasets=datasets)
+
+    # reduce to wanted features
+    idf = extract_features(oecddf,features=features).reset_index()
+
+    # merge worldbankdata on year and country - commitments for regions and by 'foundations' or
+    # other international constructs are filtered
+    return merge_wbseries_with_oecd_data(idf,wbdf,codemapping=codemapping,cachedir=cachedir)
+
+def run_pipeline(setname="sane", valuenames=default_valuenames, resultdir="results/", datadir="data/",
+                 cachedir="data/cache", windows=[(1980,datetime.now().year)], generators=None,
+                 renderer=inline_renderer, workers=1, force=False, microdataformats=['csv','json'], compression=None,
+                 backend=None):
+    """
+    creates all results for every valuename. loading, enrichment and the selection of the focus-groups
+    are done once, only the reports and microdata are created per valuename in resultdir/<valuename>/
+
+    @param setname: the set of zip-files to read, see tools.datasets
+    @param valuenames: an array of the features to evaluate, defaults to default_valuenames
+    @param resultdir: the basedir of the results
+    @param datadir: where to find the zip-files
+    @param cachedir: where to store/find cached data
+    @param windows: the time windows of the reports, see generate_reports
+    @param generators: the generate_*-functions to call, see generate_reports. an empty array only stores the microdata
+    @param renderer: the ChartRenderer creating the images
+    @param workers: how many missing partitions are built in parallel
+    @param force: create the results even if they are up to date
+    @param microdataformats: the formats of the microdata, see save_micro_data
+    @param compression: the compression of the microdata, see save_micro_data
+    @param backend: where to fetch the worldbank data, see build_enriched_data
+    """
+    df = build_enriched_data(setname=setname,datadir=datadir,cachedir=cachedir,workers=workers,backend=backend)
+    features = default_features + ["Recipientstat "+i for i in default_series]
+
+    # the focus-groups do not depend on the valuename, zero values are filtered per valuename. they are sorted
+    # once for the windows of generate_reports
+    filterindex = FilterIndex(df)
+    focus = dict([(name, sort_by_commitmentdate(df if params is None else
+                   filter_donor_sector_flow_recipient(df,filterzerocommitment=False,filterindex=filterindex,**params)))
+                  for (name, params) in default_focus_groups.items()])
+
+    for valuename in valuenames:
+        for (name, fdf) in focus.items():
+            generate_reports(fdf,windows=windows,generators=generators,targetdir="%s%s/%s/" %(resultdir,valuename,name),
+                             valuename=valuename,renderer=renderer,force=force)
+
+        # save microdata of german water projects for all recipients and the selected recipients, the rows are
+        # taken from df chunk by chunk
+        for (recipientcodes, basefilename) in default_microdata_selections:
+            rows = filterindex.query(donorcodes=['5'],sectorcodes=['140'],flowcodes=['11','13'],
+                                     recipientcodes=recipientcodes,filterzerocommitment=True,valuename=valuename)
+            save_micro_data(df,targetdir="%s%s/microdata/" %(resultdir,valuename),basefilename=basefilename,
+                            features=features,rows=rows,formats=microdataformats,compression=compression,force=force)
+
+    renderer.wait()
 
 if __name__ == "__main__":
     devel = False
 
-    # generate histogram over the full dataset
-    for valuename in ['USD_Commitment_Defl','USD_Disbursement_Defl','USD_GrantEquiv']:
-
-        if not devel:
-            df = None
-            # read the data respecting what is defined as "sane" set from the oecd
-            # if a pickle file is present, load that instead
-
-            # fetch data from worldbank
-            wbdf = fetch_series()
-
-        codemapping = get_oecd_iso3_code_mapping()
-
-        # reduce to wanted features
-        idf = extract_features(oecddf,features = default_features).reset_index()
-
-        # merge worldbankdata on year and country - commitments for regions and by 'foundations' or
-        # other international constructs are filtered
-        df = merge_wbseries_with_oecd_data(idf,wbdf,codemapping=codemapping)
-
-        # generate histogram over the full dataset
-        # generate_histograms_about_projectsize(df)
-        # histogram for the years 2010-
-
-        #generate_histograms_about_projectsize(df,startyear=2010)
-        # histogram for the years 2015-2017
-        #generate_histograms_about_projectsize(df,startyear=2015,stopyear=2017)
-        # and a histogram for every year
-        #for i in range(2010,2020):
-        #    generate_histograms_about_projectsize(df,startyear=i,stopyear=i)
-
-        # generate_barchart_for_incomegroup_distribution(df,startyear=1980)
-        # generate_sunburst_for_grouping(df,startyear=1980)
-
-        # focus on all german projects
-        df_focus = filter_donor_sector_flow_recipient(df,sectorcodes=None,recipientcodes=None)
-        # generate_barchart_for_incomegroup_distribution(df_focus,startyear=1980,targetdir="results/germany/")
-        # generate_sunburst_for_grouping(df_focus,basefilename="germany_projects_grouping",startyear=1980,targetdir="results/germany/")
-
-
-        # save microdata for all recipients, but filtered otherwise
-        df = filter_donor_sector_flow_recipient(df,recipientcodes=None)
-        features = default_features
-        for i in default_series:
-            features.append("Recipientstat "+i)
-        save_micro_data(df,features=features)
-        # generate_barchart_for_incomegroup_distribution(df,basefilename="water_incomegroups.png",startyear=1980,targetdir="results/germany-water/")
-        # generate_sunburst_for_grouping(df,basefilename="water_projects_grouping",startyear=1980,targetdir="results/germany-water/")
-
-        df = filter_donor_sector_flow_recipient(df)
-        # generate_histograms_about_projectsize(df,basefilename="projectsizes_germany_water_selected_countries.png",targetdir="results/germany-water/")
-        # generate_histograms_about_projectsize(df,basefilename="projectsizes_germany_water_selected_countries.png",startyear=2015,targetdir="results/germany-water/")
-        save_micro_data(df,basefilename="microdata_selectedrecipients",features=features)
+    if not devel:
+        with ChartRenderer(workers=None) as renderer:
+            run_pipeline(renderer=renderer)
 
     else:
         df = read_water_data(setname="playset")
@@ -1,10 +1,15 @@
 #!/usr/bin/env python3
 
 import world_bank_data as wb
-from pandas import DataFrame
+import pandas as pd
+import numpy as np
+from pandas import DataFrame, read_csv
 from datetime import datetime
 import os
 import pickle
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
 import plotly.express as px
 
 default_series=['SI.SPR.PCAP','SI.POV.XPND.MD','SP.POP.TOTL','AG.SRF.TOTL.K2']
@@ -35,36 +40,249 @@ def get_all_countries(reverse=False,cachedir="data/cache",includeaggs=False):
 
     return result
 
-def get_regionnames(cachedir="data/cache"):
+def get_regionnames(cachedir="data/cache", backend=None):
     """
     returns a df of iso3 country-codes used by the worldbank to the realnames.
     
     @param cachedir: since the data is on a remote server and cannot be downloaded as persistent file, 
                      the result of the api-call is stored in this cachedir
+    @param backend: where to fetch the data if it is not cached, defaults to default_backend
     
     @return dict: with index country-code and value of the country-name
     """
     
-    result = {}
-    df = None
     os.makedirs(cachedir,exist_ok=True)
 
     cached_df_filename = cachedir+"/countrycodes.p"
     try:
         with open(cached_df_filename, 'rb') as fd:
             print("Reading Data from cached file: %s" %(cached_df_filename))
-            df = pickle.load(fd)
+            return pickle.load(fd)
     except:
-        df = DataFrame(wb.get_countries()).reset_index()
-        print("Writing cached_df_file: %s" %(cached_df_filename))
-        with open(cached_df_filename, 'wb') as fd:
-            pickle.dump(df, fd)
-    
-    return df
+        df = call_with_retries((backend or default_backend).fetch_countries,())
+        write_regionnames(df,cachedir=cachedir)
+        return df
+
+def write_regionnames(df, cachedir="data/cache"):
+    """
+    stores the result of fetch_countries of a backend as cache-file used by get_regionnames
+    """
+    cached_df_filename = cachedir+"/countrycodes.p"
+    print("Writing cached_df_file: %s" %(cached_df_filename))
+    with open(cached_df_filename, 'wb') as fd:
+        pickle.dump(df, fd)
+
+class ApiBackend:
+    """
+    fetches the data from the api of the worldbank (world_bank_data)
+    """
+
+    def fetch_series(self, series, startyear, stopyear):
+        """
+        fetches one series for all countries
+
+        @param series: the name of the series as defined by the worldbank
+        @param startyear: the first year to fetch
+        @param stopyear: the last year to fetch
+
+        @return: a DataFrame with the columns Series, Country (iso3), Year (int) and Value
+        """
+        df = wb.get_series(series, date="%d:%d" %(startyear,stopyear), id_or_value='id').reset_index()
+        return DataFrame({'Series': series, 'Country': df['Country'].astype(str),
+                          'Year': pd.to_numeric(df['Year']).astype(np.int64), 'Value': df[series].astype(np.float64)})
+
+    def fetch_countries(self):
+        """
+        @return: a DataFrame with the countries and regions, the iso3-code is the column 'id'
+        """
+        return DataFrame(wb.get_countries()).reset_index()
+
+class FixtureBackend:
+    """
+    reads the data from local files instead of the api, used if the api is not available (offline, tests).
+    the directory contains 'series.csv' with the columns Series, Country, Year and Value and 'countries.csv'
+    with the columns of ApiBackend.fetch_countries
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.series = None
+
+    def fetch_series(self, series, startyear, stopyear):
+        if self.series is None:
+            self.series = read_csv(self.directory+"/series.csv",
+                                   dtype={'Series': str, 'Country': str, 'Year': np.int64, 'Value': np.float64})
+        df = self.series
+        mask = (df['Series'] == series) & (df['Year'] >= startyear) & (df['Year'] <= stopyear)
+        return df[mask].reset_index(drop=True)
+
+    def fetch_countries(self):
+        df = read_csv(self.directory+"/countries.csv",dtype=str,keep_default_na=False)
+        for i in ['longitude','latitude']:
+            if i in df:
+                df[i] = pd.to_numeric(df[i],errors='coerce')
+        return df
+
+default_backend = ApiBackend()
+
+def call_with_retries(function, args, retries=3, backoff=1.0):
+    """
+    calls function(*args) and retries on errors, waiting backoff, 2*backoff, 4*backoff ... seconds
+
+    @param retries: how often the call is repeated before the last error is raised
+    """
+    for n in range(retries + 1):
+        try:
+            return function(*args)
+        except Exception as e:
+            if n == retries:
+                raise
+            print("Warning: %s failed (%s), retrying in %.1fs" %(function.__name__,e,backoff * 2**n))
+            time.sleep(backoff * 2**n)
+
+def read_series_store(cachedir="data/cache"):
+    """
+    reads the local store of worldbank series. the store is a single parquet-file with one row per
+    (Series, Country, Year) and a json-file with the years fetched per series
+
+    @param cachedir: the basedir of the cache
+
+    @return: a tupel (DataFrame indexed and sorted by (Series, Country, Year) with the column Value,
+             dict with the fetched [startyear, stopyear] per series)
+    """
+    store_filename = "%s/wb/series.parquet" %(cachedir)
+    ranges_filename = "%s/wb/ranges.json" %(cachedir)
+    if not (os.path.exists(store_filename) and os.path.exists(ranges_filename)):
+        store = DataFrame({'Series': pd.Series([],dtype=str), 'Country': pd.Series([],dtype=str),
+                           'Year': pd.Series([],dtype=np.int64), 'Value': pd.Series([],dtype=np.float64)})
+        return (store.set_index(['Series','Country','Year']), {})
+
+    with open(ranges_filename) as fd:
+        ranges = json.load(fd)
+    store = pd.read_parquet(store_filename, engine="pyarrow")
+    return (store.set_index(['Series','Country','Year']).sort_index(), ranges)
+
+def write_series_store(store, ranges, cachedir="data/cache"):
+    """
+    writes the store as returned by read_series_store
+    """
+    os.makedirs("%s/wb" %(cachedir),exist_ok=True)
+    print("Writing series store: %s/wb/series.parquet" %(cachedir))
+    store.reset_index().to_parquet("%s/wb/series.parquet" %(cachedir), engine="pyarrow", index=False)
+    with open("%s/wb/ranges.json" %(cachedir),'w') as fd:
+        json.dump(ranges, fd, indent=1)
+
+def get_missing_ranges(fetched, startyear, stopyear):
+    """
+    @param fetched: the fetched [startyear, stopyear] of a series or None
+    @return: an array of tupels (startyear, stopyear) not covered by fetched
+    """
+    if fetched is None:
+        return [(startyear, stopyear)]
+    missing = []
+    if startyear < fetched[0]:
+        missing.append((startyear, min(stopyear, fetched[0] - 1)))
+    if stopyear > fetched[1]:
+        missing.append((max(startyear, fetched[1] + 1), stopyear))
+    return missing
+
+def read_legacy_series(series, cachedir="data/cache"):
+    """
+    reads a series from the pickle-files (cachedir/<series>.p) used before the series store
+
+    @return: a DataFrame like ApiBackend.fetch_series or None if there is no pickle-file
+    """
+    cached_df_filename = cachedir+"/"+series+".p"
+    if not os.path.exists(cached_df_filename):
+        return None
+    print("Importing Data from cached file: %s" %(cached_df_filename))
+    with open(cached_df_filename, 'rb') as fd:
+        df = pickle.load(fd).reset_index()
+    return DataFrame({'Series': series, 'Country': df['Country'].astype(str),
+                      'Year': pd.to_numeric(df['Year']).astype(np.int64), 'Value': df[series].astype(np.float64)})
+
+def update_series_store(series=default_series, date="1980:%s" %(datetime.now().year), cachedir="data/cache",
+                        backend=None, refresh=False, workers=4, retries=3, backoff=1.0):
+    """
+    fetches only the years of the series, that are not in the store yet, and adds them to the store. the
+    requests (and the countries for get_regionnames, if they are not cached) run concurrently
+
+    @param series: an array of names of series as defined by the worldbank
+    @param date: the including timerange in the format 'from:to' ex. '1980:2020'
+    @param cachedir: the basedir of the cache
+    @param backend: where to fetch the data, defaults to default_backend. see ApiBackend and FixtureBackend
+    @param refresh: fetch the whole timerange again, ex. to get revised data of the last years
+    @param workers: the maximum number of concurrent requests
+    @param retries: how often a failed request is repeated
+    @param backoff: the seconds to wait before the first retry, doubled for every further retry
+
+    @return: the updated store as returned by read_series_store
+    """
+    backend = backend or default_backend
+    (startyear, stopyear) = [int(i) for i in date.split(":")]
+    (store, ranges) = read_series_store(cachedir=cachedir)
+
+    requests = []
+    fetched = []
+    for i in series:
+        if i not in ranges and not refresh:
+            legacy = read_legacy_series(i, cachedir=cachedir)
+            if legacy is not None and len(legacy) > 0:
+                fetched.append(legacy)
+                # the pickle-files were fetched from the startyear upto the last year with data
+                ranges[i] = [min(startyear, int(legacy['Year'].min())), int(legacy['Year'].max())]
+
+        missing = [(startyear, stopyear)] if refresh else get_missing_ranges(ranges.get(i), startyear, stopyear)
+        for (start, stop) in missing:
+            print("Fetching series: %s %d:%d" %(i,start,stop))
+            requests.append((i, start, stop))
+
+        if len(missing) > 0:
+            known = ranges.get(i, [startyear, stopyear]) if not refresh else [startyear, stopyear]
+            ranges[i] = [min(known[0], startyear), max(known[1], stopyear)]
+
+    countries = not os.path.exists(cachedir+"/countrycodes.p")
+    if len(requests) > 0 or countries:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(call_with_retries,backend.fetch_series,request,retries,backoff)
+                       for request in requests]
+            if countries:
+                countryfuture = executor.submit(call_with_retries,backend.fetch_countries,(),retries,backoff)
+            fetched += [i.result() for i in futures]
+            if countries:
+                os.makedirs(cachedir,exist_ok=True)
+                write_regionnames(countryfuture.result(),cachedir=cachedir)
+
+    if len(fetched) == 0:
+        return (store, ranges)
+
+    # fetched values replace stored values of the same (Series, Country, Year)
+    new = pd.concat(fetched, ignore_index=True)
+    new = new[new['Value'].notnull()].set_index(['Series','Country','Year'])
+    store = pd.concat([store[~store.index.isin(new.index)], new[~new.index.duplicated(keep='last')]]).sort_index()
+    write_series_store(store, ranges, cachedir=cachedir)
+    return (store, ranges)
+
+def lookup_series(store, series, country, year):
+    """
+    returns a single value of the store
+
+    @param store: the store as returned by read_series_store or update_series_store
+    @param series: the name of the series
+    @param country: the iso3-countrycode
+    @param year: the year (int)
+
+    @return: the value or NaN if the store has no value
+    """
+    try:
+        return store.at[(series, country, year), 'Value']
+    except KeyError:
+        return np.nan
 
 def fetch_series(series=default_series,
                  scale=['SI.SPR.PCAP','SI.POV.XPND.MD'], scaleby=360,
-                 date="1980:%s" %(datetime.now().year), cachedir="data/cache"):
+                 date="1980:%s" %(datetime.now().year), cachedir="data/cache",
+                 backend=None, workers=4):
     """
     fetches a definded indicators and formates them in a wide-dataframe
 
@@ -77,33 +295,30 @@ def fetch_series(series=default_series,
     @param scaleby: the scalefactor to apply to the series that should be scaled - used to scale daily to year by 360
     @param date: the including timerange - defaults to 1980 upto the current year in the format 'from:to' ex. '1980:2020'
     @param cachedir: since the data is on a remote server and cannot be downloaded as persistent file, 
-                     the result of the api-call is stored in this cachedir
+                     the result of the api-call is stored in the series store in this cachedir. only years
+                     missing in the store are fetched
+    @param backend: where to fetch the data, defaults to default_backend. ex. FixtureBackend("fixtures/") to work offline
+    @param workers: the maximum number of concurrent requests
 
     @return: a dataframe with selected series as columns and country, countrycode, year
     """
-    odf = DataFrame()
-    os.makedirs(cachedir,exist_ok=True)
+    (store, ranges) = update_series_store(series=series, date=date, cachedir=cachedir, backend=backend, workers=workers)
+    (startyear, stopyear) = [int(i) for i in date.split(":")]
 
-    for i in series:
-        cached_df_filename = cachedir+"/"+i+".p"
-        df = None
-        try:
-            with open(cached_df_filename, 'rb') as fd:
-                print("Reading Data from cached file: %s" %(cached_df_filename))
-                df = pickle.load(fd)
-        except:
-            df = DataFrame(wb.get_series(i, date=date,id_or_value='id', simplify_index=True))
-            print("Writing cached_df_file: %s" %(cached_df_filename))
-            with open(cached_df_filename, 'wb') as fd:
-                pickle.dump(df, fd)
-
-        df = df[df[i].notnull()]
-        if i in scale:
-            df[i] = df[i] * scaleby
-        odf = odf.append(df)
-    odf = DataFrame(odf.groupby(['Country','Year']).sum())
+    df = store.reset_index()
+    df = df[df['Series'].isin(series) & (df['Year'] >= startyear) & (df['Year'] <= stopyear)]
+
+    # one row per (Country, Year) with any value, a missing value of a single series is 0.0
+    odf = df.pivot_table(index=['Country','Year'], columns='Series', values='Value', aggfunc='sum')
+    odf = odf.reindex(columns=[i for i in series if i in odf.columns]).fillna(0.0)
+    for i in scale:
+        if i in odf:
+            odf[i] = odf[i] * scaleby
+
+    odf.columns.name = None
     odf = odf.reset_index()
-    return odf
+    odf['Year'] = odf['Year'].astype(str)
+    return odf.sort_values(['Country','Year'],kind='mergesort').reset_index(drop=True)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,82 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+
+def make_crs_rows(year, size, rng):
+    """
+    creates synthetic rows of the crs for one reporting year. codes, ids and amounts are missing or zero
+    in some rows, like in the real data
+    """
+    def codes(values, missing=0.0):
+        result = pd.Series(rng.choice(values,size=size)).astype(object)
+        return result.where(rng.random(size) >= missing, None)
+
+    def amounts(missing=0.2, zero=0.2):
+        result = pd.Series(np.round(rng.exponential(5.0,size=size),4))
+        result[rng.random(size) < zero] = 0.0
+        return result.where(rng.random(size) >= missing)
+
+    def dates(missing=0.1):
+        result = pd.Series(pd.Timestamp(year=year-3,month=1,day=1) + pd.to_timedelta(rng.integers(0,4*365,size),unit="D"))
+        return result.where(rng.random(size) >= missing).dt.strftime("%Y-%m-%d")
+
+    df = pd.DataFrame({
+        'Year': str(year),
+        'DonorCode': codes(['1','2','5','12'],missing=0.02),
+        'DonorName': "Donor",
+        'AgencyCode': codes(['1','2','3'],missing=0.02),
+        'AgencyName': "Agency",
+        'CrsID': pd.Series(["%d%05d" %(year, i) for i in range(size)]).where(rng.random(size) >= 0.05, None),
+        'ProjectNumber': codes(["P%d" %(i) for i in range(200)],missing=0.3),
+        'RecipientCode': codes(['238','285','289','625','765'],missing=0.01),
+        'RecipientName': "Recipient",
+        'IncomegroupName': codes(['LDCs','LMICs','UMICs','Part I unallocated by income'],missing=0.05),
+        'FlowCode': codes(['11','13','19']),
+        'SectorCode': codes(['140','210','311'],missing=0.02),
+        'SectorName': "Sector",
+        'PurposeCode': codes(['14010','14020','21010','31110']),
+        'PurposeName': "Purpose",
+        'ProjectTitle': codes(["Wasser und Straße", "Water supply", "Roads"]),
+        'CommitmentDate': dates(),
+        'ExpectedStartDate': dates(0.5),
+        'CompletionDate': dates(0.5),
+        'Repaydate1': dates(1.0),
+        'Repaydate2': dates(1.0),
+        'USD_Commitment_Defl': amounts(),
+        'USD_Disbursement_Defl': amounts(),
+        'USD_Received_Defl': amounts(0.5),
+        'USD_GrantEquiv': amounts(0.5),
+    })
+    return df
+
+@pytest.fixture(scope="session")
+def crsdata(tmp_path_factory):
+    """
+    writes two synthetic zip-files of the crs
+
+    @return: a dict with the parameters of read_water_data for the set 'testset'
+    """
+    basedir = tmp_path_factory.mktemp("crs")
+    datadir = str(basedir / "data") + "/"
+    os.makedirs(datadir)
+    rng = np.random.default_rng(42)
+    zipnames = []
+    for year in [2018, 2019]:
+        zipname = "crs%d.zip" %(year)
+        make_crs_rows(year,3000,rng).to_csv(datadir+zipname,sep="|",index=False,quotechar='"',encoding="iso8859_15",
+                                            compression={'method': 'zip', 'archive_name': "CRS %d data.txt" %(year)})
+        zipnames.append(zipname)
+
+    return {'setname': 'testset', 'datadir': datadir, 'datasets': {'testset': zipnames},
+            'cachedir': str(basedir / "cache")}
+
+@pytest.fixture(scope="session")
+def crsrows(crsdata):
+    from tools import read_water_data
+    return read_water_data(**crsdata)
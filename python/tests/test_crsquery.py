@@ -0,0 +1,21 @@
+import pandas as pd
+import pytest
+
+from rollupCube import cube_dimensions
+from crsQuery import CrsQuery
+
+
+@pytest.mark.parametrize("filterzerocommitment", [False, True])
+@pytest.mark.parametrize("by", [['Year','SectorCode'], cube_dimensions])
+def test_cube_equals_partitions(crsdata, by, filterzerocommitment):
+    query = (CrsQuery(crsdata['setname'],datadir=crsdata['datadir'],datasets=crsdata['datasets'],
+                      cachedir=crsdata['cachedir'])
+             .where(donorcodes=['5','12'],filterzerocommitment=filterzerocommitment)
+             .aggregate(by,commitment=('USD_Commitment_Defl','sum')))
+    assert query.plan()['source'] == 'cube'
+    result = query.collect()
+
+    query.can_use_cube = lambda: False
+    expected = query.collect()
+
+    pd.testing.assert_frame_equal(result,expected,check_dtype=False,check_categorical=False)
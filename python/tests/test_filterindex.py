@@ -0,0 +1,31 @@
+import numpy as np
+import pytest
+
+from tools import FilterIndex, get_donor_sector_flow_recipient_mask
+
+
+selections = [
+    {},
+    {'donorcodes': ['5']},
+    {'donorcodes': ['5'], 'sectorcodes': ['140'], 'flowcodes': ['11','13']},
+    {'sectorcodes': ['210','210']},
+    {'donorcodes': ['5','5','12'], 'recipientcodes': ['285','285']},
+    {'sectorcodes': ['999']},
+    {'donorcodes': [], 'sectorcodes': ['140']},
+    {'sectorcodes': ['140'], 'filterzerocommitment': True},
+    {'recipientcodes': ['238'], 'filterzerocommitment': True, 'valuename': 'USD_Disbursement_Defl'},
+]
+
+@pytest.mark.parametrize("selection", selections)
+def test_query_equals_mask(crsrows, selection):
+    index = FilterIndex(crsrows)
+    rows = index.query(**selection)
+    mask = get_donor_sector_flow_recipient_mask(crsrows,**selection)
+
+    np.testing.assert_array_equal(rows,np.flatnonzero(mask.to_numpy()))
+    assert index.select(rows).index.equals(crsrows[mask].index)
+
+def test_missing_codes_are_never_selected(crsrows):
+    index = FilterIndex(crsrows)
+    rows = index.query(donorcodes=list(crsrows['DonorCode'].cat.categories))
+    assert len(rows) == crsrows['DonorCode'].notnull().sum()
@@ -0,0 +1,43 @@
+import pandas as pd
+import pytest
+
+from tools import iter_water_data, read_crs_zip, concat_water_data
+from waterData import filter_donor_sector_flow_recipient
+
+
+def as_plain(df):
+    # the categories of chunks differ from the categories of a whole file
+    return df.astype(dict([(i, object) for i in df.columns if df[i].dtype.name == 'category']))
+
+def read_baseline(crsdata, features, **params):
+    """
+    reads every zip-file as a whole and filters the rows afterwards
+    """
+    dfs = []
+    for i in crsdata['datasets'][crsdata['setname']]:
+        df = filter_donor_sector_flow_recipient(read_crs_zip(crsdata['datadir']+i),**params)
+        dfs.append(df if features is None else df[[f for f in features if f in df]])
+    return concat_water_data(dfs)
+
+selections = [
+    {'donorcodes': None, 'sectorcodes': None, 'flowcodes': None, 'recipientcodes': None,
+     'filterzerocommitment': False},
+    {'donorcodes': ['5'], 'sectorcodes': ['140'], 'flowcodes': ['11','13'], 'recipientcodes': None,
+     'filterzerocommitment': True},
+    {'donorcodes': ['5','12'], 'sectorcodes': None, 'flowcodes': None, 'recipientcodes': ['285','238'],
+     'filterzerocommitment': True, 'valuename': 'USD_Disbursement_Defl'},
+]
+
+@pytest.mark.parametrize("features", [None, ['CommitmentDate','DonorCode','IncomegroupName','USD_Commitment_Defl',
+                                             'Repaydate1','NotInTheCrs']])
+@pytest.mark.parametrize("selection", selections)
+def test_streaming_equals_baseline(crsdata, features, selection):
+    result = concat_water_data(iter_water_data(crsdata['setname'],datadir=crsdata['datadir'],
+                                               datasets=crsdata['datasets'],features=features,chunksize=500,
+                                               **selection))
+    expected = read_baseline(crsdata,features,**selection)
+
+    assert len(result) > 0
+    if features is not None:
+        assert list(result.columns) == [i for i in features if i in expected]
+    pd.testing.assert_frame_equal(as_plain(result),as_plain(expected))
@@ -0,0 +1,53 @@
+import numpy as np
+import pandas as pd
+
+from projectTable import read_project_table, aggregate_projects, merge_project_aggregates
+from projectTable import project_key_features, project_amount_features
+
+
+def test_project_sums_equal_row_sums(crsdata, crsrows):
+    projects = read_project_table(**crsdata)
+
+    assert projects['Rows'].sum() == len(crsrows)
+    for i in project_amount_features:
+        assert np.isclose(projects[i].sum(),crsrows[i].sum())
+
+def test_missing_keys_stay_missing(crsdata, crsrows):
+    projects = read_project_table(**crsdata)
+
+    for i in project_key_features:
+        assert not (projects[i] == 'nan').any()
+    assert projects['DonorCode'].isnull().sum() > 0
+    assert projects['AgencyCode'].isnull().sum() > 0
+    # projects are unique, a missing key counts as a value of its own
+    assert not projects[project_key_features].fillna("<missing>").duplicated().any()
+
+def test_merged_parts_equal_whole(crsrows):
+    whole = merge_project_aggregates([aggregate_projects(crsrows)])
+    parts = merge_project_aggregates([aggregate_projects(crsrows.iloc[:2000]),
+                                      aggregate_projects(crsrows.iloc[2000:4500]),
+                                      aggregate_projects(crsrows.iloc[4500:])])
+
+    pd.testing.assert_frame_equal(parts,whole,check_exact=False)
+
+def test_filters(crsdata, crsrows):
+    projects = read_project_table(donorcodes=['5'],years=(2019,None),**crsdata)
+
+    # the same projects from the rows: the donor is part of the key, the years are the years of the project
+    rows = crsrows[crsrows['DonorCode'] == '5']
+    projectids = rows['ProjectNumber'].astype(object)
+    projectids = projectids.where(projectids.notnull(),"CrsID:" + rows['CrsID'].astype(object))
+    keys = [rows['AgencyCode'].astype(object).fillna("<missing>"),projectids.fillna("<missing>")]
+    expected = rows.groupby(keys).agg(Rows=('Year','size'),LastYear=('Year','max'),
+                                      **dict([(i, (i, 'sum')) for i in project_amount_features]))
+    expected = expected[expected['LastYear'].dt.year >= 2019].drop(columns=['LastYear'])
+
+    assert (projects['DonorCode'] == '5').all()
+    result = projects.set_index([projects['AgencyCode'].fillna("<missing>"),projects['ProjectId'].fillna("<missing>")])
+    result = result[expected.columns].sort_index()
+    expected = expected.sort_index()
+    assert len(result) > 0
+    assert list(result.index) == list(expected.index)
+    assert (result['Rows'].to_numpy() == expected['Rows'].to_numpy()).all()
+    for i in project_amount_features:
+        np.testing.assert_allclose(result[i].to_numpy(),expected[i].to_numpy())
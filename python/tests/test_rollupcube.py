@@ -0,0 +1,46 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from rollupCube import RollupCube, cube_dimensions, cube_valuenames, get_count_name
+
+
+def group_rows(df, by, columns):
+    """
+    groups the rows like the cube, rows with missing values in the features of by are their own group
+    """
+    df = pd.DataFrame(dict([(i, df[i].dt.year if i == 'Year' else df[i].astype(object)) for i in by] +
+                           [(i, df[i]) for i in columns]))
+    return df.groupby(by,dropna=False)[columns].sum().reset_index()
+
+def as_comparable(df, by):
+    df = df.copy()
+    for i in by:
+        df[i] = df[i].astype(object).where(df[i].notnull(),"<missing>").astype(str)
+    return df.sort_values(by).reset_index(drop=True)
+
+@pytest.fixture(scope="module")
+def cube(crsdata):
+    return RollupCube.load(**crsdata)
+
+@pytest.mark.parametrize("by", [[], ['Year'], ['DonorCode','SectorCode'], ['IncomegroupName','FlowCode'],
+                                cube_dimensions])
+def test_query_equals_rows(cube, crsrows, by):
+    result = cube.query(by=by,counts=False)
+    if len(by) == 0:
+        for i in cube_valuenames:
+            assert np.isclose(result[i].iloc[0],crsrows[i].sum())
+        return
+
+    expected = as_comparable(group_rows(crsrows,by,cube_valuenames),by)
+    result = as_comparable(result,by)
+    pd.testing.assert_frame_equal(result[by],expected[by])
+    for i in cube_valuenames:
+        np.testing.assert_allclose(result[i],expected[i])
+
+def test_counts_equal_rows(cube, crsrows):
+    result = cube.query(by=['SectorCode'],sectorcodes=['140'])
+    rows = crsrows[crsrows['SectorCode'] == '140']
+    assert result['Rows'].iloc[0] == len(rows)
+    for i in cube_valuenames:
+        assert result[get_count_name(i)].iloc[0] == (rows[i].notnull() & (rows[i] != 0.0)).sum()
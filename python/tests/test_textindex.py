@@ -0,0 +1,68 @@
+import os
+
+import numpy as np
+import pytest
+
+from conftest import make_crs_rows
+from textIndex import search, read_search_results, tokenize, text_features
+
+
+descriptions = ["Trinkwasser für Dörfer", "Straßenbau und Brücken", "École primaire", "water supply and sanitation",
+                None]
+
+@pytest.fixture(scope="module")
+def textdata(tmp_path_factory):
+    """
+    writes a synthetic zip-file with short descriptions, LongDescription is missing like in older zip-files
+
+    @return: a tupel (the parameters of search, the rows of the zip-file)
+    """
+    basedir = tmp_path_factory.mktemp("text")
+    datadir = str(basedir / "data") + "/"
+    os.makedirs(datadir)
+    df = make_crs_rows(2019,500,np.random.default_rng(7))
+    df['ShortDescription'] = [descriptions[i % len(descriptions)] for i in range(len(df))]
+    df.to_csv(datadir+"crs2019.zip",sep="|",index=False,quotechar='"',encoding="iso8859_15",
+              compression={'method': 'zip', 'archive_name': "CRS 2019 data.txt"})
+
+    return ({'setname': 'textset', 'datadir': datadir, 'datasets': {'textset': ['crs2019.zip']},
+             'cachedir': str(basedir / "cache")}, df)
+
+def find_rows(df, match):
+    """
+    the positions of the rows with the tokens of a text-feature matching, computed without the index
+    """
+    texts = df[[i for i in text_features if i in df]].fillna("")
+    return [n for n in range(len(df)) if any(match(tokenize(i)) for i in texts.iloc[n])]
+
+@pytest.mark.parametrize(("query", "match"), [
+    # casefold expands ß to ss, the query is folded the same way
+    ("Straße", lambda tokens: 'strasse' in tokens),
+    ("STRASSE", lambda tokens: 'strasse' in tokens),
+    # accents and umlauts are removed
+    ("dörfer", lambda tokens: 'dorfer' in tokens),
+    ("ecole", lambda tokens: 'ecole' in tokens),
+    ("brück*", lambda tokens: any(i.startswith('bruck') for i in tokens)),
+    ('"water supply"', lambda tokens: any(tokens[i:i+2] == ['water','supply'] for i in range(len(tokens)))),
+    # every term has to match
+    ("wasser straße", lambda tokens: 'wasser' in tokens and 'strasse' in tokens),
+])
+def test_search_finds_rows(textdata, query, match):
+    (params, df) = textdata
+    expected = find_rows(df,match)
+
+    results = search(query,**params)
+    assert len(expected) > 0
+    assert (results['Source'] == 'crs2019.zip').all()
+    assert list(results['Row']) == expected
+
+def test_search_with_codes(textdata):
+    (params, df) = textdata
+    results = search("straße",donorcodes=['5'],**params)
+    expected = [n for n in find_rows(df,lambda tokens: 'strasse' in tokens) if df['DonorCode'].iloc[n] == '5']
+
+    assert len(expected) > 0
+    assert list(results['Row']) == expected
+    rows = read_search_results(results,columns=['DonorCode','ProjectTitle'],**params)
+    assert list(rows.index) == expected
+    assert (rows['DonorCode'] == '5').all()
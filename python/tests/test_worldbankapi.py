@@ -0,0 +1,95 @@
+import os
+
+import pandas as pd
+import pytest
+
+from worldbankApi import FixtureBackend, update_series_store, read_series_store, call_with_retries, fetch_series
+
+
+class CountingBackend(FixtureBackend):
+    """
+    a FixtureBackend that records every request
+    """
+
+    def __init__(self, directory):
+        FixtureBackend.__init__(self,directory)
+        self.requests = []
+        self.countries = 0
+
+    def fetch_series(self, series, startyear, stopyear):
+        self.requests.append((series, startyear, stopyear))
+        return FixtureBackend.fetch_series(self,series,startyear,stopyear)
+
+    def fetch_countries(self):
+        self.countries += 1
+        return FixtureBackend.fetch_countries(self)
+
+@pytest.fixture
+def fixtures(tmp_path):
+    directory = tmp_path / "fixtures"
+    os.makedirs(directory)
+    rows = [(s, c, y, float(y - 1990) * (2.0 if c == 'DEU' else 1.0))
+            for s in ['SP.POP.TOTL','AG.SRF.TOTL.K2'] for c in ['DEU','UGA'] for y in range(1995,2021)]
+    pd.DataFrame(rows,columns=['Series','Country','Year','Value']).to_csv(directory / "series.csv",index=False)
+    pd.DataFrame({'id': ['DEU','UGA'], 'iso2Code': ['DE','UG'], 'name': ['Germany','Uganda'],
+                  'region': ['Europe','Africa']}).to_csv(directory / "countries.csv",index=False)
+    return (str(directory), str(tmp_path / "cache"))
+
+def test_cold_store_is_filled(fixtures):
+    (directory, cachedir) = fixtures
+    backend = CountingBackend(directory)
+    (store, ranges) = update_series_store(series=['SP.POP.TOTL','AG.SRF.TOTL.K2'],date="2000:2005",
+                                          cachedir=cachedir,backend=backend)
+
+    assert sorted(backend.requests) == [('AG.SRF.TOTL.K2',2000,2005),('SP.POP.TOTL',2000,2005)]
+    assert backend.countries == 1
+    assert ranges == {'SP.POP.TOTL': [2000,2005], 'AG.SRF.TOTL.K2': [2000,2005]}
+    assert len(store) == 2 * 2 * 6
+    assert store.at[('SP.POP.TOTL','DEU',2003),'Value'] == 26.0
+
+    # the store is persistent
+    (stored, storedranges) = read_series_store(cachedir=cachedir)
+    pd.testing.assert_frame_equal(stored,store)
+    assert storedranges == ranges
+    assert os.path.exists(cachedir + "/countrycodes.p")
+
+def test_second_run_fetches_nothing(fixtures):
+    (directory, cachedir) = fixtures
+    update_series_store(series=['SP.POP.TOTL'],date="2000:2005",cachedir=cachedir,backend=CountingBackend(directory))
+
+    backend = CountingBackend(directory)
+    (store, ranges) = update_series_store(series=['SP.POP.TOTL'],date="2000:2005",cachedir=cachedir,backend=backend)
+    assert backend.requests == []
+    assert backend.countries == 0
+    assert len(store) == 2 * 6
+
+    # only the missing years are fetched
+    (store, ranges) = update_series_store(series=['SP.POP.TOTL'],date="1998:2007",cachedir=cachedir,backend=backend)
+    assert sorted(backend.requests) == [('SP.POP.TOTL',1998,1999),('SP.POP.TOTL',2006,2007)]
+    assert ranges == {'SP.POP.TOTL': [1998,2007]}
+    assert len(store) == 2 * 10
+
+def test_fetch_series_from_store(fixtures):
+    (directory, cachedir) = fixtures
+    df = fetch_series(series=['SP.POP.TOTL','AG.SRF.TOTL.K2'],scale=['SP.POP.TOTL'],scaleby=10,date="2000:2001",
+                      cachedir=cachedir,backend=CountingBackend(directory))
+
+    assert list(df.columns) == ['Country','Year','SP.POP.TOTL','AG.SRF.TOTL.K2']
+    assert list(df['Year']) == ['2000','2001','2000','2001']
+    assert list(df['SP.POP.TOTL']) == [200.0,220.0,100.0,110.0]
+
+def test_call_with_retries():
+    calls = []
+    def flaky(value):
+        calls.append(value)
+        if len(calls) < 3:
+            raise IOError("unavailable")
+        return value
+
+    assert call_with_retries(flaky,(42,),retries=3,backoff=0.0) == 42
+    assert len(calls) == 3
+
+    calls.clear()
+    with pytest.raises(IOError):
+        call_with_retries(flaky,(42,),retries=1,backoff=0.0)
+    assert len(calls) == 2